@@ -148,13 +148,71 @@ REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': DEFAULT_RENDER_CLASSES,
 }
 
-LOGGING_CHAT_ID = os.environ.get("LOGGING_CHAT_ID", 0)
+LOGGING_CHAT_ID = int(os.environ.get("LOGGING_CHAT_ID", 0))
 LOGGING_BOT_TOKEN = os.environ.get("LOGGING_BOT_TOKEN", "")
 
 TELEGRAM_API_ID = os.environ.get("TELEGRAM_API_ID", None)
 TELEGRAM_API_HASH = os.environ.get("TELEGRAM_API_HASH", None)
 
-TELEGRAM_ADMIN_GROUP_ID = os.environ.get("TELEGRAM_ADMIN_GROUP_ID", 0)
+TELEGRAM_ADMIN_GROUP_ID = int(os.environ.get("TELEGRAM_ADMIN_GROUP_ID", 0))
+
+# Queue the webhook updates instead of processing them in the request (see `manage.py process_updates`)
+TELEGRAM_WEBHOOK_QUEUE = bool(os.environ.get("TELEGRAM_WEBHOOK_QUEUE", False))
+TELEGRAM_WEBHOOK_QUEUE_WORKERS = int(os.environ.get("TELEGRAM_WEBHOOK_QUEUE_WORKERS", 4))
+
+# Also accept the webhooks authenticated by the bot token in the query string, the way they were set
+# before `manage.py set_webhooks`; only needed until all the webhooks are set again
+TELEGRAM_WEBHOOK_QUERY_TOKEN = bool(os.environ.get("TELEGRAM_WEBHOOK_QUERY_TOKEN", False))
+
+# Build the dispatchers of all bots when the process starts instead of on their first update
+TELEGRAM_DISPATCHER_WARMUP = bool(os.environ.get("TELEGRAM_DISPATCHER_WARMUP", False))
+
+# Number of recent update IDs remembered per bot to drop the updates Telegram delivers twice,
+# optionally backed by a high-water mark saved in the database
+TELEGRAM_UPDATE_DEDUP_WINDOW = int(os.environ.get("TELEGRAM_UPDATE_DEDUP_WINDOW", 1000))
+TELEGRAM_UPDATE_DEDUP_PERSIST = bool(os.environ.get("TELEGRAM_UPDATE_DEDUP_PERSIST", False))
+
+# Buffer the users and memberships bookkeeping of group messages and save it in bulk
+# every TELEGRAM_WRITE_BEHIND_INTERVAL seconds or TELEGRAM_WRITE_BEHIND_SIZE messages
+TELEGRAM_WRITE_BEHIND = bool(os.environ.get("TELEGRAM_WRITE_BEHIND", False))
+TELEGRAM_WRITE_BEHIND_INTERVAL = float(os.environ.get("TELEGRAM_WRITE_BEHIND_INTERVAL", 5))
+TELEGRAM_WRITE_BEHIND_SIZE = int(os.environ.get("TELEGRAM_WRITE_BEHIND_SIZE", 500))
+
+# Expiration time (in seconds) of the per-process caches, see telegrambot.cache
+TELEGRAM_CACHE_TTL = int(os.environ.get("TELEGRAM_CACHE_TTL", 300))
+
+# Seconds between two checks for the bans and blacklist entries added by other processes, see cache.BanCache
+TELEGRAM_BAN_REFRESH_INTERVAL = float(os.environ.get("TELEGRAM_BAN_REFRESH_INTERVAL", 5))
+
+# Telegram calls per second made by every bot while running a network job, see telegrambot.jobs
+TELEGRAM_NETWORK_JOB_RATE = float(os.environ.get("TELEGRAM_NETWORK_JOB_RATE", 5))
+
+# Limits of the calls to the Telegram Bot API, see telegrambot.outbound:
+# calls per second of every bot, calls per minute in every group and threads making the calls
+TELEGRAM_OUTBOUND_RATE = float(os.environ.get("TELEGRAM_OUTBOUND_RATE", 30))
+TELEGRAM_OUTBOUND_GROUP_RATE = float(os.environ.get("TELEGRAM_OUTBOUND_GROUP_RATE", 20))
+TELEGRAM_OUTBOUND_WORKERS = int(os.environ.get("TELEGRAM_OUTBOUND_WORKERS", 8))
+
+# Keep-alive HTTPS connections to the Bot API shared by all the bots, see telegrambot.bots.
+# It should be larger than TELEGRAM_OUTBOUND_WORKERS plus the dispatcher threads.
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.environ.get("TELEGRAM_CONNECTION_POOL_SIZE", 16))
+
+# Seconds the joins and leaves are collected before being sent to the log chat in a single message
+TELEGRAM_LOG_BATCH_INTERVAL = float(os.environ.get("TELEGRAM_LOG_BATCH_INTERVAL", 10))
+
+# Save the logged events in bulk every TELEGRAM_LOG_DB_INTERVAL seconds or TELEGRAM_LOG_DB_SIZE events
+TELEGRAM_LOG_DB_INTERVAL = float(os.environ.get("TELEGRAM_LOG_DB_INTERVAL", 2))
+TELEGRAM_LOG_DB_SIZE = int(os.environ.get("TELEGRAM_LOG_DB_SIZE", 200))
+
+# Months of logged events kept in the database, including the current one (0: keep them forever).
+# The older monthly partitions are exported to TELEGRAM_LOG_ARCHIVE_DIR and dropped, see telegrambot.partitions
+TELEGRAM_LOG_RETENTION_MONTHS = int(os.environ.get("TELEGRAM_LOG_RETENTION_MONTHS", 0))
+TELEGRAM_LOG_ARCHIVE_DIR = Path(os.environ.get("TELEGRAM_LOG_ARCHIVE_DIR", BASE_DIR / "media" / "log-archive"))
+
+# Seconds after which the Telegram info of a group is fetched again, see telegrambot.groupsync.
+# A group is idle if nobody wrote in it since TELEGRAM_GROUP_SYNC_IDLE_INTERVAL seconds.
+TELEGRAM_GROUP_SYNC_INTERVAL = int(os.environ.get("TELEGRAM_GROUP_SYNC_INTERVAL", 3600))
+TELEGRAM_GROUP_SYNC_IDLE_INTERVAL = int(os.environ.get("TELEGRAM_GROUP_SYNC_IDLE_INTERVAL", 86400))
 
 GROUPHELP_BLOCKLIST_URL = os.environ.get("GROUPHELP_BLOCKLIST_URL", None)
 
@@ -5,3 +5,6 @@ class RolesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'roles'
     verbose_name = 'Organization roles'
+
+    def ready(self):
+        from roles import signals  # noqa: F401 (connect the signal receivers)
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from roles.models import BaseRole, Moderator, Administrator, SuperAdministrator, get_staff_users
+from university.models import Degree
+
+
+def polymorphic_staff_users(degree_ids: list[int]) -> list:
+    """The staff lookup as it was done before BaseRole.level"""
+    if degree_ids:
+        roles = BaseRole.objects.filter(degrees__in=degree_ids) | BaseRole.objects.filter(all_groups=True)
+    else:
+        roles = BaseRole.objects.filter(extra_groups=True)
+    roles = roles.instance_of(Moderator) | roles.instance_of(Administrator) | roles.instance_of(SuperAdministrator)
+    return list({role.tg_user for role in roles})
+
+
+class Command(BaseCommand):
+    help = "Compare the polymorphic and the BaseRole.level lookups of the staff members of every degree"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rounds", type=int, default=10, help="Number of lookups of every degree")
+
+    def measure(self, lookup, degrees: list[list[int]], rounds: int) -> tuple[float, int, set]:
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                results = [{user.id for user in lookup(degree_ids)} for degree_ids in degrees]
+            elapsed = time.perf_counter() - start
+        return elapsed, len(queries), results
+
+    def handle(self, *args, **options):
+        rounds = options["rounds"]
+        degrees = [[degree_id] for degree_id in Degree.objects.values_list("id", flat=True)] + [[]]
+
+        polymorphic = self.measure(polymorphic_staff_users, degrees, rounds)
+        flat = self.measure(get_staff_users, degrees, rounds)
+        lookups = len(degrees) * rounds
+        for name, (elapsed, queries, _) in (("polymorphic", polymorphic), ("level", flat)):
+            self.stdout.write(f"{name:>12}: {elapsed * 1000 / lookups:8.3f} ms/lookup, "
+                              f"{queries / lookups:6.1f} queries/lookup")
+
+        if polymorphic[2] != flat[2]:
+            self.stderr.write("The two lookups returned different users!")
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.9 on 2026-10-18 07:58
+
+from django.db import migrations, models
+
+
+LEVELS = {
+    "representative": 10,
+    "professor": 15,
+    "moderator": 20,
+    "administrator": 30,
+    "superadministrator": 40,
+}
+
+
+def fill_levels(apps, schema_editor):
+    BaseRole = apps.get_model("roles", "BaseRole")
+    for model, level in LEVELS.items():
+        BaseRole.objects.filter(polymorphic_ctype__app_label="roles", polymorphic_ctype__model=model)\
+            .update(level=level)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('roles', '0003_baserole_custom_title_override'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='baserole',
+            name='level',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Staff member'), (10, 'Representative'), (15, 'Professor'), (20, 'Moderator'), (30, 'Administrator'), (40, 'Super Administrator')], db_index=True, default=0, editable=False, verbose_name='Level'),
+        ),
+        migrations.RunPython(fill_levels, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,10 @@
+from django.apps import apps
 from django.db import models
+from django.db.models import Q
 from polymorphic.models import PolymorphicModel
 
-from telegrambot.handlers import utils
+from telegrambot import jobs
+from telegrambot.models import NetworkJob
 from telegrambot.logging import (
     EventTypes,
     MODERATION_INFO,
@@ -16,13 +19,27 @@ from telegrambot.logging import (
 )
 
 
+class RoleLevel(models.IntegerChoices):
+    """The rank of a role, stored on every BaseRole row to filter the staff without polymorphic queries"""
+    BASE = 0, "Staff member"
+    REPRESENTATIVE = 10, "Representative"
+    PROFESSOR = 15, "Professor"
+    MODERATOR = 20, "Moderator"
+    ADMINISTRATOR = 30, "Administrator"
+    SUPERADMINISTRATOR = 40, "Super Administrator"
+
+
 class BaseRole(PolymorphicModel):
     """Abstract class for all roles"""
     class Meta:
         verbose_name = "Staff member"
         verbose_name_plural = "Staff members"
 
+    LEVEL = RoleLevel.BASE
+
     tg_user = models.ForeignKey("telegrambot.User", on_delete=models.CASCADE)
+    level = models.PositiveSmallIntegerField("Level", choices=RoleLevel.choices, default=RoleLevel.BASE,
+                                             editable=False, db_index=True)
     django_user = models.ForeignKey("auth.User", on_delete=models.SET_NULL, null=True, blank=True)
 
     # Permissions scope
@@ -145,16 +162,15 @@ class BaseRole(PolymorphicModel):
         return f"{self.polymorphic_type()} {self.tg_user.name}"
 
     def save(self, *args, **kwargs):
+        self.level = self.LEVEL
         super().save(*args, **kwargs)
-        groups = self.tg_user.member_of.all()
-        for group in groups:
-            utils.set_admin_rights(self.tg_user, group, force=True)
+        # Update the admin rights in the groups in background, see telegrambot.jobs
+        jobs.enqueue(NetworkJob.Kinds.SET_ADMIN_RIGHTS, self.tg_user, self.tg_user.member_of.all())
 
     def delete(self, *args, **kwargs):
-        groups = self.tg_user.member_of.all()
+        groups = list(self.tg_user.member_of.all())
         super().delete(*args, **kwargs)
-        for group in groups:
-            utils.set_admin_rights(self.tg_user, group, force=True)
+        jobs.enqueue(NetworkJob.Kinds.SET_ADMIN_RIGHTS, self.tg_user, groups)
 
 
 class Representative(BaseRole):
@@ -162,6 +178,8 @@ class Representative(BaseRole):
         verbose_name = "Representative"
         verbose_name_plural = "Representatives"
 
+    LEVEL = RoleLevel.REPRESENTATIVE
+
     political_list = models.CharField("Political list", max_length=16)
     political_role = models.CharField("Political role", max_length=16)
 
@@ -187,6 +205,8 @@ class Professor(BaseRole):
         verbose_name = "Professor"
         verbose_name_plural = "Professors"
 
+    LEVEL = RoleLevel.PROFESSOR
+
     def permissions(self) -> list[EventTypes | None]:
         return super().permissions()
 
@@ -206,6 +226,8 @@ class Moderator(BaseRole):
         verbose_name = "Moderator"
         verbose_name_plural = "Moderators"
 
+    LEVEL = RoleLevel.MODERATOR
+
     def permissions(self) -> list[EventTypes | None]:
         return [
             *super().permissions(),
@@ -231,6 +253,8 @@ class Administrator(BaseRole):
         verbose_name = "Administrator"
         verbose_name_plural = "Administrators"
 
+    LEVEL = RoleLevel.ADMINISTRATOR
+
     def permissions(self) -> list[EventTypes | None]:
         return [
             *super().permissions(),
@@ -260,6 +284,8 @@ class SuperAdministrator(BaseRole):
         verbose_name = "Super Administrator"
         verbose_name_plural = "Super Administrators"
 
+    LEVEL = RoleLevel.SUPERADMINISTRATOR
+
     def permissions(self) -> list[EventTypes | None]:
         return [
             MODERATION_INFO if self.moderation_info is not False else None,
@@ -289,3 +315,19 @@ class SuperAdministrator(BaseRole):
         if super().custom_title():
             return super().custom_title()
         return "CdA Network"
+
+
+def get_staff_users(degree_ids: list[int], min_level: RoleLevel = RoleLevel.MODERATOR):
+    """Get the users with a role of at least min_level for some degrees, with a single query.
+
+    :param degree_ids: the IDs of the degrees; if empty, the staff of the groups without a degree
+    :param min_level: the minimum role level
+    :return: a QuerySet of the distinct telegrambot.User
+    """
+    TgUser = apps.get_model("telegrambot.User")
+    # The conditions on the roles must be in the same filter() to apply to the same role
+    if degree_ids:
+        scope = Q(baserole__degrees__in=degree_ids) | Q(baserole__all_groups=True)
+    else:
+        scope = Q(baserole__extra_groups=True)
+    return TgUser.objects.filter(scope, baserole__level__gte=min_level).distinct().order_by("id")
@@ -0,0 +1,15 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from roles.models import BaseRole, Representative, Professor, Moderator, Administrator, SuperAdministrator
+from telegrambot import cache
+
+
+def invalidate_permissions(**_) -> None:
+    cache.permissions.invalidate()
+
+
+# Roles are polymorphic: the signals are sent with the concrete role class as sender
+for role in (BaseRole, Representative, Professor, Moderator, Administrator, SuperAdministrator):
+    post_save.connect(invalidate_permissions, sender=role)
+    post_delete.connect(invalidate_permissions, sender=role)
+m2m_changed.connect(invalidate_permissions, sender=BaseRole.degrees.through)
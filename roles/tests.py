@@ -1,3 +1,31 @@
 from django.test import TestCase
 
-# Create your tests here.
+from roles.models import Moderator, Representative, SuperAdministrator, RoleLevel, get_staff_users
+from telegrambot.models import User as TgUser
+from university.models import Degree, Department
+
+
+class StaffUsersTestCase(TestCase):
+    def setUp(self):
+        department = Department.objects.create(name="Computer Science Department", slug="computer_science")
+        self.deg1 = Degree.objects.create(name="Computer Science", type='B', department=department)
+        self.deg2 = Degree.objects.create(name="Computer Science", type='M', department=department)
+
+        self.usr1 = TgUser.objects.create(id=26170256, first_name="Marco")
+        self.usr2 = TgUser.objects.create(id=244426552, first_name="Sette")
+        self.usr3 = TgUser.objects.create(id=108121631, first_name="Giulio")
+        Moderator.objects.create(tg_user=self.usr1).degrees.add(self.deg1)
+        Representative.objects.create(tg_user=self.usr2, political_list="List").degrees.add(self.deg1)
+        SuperAdministrator.objects.create(tg_user=self.usr3, all_groups=True)
+
+    def test_level(self):
+        self.assertEqual(Moderator.objects.get(tg_user=self.usr1).level, RoleLevel.MODERATOR)
+        self.assertEqual(SuperAdministrator.objects.get(tg_user=self.usr3).level, RoleLevel.SUPERADMINISTRATOR)
+
+    def test_staff_users(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(list(get_staff_users([self.deg1.id])), [self.usr1, self.usr3])
+        self.assertEqual(list(get_staff_users([self.deg2.id])), [self.usr3])
+        self.assertEqual(list(get_staff_users([self.deg1.id], RoleLevel.REPRESENTATIVE)),
+                         [self.usr1, self.usr3, self.usr2])
+        self.assertEqual(list(get_staff_users([])), [])
@@ -1,12 +1,15 @@
 from datetime import datetime
 
 import asyncio
-import telegram.error
 import telethon.errors
-import time
 from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
 from django.core.checks import messages
+from django.core.paginator import Paginator
+from django.forms.models import BaseInlineFormSet
+from django.db.models import Count, Q
 from sentry_sdk import capture_exception
 from telethon.sync import TelegramClient
 from telethon.tl.functions.channels import (
@@ -17,6 +20,8 @@ from telethon.tl.functions.channels import (
 from telethon.tl.types import ChatAdminRights
 from modeltranslation.admin import TranslationAdmin
 
+from telegrambot import logsearch
+
 from telegrambot.models import (
     User,
     Group,
@@ -27,6 +32,10 @@ from telegrambot.models import (
     BotWhitelist,
     TelegramLog,
     BlacklistedUser,
+    TelegramUpdate,
+    ScheduledDeletion,
+    NetworkJob,
+    NetworkJobGroup,
 )
 
 
@@ -36,14 +45,25 @@ class GroupMembershipInline(admin.TabularInline):
     autocomplete_fields = ("group", "user", )
 
 
+class LatestLogsFormSet(BaseInlineFormSet):
+    """Only the latest logs of a user: the full history is in the TelegramLog admin"""
+    max_rows = 50
+
+    def get_queryset(self):
+        if not hasattr(self, "_queryset"):
+            self._queryset = super().get_queryset()[:self.max_rows]
+        return self._queryset
+
+
 class UserLogInline(admin.TabularInline):
     model = TelegramLog
+    formset = LatestLogsFormSet
     fk_name = "target"
     extra = 0
     fields = ("iso_timestamp", "event", "chat", "issuer", )
     readonly_fields = ("iso_timestamp", )
     show_change_link = True
-    ordering = ("-timestamp", )
+    ordering = ("-timestamp", "-id", )
 
     def has_change_permission(self, request, obj=None):
         return False
@@ -141,13 +161,11 @@ class GroupAdmin(TranslationAdmin):
 
     @admin.action(description="Fetch and update Telegram data")
     def fetch_telegram_info_action(self, request, queryset):
-        stats = {False: 0, True: 0}
-        for group in queryset:
-            try:
-                stats[group.update_info()] += 1
-            except telegram.error.RetryAfter as e:
-                time.sleep(e.retry_after + 1)
-        self.message_user(request, f"{stats[True]} groups updated.\n{stats[False]} groups not updated.")
+        from telegrambot.tasks import fetch_groups_telegram_info
+
+        group_ids = list(queryset.exclude(bot=None).values_list("id", flat=True))
+        fetch_groups_telegram_info(group_ids)
+        self.message_user(request, f"The Telegram data of {len(group_ids)} groups will be updated in a few seconds.")
 
     def save_model(self, request, obj: Group, form, change):
         if obj.id == 0:
@@ -165,8 +183,9 @@ class GroupAdmin(TranslationAdmin):
                 capture_exception(e)
                 return
 
+        # Save the changes first: update_info only saves the Telegram info
+        super(GroupAdmin, self).save_model(request, obj, form, change)
         if not obj.update_info():
-            super(GroupAdmin, self).save_model(request, obj, form, change)
             self.message_user(
                 request, f"The group has been saved, but the bot was not able to retrieve any data from Telegram.\n"
                          f"Are you sure you inserted the correct chat id and selected the right bot?",
@@ -223,24 +242,50 @@ class BotWhitelistAdmin(admin.ModelAdmin):
     search_fields = ("username", "whitelisted_by")
 
 
+class LogChangeList(ChangeList):
+    """A change list paged by (timestamp, id) cursors instead of page numbers, see telegrambot.logsearch"""
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(logsearch.CURSOR_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        cursor = request.GET.get(logsearch.CURSOR_VAR)
+        try:
+            result_list, next_cursor = logsearch.page(self.queryset, cursor, self.list_per_page)
+        except ValueError:
+            raise IncorrectLookupParameters
+
+        self.result_count = len(result_list)
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = cursor is not None or next_cursor is not None
+        self.paginator = Paginator(result_list, self.list_per_page)
+        self.latest_page_url = self.get_query_string(remove=[logsearch.CURSOR_VAR]) if cursor else None
+        self.next_page_url = self.get_query_string({logsearch.CURSOR_VAR: next_cursor}) if next_cursor else None
+
+
 @admin.register(TelegramLog)
 class TelegramLogAdmin(admin.ModelAdmin):
     list_display = ("iso_timestamp", "event", "target", "chat", "issuer", )
-    search_fields = [
-        "issuer__id",
-        "issuer__username",
-        "issuer__first_name",
-        "issuer__last_name",
-        "target__id",
-        "target__username",
-        "target__first_name",
-        "target__last_name",
-        "chat__title",
-        "chat__id",
-    ]
-    list_filter = ("event", )
-    date_hierarchy = "timestamp"
-    ordering = ["-timestamp"]
+    list_select_related = ("target", "chat", "issuer", )
+    # Searched by logsearch.search, see get_search_results
+    search_fields = ["reason", "message", ]
+    # Bounded ranges of timestamp; a date_hierarchy would scan the whole table for the distinct dates
+    list_filter = ("event", ("timestamp", admin.DateFieldListFilter), )
+    ordering = ["-timestamp", "-id"]
+    # The pages are always ordered by (timestamp, id)
+    sortable_by = ()
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return LogChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        return logsearch.search(queryset, search_term), False
 
     def has_add_permission(self, request):
         return False
@@ -257,3 +302,84 @@ class BlacklistedUserAdmin(admin.ModelAdmin):
     list_display = ("user_id", "source")
     search_fields = ["user_id", ]
     list_filter = ("source", )
+
+
+@admin.register(TelegramUpdate)
+class TelegramUpdateAdmin(admin.ModelAdmin):
+    list_display = ("id", "bot", "chat_id", "received", )
+    list_filter = ("bot", )
+    search_fields = ["chat_id", ]
+    ordering = ["id"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ScheduledDeletion)
+class ScheduledDeletionAdmin(admin.ModelAdmin):
+    list_display = ("id", "chat_id", "message_id", "due_at", )
+    search_fields = ["chat_id", ]
+    ordering = ["due_at", "id"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class NetworkJobGroupInline(admin.TabularInline):
+    model = NetworkJobGroup
+    extra = 0
+    fields = ("group", "status", "attempts", "error", )
+    readonly_fields = fields
+    ordering = ("status", "group", )
+
+    def has_add_permission(self, request, obj):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(NetworkJob)
+class NetworkJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "kind", "target", "status", "progress", "created", "finished", )
+    list_filter = ("kind", "status", )
+    search_fields = ["target__id", "target__username", ]
+    fields = ("kind", "target", "status", "created", "started", "finished", )
+    readonly_fields = fields
+    inlines = (NetworkJobGroupInline, )
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related("target").annotate(
+            groups_count=Count("groups"),
+            processed_count=Count("groups", filter=~Q(groups__status=NetworkJobGroup.Statuses.PENDING)),
+            failed_count=Count("groups", filter=Q(groups__status=NetworkJobGroup.Statuses.FAILED)),
+        )
+
+    @admin.display(description="Progress")
+    def progress(self, obj: NetworkJob) -> str:
+        text = f"{obj.processed_count}/{obj.groups_count}"
+        if obj.failed_count:
+            text += f" ({obj.failed_count} failed)"
+        return text
+
+    @admin.action(description="Resume the pending groups")
+    def resume_jobs_action(self, request, queryset):
+        from telegrambot.tasks import run_network_job
+
+        for job in queryset:
+            run_network_job(job.id)
+        self.message_user(request, f"{queryset.count()} jobs scheduled.")
+
+    actions = [resume_jobs_action, ]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
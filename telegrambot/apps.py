@@ -1,7 +1,27 @@
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
+
+
+def _warm_up_dispatchers() -> None:
+    from django.db import connection
+    from telegrambot.handlers.dispatcher import warm_up
+
+    try:
+        warm_up()
+    finally:
+        connection.close()
 
 
 class TelegramConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'telegrambot'
     verbose_name = 'Telegram'
+
+    def ready(self):
+        from telegrambot import signals  # noqa: F401 (connect the signal receivers)
+
+        if settings.TELEGRAM_DISPATCHER_WARMUP:
+            # Build the dispatchers in background, without delaying the process start
+            threading.Thread(target=_warm_up_dispatchers, name="dispatchers-warm-up", daemon=True).start()
@@ -0,0 +1,92 @@
+"""Sync of the external blocklists with the BlacklistedUser table.
+
+The blocklist is parsed while it's downloaded, and only the difference with
+the rows of its source is written: the new IDs with a single bulk insert and
+the removed ones with a single delete. The known users which are blacklisted
+are then flagged as banned with a single UPDATE, and logged with one summary
+entry instead of one entry per user.
+"""
+import re
+from typing import Iterable, Iterator
+
+from django.db import transaction
+
+from telegrambot import cache, logging
+from telegrambot.models import (
+    User as DBUser,
+    BlacklistedUser,
+)
+
+
+# Rows inserted at once
+_BATCH_SIZE = 5000
+
+_RESULT_RE = re.compile(rb'"result"\s*:\s*\[')
+# An item of the result array, as a number or a string, and the following separator
+_ITEM_RE = re.compile(rb'\s*(?:"?(\d+)"?\s*)?([,\]])')
+
+
+def parse_ids(chunks: Iterable[bytes]) -> Iterator[int]:
+    """Parse the user IDs of a GroupHelp blocklist, {"ok": true, "result": [...]}, chunk by chunk.
+    Raise ValueError if the response ends before the result array does.
+
+    :param chunks: the body of the response, e.g. Response.iter_content()
+    """
+    buffer = b""
+    started = False
+    for chunk in chunks:
+        buffer += chunk
+        if not started:
+            match = _RESULT_RE.search(buffer)
+            if match is None:
+                # Keep enough bytes to match the key if it's split between two chunks
+                buffer = buffer[-32:]
+                continue
+            started = True
+            buffer = buffer[match.end():]
+
+        pos = 0
+        while match := _ITEM_RE.match(buffer, pos):
+            pos = match.end()
+            if match[1] is not None:
+                yield int(match[1])
+            if match[2] == b"]":
+                return
+        buffer = buffer[pos:]
+
+    raise ValueError("The blocklist is truncated")
+
+
+def sync(user_ids: set[int], source: BlacklistedUser.BlacklistSource) -> dict[str, int]:
+    """Make the rows of a source match a blocklist.
+    The users which are already blacklisted by another source are left alone.
+
+    :param user_ids: the IDs of the blocklist
+    :param source: the source of the blocklist
+    :return: how many rows were added and removed, and how many known users were flagged as banned
+    """
+    existing = set(BlacklistedUser.objects.filter(source=source).values_list("user_id", flat=True))
+    added = user_ids - existing
+    removed = existing - user_ids
+
+    with transaction.atomic():
+        BlacklistedUser.objects.bulk_create(
+            [BlacklistedUser(user_id=user_id, source=source) for user_id in sorted(added)],
+            batch_size=_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        if removed:
+            BlacklistedUser.objects.filter(source=source, user_id__in=removed).delete()
+        flagged = DBUser.objects\
+            .filter(banned=False, id__in=BlacklistedUser.objects.filter(source=source).values("user_id"))\
+            .update(banned=True)
+
+    # The bulk statements don't send the signals which keep the cache up to date
+    cache.bans.refresh()
+    if flagged:
+        logging.log(
+            event=logging.MODERATION_SUPERBAN,
+            chat=None,
+            reason=f"{flagged} known users are blacklisted (source: {source.label})",
+        )
+    return {"added": len(added), "removed": len(removed), "flagged": flagged}
@@ -0,0 +1,217 @@
+"""Bulk upserts of Telegram users and group memberships, and a write-behind buffer built on them.
+
+Saving who wrote a message, where and when is the most frequent write of the bot.
+With settings.TELEGRAM_WRITE_BEHIND enabled, the messages of users already
+known to the process are only recorded in memory and flushed every few seconds
+(or every few hundred updates) with a single INSERT ... ON CONFLICT DO UPDATE
+per table, with the message counters added up in SQL.
+"""
+import atexit
+import logging as logg
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection, transaction, close_old_connections
+from telegram import User
+
+from telegrambot.models import (
+    User as DBUser,
+    GroupMembership as DBGroupMembership,
+)
+
+
+LOG = logg.getLogger(__name__)
+
+# Maximum number of rows inserted by a single statement
+_CHUNK_SIZE = 1000
+
+
+def user_row(user: User, last_seen: datetime) -> tuple:
+    """Convert a Telegram user to a row for upsert_users"""
+    return (
+        user.id,
+        user.first_name,
+        user.last_name,
+        user.username,
+        user.language_code[:3] if user.language_code else None,
+        last_seen,
+    )
+
+
+def _chunks(rows: list, size: int = _CHUNK_SIZE):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def _upsert_users_sql(count: int) -> str:
+    table = DBUser._meta.db_table
+    return (
+        f"INSERT INTO {table} "
+        f"(id, first_name, last_name, username, language, last_seen, "
+        f"reputation, warn_count, banned, permissions_level) "
+        f"VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, 0, 0, false, 0)'] * count)} "
+        f"ON CONFLICT (id) DO UPDATE SET "
+        f"first_name = EXCLUDED.first_name, "
+        f"last_name = EXCLUDED.last_name, "
+        f"username = EXCLUDED.username, "
+        f"language = EXCLUDED.language, "
+        f"last_seen = GREATEST({table}.last_seen, EXCLUDED.last_seen)"
+    )
+
+
+def upsert_users(rows: list[tuple]) -> None:
+    """Insert or update Telegram users in a single statement per chunk.
+
+    :param rows: (id, first_name, last_name, username, language, last_seen) tuples, see user_row
+    """
+    for chunk in _chunks(rows):
+        with connection.cursor() as cursor:
+            cursor.execute(_upsert_users_sql(len(chunk)), [value for row in chunk for value in row])
+
+
+def upsert_user(user: User, last_seen: datetime = None) -> DBUser:
+    """Insert or update a Telegram user with a single statement.
+
+    :param user: the Telegram user to save
+    :param last_seen: when the user was last seen (default: now)
+    :return: the saved telegrambot.User, as returned by the database
+    """
+    row = user_row(user, last_seen or datetime.now())
+    return list(DBUser.objects.raw(f"{_upsert_users_sql(1)} RETURNING *", row))[0]
+
+
+def upsert_memberships(rows: list[tuple]) -> None:
+    """Insert or update group memberships in a single statement per chunk,
+    adding the new messages to messages_count.
+
+    :param rows: (user_id, group_id, last_seen, new messages count) tuples
+    """
+    table = DBGroupMembership._meta.db_table
+    for chunk in _chunks(rows):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (user_id, group_id, last_seen, messages_count, status) "
+                f"VALUES {', '.join(['(%s, %s, %s, %s, %s)'] * len(chunk))} "
+                f"ON CONFLICT (user_id, group_id) DO UPDATE SET "
+                f"last_seen = GREATEST({table}.last_seen, EXCLUDED.last_seen), "
+                f"messages_count = {table}.messages_count + EXCLUDED.messages_count",
+                [
+                    value
+                    for row in chunk
+                    for value in (*row, DBGroupMembership.MembershipStatus.MEMBER)
+                ],
+            )
+
+
+def upsert_membership_statuses(group_id: int, statuses: dict[int, str]) -> None:
+    """Insert or update the status of many members of a group in a single statement.
+
+    :param group_id: the Telegram group ID
+    :param statuses: the GroupMembership.MembershipStatus of every user ID
+    """
+    if not statuses:
+        return
+
+    table = DBGroupMembership._meta.db_table
+    now = datetime.now()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (user_id, group_id, last_seen, messages_count, status) "
+            f"VALUES {', '.join(['(%s, %s, %s, 0, %s)'] * len(statuses))} "
+            f"ON CONFLICT (user_id, group_id) DO UPDATE SET status = EXCLUDED.status",
+            [value for user_id in sorted(statuses) for value in (user_id, group_id, now, statuses[user_id])],
+        )
+
+
+class WriteBehindBuffer:
+    """Collect users and memberships changes in memory and save them in bulk.
+
+    Only the (user, group) pairs which were already saved to the database by this
+    process should be buffered, so that the rows the handlers read always exist:
+    see knows() and remember().
+    """
+    # Forget the known pairs when there are too many of them; they'll be saved again
+    MAX_KNOWN = 200_000
+
+    def __init__(self, flush_interval: float, flush_size: int):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+
+        self._users: dict[int, tuple] = {}
+        self._memberships: dict[tuple[int, int], list] = {}
+        self._pending = 0
+        self._known: set[tuple[int, int]] = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer: threading.Thread | None = None
+
+    def knows(self, user_id: int, group_id: int) -> bool:
+        """Return True if the membership was already saved to the database by this process"""
+        return (user_id, group_id) in self._known
+
+    def remember(self, user_id: int, group_id: int) -> None:
+        """Mark a membership as saved to the database"""
+        if len(self._known) >= self.MAX_KNOWN:
+            self._known.clear()
+        self._known.add((user_id, group_id))
+
+    def record(self, user: User, group_id: int, count_message: bool = False) -> None:
+        """Record that a user has been seen in a group"""
+        now = datetime.now()
+        with self._lock:
+            self._users[user.id] = user_row(user, now)
+            membership = self._memberships.setdefault((user.id, group_id), [now, 0])
+            membership[0] = now
+            membership[1] += 1 if count_message else 0
+            self._pending += 1
+            full = self._pending >= self.flush_size
+
+        self._start_timer()
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        """Save all the buffered changes"""
+        with self._flush_lock:
+            with self._lock:
+                users, self._users = self._users, {}
+                memberships, self._memberships = self._memberships, {}
+                self._pending = 0
+            if not users and not memberships:
+                return
+
+            try:
+                # Sorted rows always lock in the same order, so concurrent flushes can't deadlock
+                with transaction.atomic():
+                    upsert_users([users[user_id] for user_id in sorted(users)])
+                    upsert_memberships([
+                        (user_id, group_id, *memberships[(user_id, group_id)])
+                        for user_id, group_id in sorted(memberships)
+                    ])
+            except Exception as e:
+                LOG.exception("Can't flush %d users and %d memberships: %s", len(users), len(memberships), e)
+
+    def _start_timer(self) -> None:
+        if self._timer is not None:
+            return
+
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Thread(target=self._run_timer, name="write-behind-flush", daemon=True)
+            self._timer.start()
+
+    def _run_timer(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+            close_old_connections()
+
+
+buffer = WriteBehindBuffer(
+    flush_interval=settings.TELEGRAM_WRITE_BEHIND_INTERVAL,
+    flush_size=settings.TELEGRAM_WRITE_BEHIND_SIZE,
+)
+atexit.register(buffer.flush)
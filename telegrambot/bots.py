@@ -0,0 +1,158 @@
+"""Process-level registry of the authorized Telegram bots.
+
+The registry is loaded from the database the first time it's needed and it's
+invalidated by the TelegramBot save/delete signals (see telegrambot.signals),
+so that authorizing a webhook request never needs a database round trip.
+
+The module also holds one long-lived telegram.Bot per token: all of them share
+a single pool of keep-alive HTTPS connections to the Bot API, whose size is
+settings.TELEGRAM_CONNECTION_POOL_SIZE.
+"""
+import hashlib
+import hmac
+import threading
+import time
+
+import telegram
+from django.conf import settings
+from telegram.utils.request import Request
+
+from telegrambot.models import TelegramBot
+
+
+_lock = threading.Lock()
+_tokens: dict[str, int] | None = None   # token -> TelegramBot.id
+_secrets: dict[str, str] | None = None  # webhook secret -> token
+_ids: dict[int, str] | None = None      # TelegramBot.id -> token
+
+
+def webhook_secret(token: str) -> str:
+    """Derive the secret Telegram must send in the X-Telegram-Bot-Api-Secret-Token header.
+
+    :param token: the bot token
+    :return: a secret which is valid for the setWebhook secret_token parameter
+    """
+    return hmac.new(settings.SECRET_KEY.encode(), token.encode(), hashlib.sha256).hexdigest()
+
+
+def load() -> tuple[dict[str, int], dict[str, str], dict[int, str]]:
+    """(Re)load the registry from the database"""
+    global _tokens, _secrets, _ids
+
+    tokens = dict(TelegramBot.objects.values_list("token", "id"))
+    secrets = {webhook_secret(token): token for token in tokens}
+    ids = {id_: token for token, id_ in tokens.items()}
+    with _lock:
+        _tokens, _secrets, _ids = tokens, secrets, ids
+    return tokens, secrets, ids
+
+
+def invalidate() -> None:
+    """Drop the registry; it will be loaded again on the next access"""
+    global _tokens, _secrets, _ids
+
+    with _lock:
+        _tokens = None
+        _secrets = None
+        _ids = None
+
+
+def _registry() -> tuple[dict[str, int], dict[str, str], dict[int, str]]:
+    tokens, secrets, ids = _tokens, _secrets, _ids
+    if tokens is None or secrets is None or ids is None:
+        return load()
+    return tokens, secrets, ids
+
+
+def is_authorized(token: str) -> bool:
+    """Return True if the token belongs to an authorized bot"""
+    return token in _registry()[0]
+
+
+def get_bot_id(token: str) -> int | None:
+    """Return the TelegramBot.id of an authorized bot, or None"""
+    return _registry()[0].get(token)
+
+
+def get_token(bot_id: int) -> str | None:
+    """Return the token of an authorized bot given its TelegramBot.id, or None"""
+    return _registry()[2].get(bot_id)
+
+
+def get_token_by_secret(secret: str) -> str | None:
+    """Return the token of the bot the webhook secret belongs to, or None"""
+    return _registry()[1].get(secret)
+
+
+def all_tokens() -> list[str]:
+    """Return the tokens of all the authorized bots"""
+    return list(_registry()[0])
+
+
+class MeteredRequest(Request):
+    """A telegram Request which measures the latency of the calls to the Bot API"""
+    __slots__ = ("requests", "total_latency", "_stats_lock")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = 0
+        self.total_latency = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _request_wrapper(self, *args, **kwargs) -> bytes:
+        started = time.perf_counter()
+        try:
+            return super()._request_wrapper(*args, **kwargs)
+        finally:
+            latency = time.perf_counter() - started
+            with self._stats_lock:
+                self.requests += 1
+                self.total_latency += latency
+
+    def stats(self) -> dict[str, float]:
+        """Return the requests made, the connections opened, how many requests reused
+        a pooled connection and the average latency in milliseconds
+        """
+        pools = self._con_pool.pools
+        connection_pools = [pools[key] for key in pools.keys()]
+        connections = sum(pool.num_connections for pool in connection_pools)
+        requests = sum(pool.num_requests for pool in connection_pools)
+        return {
+            "requests": self.requests,
+            "new_connections": connections,
+            "pool_hits": max(0, requests - connections),
+            "avg_latency_ms": self.total_latency * 1000 / self.requests if self.requests else 0.0,
+        }
+
+
+_request: MeteredRequest | None = None
+_bots: dict[str, telegram.Bot] = {}
+_bots_lock = threading.Lock()
+
+
+def shared_request() -> MeteredRequest:
+    """Return the HTTP connection pool shared by all the bots"""
+    global _request
+
+    if _request is None:
+        with _bots_lock:
+            if _request is None:
+                _request = MeteredRequest(con_pool_size=settings.TELEGRAM_CONNECTION_POOL_SIZE)
+    return _request
+
+
+def get_bot(token: str) -> telegram.Bot:
+    """Return the long-lived telegram.Bot of a token, creating it the first time"""
+    if (bot := _bots.get(token)) is not None:
+        return bot
+
+    request = shared_request()
+    with _bots_lock:
+        if token not in _bots:
+            _bots[token] = telegram.Bot(token, request=request)
+        return _bots[token]
+
+
+def request_stats() -> dict[str, float]:
+    """Return the statistics of the HTTP connection pool, see MeteredRequest.stats"""
+    return shared_request().stats()
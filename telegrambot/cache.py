@@ -0,0 +1,301 @@
+"""Per-process caches of the data read while processing every update.
+
+Entries expire after settings.TELEGRAM_CACHE_TTL seconds and they're invalidated
+by the model signals (see telegrambot.signals). Signals only reach the process
+which changed the data, so the TTL bounds how stale the other processes can be;
+the bans are also refreshed incrementally every few seconds, see BanCache.
+"""
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, List
+
+from django.apps import apps
+from django.conf import settings
+from django.db.models import Max
+
+from telegrambot.models import (
+    Group as DBGroup,
+    User as DBUser,
+    BlacklistedUser,
+    format_welcome_message,
+)
+
+
+@dataclass(frozen=True)
+class CachedGroup:
+    """A read-only snapshot of the Group fields needed to process updates"""
+    id: int
+    title: str
+    language: str | None
+    bot_id: int | None
+    ignore_admin_tagging: bool
+    invite_link: str | None
+    welcome_model: str | None
+
+    def generate_welcome_message(self, members: List) -> str:
+        return format_welcome_message(self.welcome_model, self.title, members)
+
+
+class GroupCache:
+    """Cache of the groups metadata, including the groups which are not in the database"""
+    FIELDS = ("id", "title", "language", "bot_id", "ignore_admin_tagging", "invite_link", "welcome_model")
+
+    def __init__(self, ttl: float, missing_ttl: float):
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self._groups: dict[int, tuple[float, CachedGroup | None]] = {}
+
+    def get(self, group_id: int) -> CachedGroup | None:
+        """Get a group, or None if the group is not in the database"""
+        entry = self._groups.get(group_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        values = DBGroup.objects.filter(id=group_id).values(*self.FIELDS).first()
+        group = CachedGroup(**values) if values else None
+        self._groups[group_id] = (time.monotonic() + (self.ttl if group else self.missing_ttl), group)
+        return group
+
+    def update_title(self, group_id: int, title: str) -> None:
+        """Save the title of a group, only if it's different from the cached one"""
+        group = self.get(group_id)
+        if group is None or group.title == title:
+            return
+
+        DBGroup.objects.filter(id=group_id).update(title=title)
+        self.invalidate(group_id)
+
+    def invalidate(self, group_id: int = None) -> None:
+        """Drop a group from the cache, or all of them"""
+        if group_id is None:
+            self._groups.clear()
+        else:
+            self._groups.pop(group_id, None)
+
+
+class UserIdSet:
+    """A compact set of Telegram user IDs: a sorted array of 64 bit integers searched with bisect.
+    Single additions and removals are kept aside in small sets and merged into the array in bulk.
+    """
+    MERGE_THRESHOLD = 4096
+
+    def __init__(self, user_ids: Iterable[int] = ()):
+        self._ids = array("Q", sorted(set(user_ids)))
+        self._added: set[int] = set()
+        self._removed: set[int] = set()
+
+    def _in_array(self, user_id: int) -> bool:
+        i = bisect_left(self._ids, user_id)
+        return i < len(self._ids) and self._ids[i] == user_id
+
+    def __contains__(self, user_id: int) -> bool:
+        if user_id in self._added:
+            return True
+        return user_id not in self._removed and self._in_array(user_id)
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._added) - len(self._removed)
+
+    def add(self, user_id: int) -> None:
+        self._removed.discard(user_id)
+        if not self._in_array(user_id):
+            self._added.add(user_id)
+            self._merge_if_needed()
+
+    def discard(self, user_id: int) -> None:
+        self._added.discard(user_id)
+        if self._in_array(user_id):
+            self._removed.add(user_id)
+            self._merge_if_needed()
+
+    def _merge_if_needed(self) -> None:
+        if len(self._added) + len(self._removed) < self.MERGE_THRESHOLD:
+            return
+        removed = self._removed
+        self._ids = array("Q", sorted([i for i in self._ids if i not in removed] + list(self._added)))
+        self._added, self._removed = set(), set()
+
+
+class BanCache:
+    """The IDs of the blacklisted and of the globally banned users.
+
+    The sets are reloaded from the database when they expire. In between, every
+    refresh_interval seconds, only the changes made by any process since the
+    last check are read: the users whose banned_changed_at is newer, and the
+    blacklist entries created since then. Deleted blacklist entries leave no
+    trace, so the blacklist set is loaded again whenever its size doesn't match
+    the number of entries in the database. The signals of the current process
+    update the sets in place.
+
+    A single thread queries the database at a time: the others keep using the
+    current sets, unless nothing was loaded yet.
+    """
+    # Changes are read again for this long, in case they were committed after newer ones
+    REFRESH_OVERLAP = timedelta(seconds=60)
+
+    def __init__(self, ttl: float, refresh_interval: float):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._blacklisted = UserIdSet()
+        self._banned = UserIdSet()
+        self._expires = 0.0
+        self._refreshed = 0.0
+        # The latest banned_changed_at and BlacklistedUser.created read from the database
+        self._banned_mark: datetime | None = None
+        self._blacklisted_mark: datetime | None = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def reload(self) -> None:
+        """Load the sets from the database"""
+        with self._refresh_lock:
+            self._reload()
+
+    def refresh(self) -> None:
+        """Apply the changes made since the last check right away, instead of waiting for refresh_interval"""
+        with self._refresh_lock:
+            if self._expires == 0.0:
+                self._reload()
+            else:
+                self._refresh()
+
+    def _reload(self) -> None:
+        banned_mark = DBUser.objects.aggregate(mark=Max("banned_changed_at"))["mark"]
+        blacklisted_mark = BlacklistedUser.objects.aggregate(mark=Max("created"))["mark"]
+        blacklisted = UserIdSet(BlacklistedUser.objects.values_list("user_id", flat=True).iterator())
+        banned = UserIdSet(DBUser.objects.filter(banned=True).values_list("id", flat=True).iterator())
+        with self._lock:
+            self._blacklisted, self._banned = blacklisted, banned
+            self._banned_mark, self._blacklisted_mark = banned_mark, blacklisted_mark
+            self._expires = time.monotonic() + self.ttl
+            self._refreshed = time.monotonic()
+
+    def _refresh(self) -> None:
+        """Apply the bans and blacklist entries changed since the last check, by any process"""
+        users = DBUser.objects.filter(banned_changed_at__isnull=False)
+        if self._banned_mark is not None:
+            users = users.filter(banned_changed_at__gte=self._banned_mark - self.REFRESH_OVERLAP)
+        entries = BlacklistedUser.objects.all()
+        if self._blacklisted_mark is not None:
+            entries = entries.filter(created__gte=self._blacklisted_mark - self.REFRESH_OVERLAP)
+
+        users = list(users.values_list("id", "banned", "banned_changed_at"))
+        entries = list(entries.values_list("user_id", "created"))
+        count = BlacklistedUser.objects.count()
+        with self._lock:
+            for user_id, banned, changed_at in users:
+                if banned:
+                    self._banned.add(user_id)
+                else:
+                    self._banned.discard(user_id)
+                self._banned_mark = max(self._banned_mark or changed_at, changed_at)
+            for user_id, created in entries:
+                self._blacklisted.add(user_id)
+                self._blacklisted_mark = max(self._blacklisted_mark or created, created)
+            self._refreshed = time.monotonic()
+            if len(self._blacklisted) == count:
+                return
+
+        # Some entries were deleted
+        blacklisted = UserIdSet(BlacklistedUser.objects.values_list("user_id", flat=True).iterator())
+        with self._lock:
+            self._blacklisted = blacklisted
+
+    def _ensure_loaded(self) -> None:
+        now = time.monotonic()
+        if self._expires > now and self._refreshed + self.refresh_interval > now:
+            return
+        if not self._refresh_lock.acquire(blocking=self._expires == 0.0):
+            # Another thread is already querying the database
+            return
+        try:
+            now = time.monotonic()
+            if self._expires <= now:
+                self._reload()
+            elif self._refreshed + self.refresh_interval <= now:
+                self._refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def is_blacklisted(self, user_id: int) -> bool:
+        self._ensure_loaded()
+        return user_id in self._blacklisted
+
+    def is_banned(self, user_id: int) -> bool:
+        """Return True if the user is globally banned from the network"""
+        self._ensure_loaded()
+        return user_id in self._banned
+
+    def set_blacklisted(self, user_id: int, blacklisted: bool = True) -> None:
+        with self._lock:
+            if blacklisted:
+                self._blacklisted.add(user_id)
+            else:
+                self._blacklisted.discard(user_id)
+
+    def set_banned(self, user_id: int, banned: bool = True) -> None:
+        with self._lock:
+            if banned:
+                self._banned.add(user_id)
+            else:
+                self._banned.discard(user_id)
+
+
+class PermissionCache:
+    """The permissions of the staff members, resolved per (user, chat).
+
+    Only the users with at least one role are looked up: everybody else gets
+    the empty permissions without touching the roles tables. Everything is
+    dropped when a role, the degrees of a role or the degrees of a group change.
+    """
+    NO_PERMISSIONS = ((), {}, None)
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._staff: UserIdSet | None = None
+        self._entries: dict[tuple[int, int], tuple] = {}
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def _staff_ids(self) -> UserIdSet:
+        staff = self._staff
+        if staff is not None and self._expires > time.monotonic():
+            return staff
+
+        BaseRole = apps.get_model("roles.BaseRole")
+        staff = UserIdSet(BaseRole.objects.values_list("tg_user_id", flat=True).iterator())
+        with self._lock:
+            self._staff, self._entries = staff, {}
+            self._expires = time.monotonic() + self.ttl
+        return staff
+
+    def get(self, user_id: int, chat_id: int, resolve: Callable[[int, int], tuple]) -> tuple:
+        """Get the permissions of a user in a chat.
+
+        :param user_id: the Telegram user ID
+        :param chat_id: the Telegram chat ID
+        :param resolve: the function computing the permissions when they're not cached
+        :return: (moderation permissions, Telegram permissions, custom title)
+        """
+        if user_id not in self._staff_ids():
+            permissions = self.NO_PERMISSIONS
+        elif (permissions := self._entries.get((user_id, chat_id))) is None:
+            permissions = resolve(user_id, chat_id)
+            self._entries[(user_id, chat_id)] = permissions
+
+        # The callers are free to change what they get
+        moderation, telegram, custom_title = permissions
+        return list(moderation), dict(telegram), custom_title
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._staff, self._entries = None, {}
+
+
+groups = GroupCache(ttl=settings.TELEGRAM_CACHE_TTL, missing_ttl=60)
+bans = BanCache(ttl=settings.TELEGRAM_CACHE_TTL, refresh_interval=settings.TELEGRAM_BAN_REFRESH_INTERVAL)
+permissions = PermissionCache(ttl=settings.TELEGRAM_CACHE_TTL)
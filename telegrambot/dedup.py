@@ -0,0 +1,114 @@
+"""Deduplication of the updates received from Telegram.
+
+Telegram delivers an update again when the webhook doesn't answer fast enough,
+so the same update_id can reach the dispatcher more than once. Every bot keeps
+a bounded window of the update IDs it has recently seen; repeated updates are
+dropped before being deserialized.
+
+The window can optionally be backed by a high-water mark saved on the
+TelegramBot row (settings.TELEGRAM_UPDATE_DEDUP_PERSIST), so that retries
+received right after a restart are recognized too.
+"""
+import logging as logg
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from telegrambot.models import TelegramBot
+
+
+LOG = logg.getLogger(__name__)
+
+# Save the high-water mark once every this many updates leaving the window
+_PERSIST_EVERY = 100
+
+
+class UpdateDeduplicator:
+    """A bounded window of the update IDs recently seen by a bot"""
+    def __init__(self, token: str, size: int, persist: bool = False):
+        self.token = token
+        self.size = size
+        self.persist = persist
+        self.duplicates = 0
+
+        self._ring: deque[int] = deque()
+        self._seen: set[int] = set()
+        self._evicted = 0
+        self._lock = threading.Lock()
+
+        # Every update_id <= high_water_mark has already been seen. The mark is only trusted
+        # within the window size: after a week without updates Telegram picks a random update_id.
+        self.high_water_mark: int | None = None
+        if persist:
+            self.high_water_mark = TelegramBot.objects.filter(token=token)\
+                .values_list("last_update_id", flat=True).first()
+
+    def _below_high_water_mark(self, update_id: int) -> bool:
+        return self.high_water_mark is not None and \
+            self.high_water_mark - self.size < update_id <= self.high_water_mark
+
+    def is_duplicate(self, update_id: int) -> bool:
+        """Return True if the update was already seen, otherwise remember it and return False"""
+        with self._lock:
+            if update_id in self._seen or self._below_high_water_mark(update_id):
+                self.duplicates += 1
+                return True
+
+            self._seen.add(update_id)
+            self._ring.append(update_id)
+            if len(self._ring) <= self.size:
+                return False
+
+            evicted = self._ring.popleft()
+            self._seen.discard(evicted)
+            self.high_water_mark = max(self.high_water_mark or evicted, evicted)
+            self._evicted += 1
+            save = self.persist and self._evicted % _PERSIST_EVERY == 0
+            high_water_mark = self.high_water_mark
+
+        if save:
+            TelegramBot.objects.filter(token=self.token).update(
+                last_update_id=Greatest(F("last_update_id"), Value(high_water_mark)),
+            )
+        return False
+
+
+_deduplicators: dict[str, UpdateDeduplicator] = {}
+_deduplicators_lock = threading.Lock()
+
+
+def get_deduplicator(token: str) -> UpdateDeduplicator:
+    """Get the deduplication window of a bot"""
+    if (deduplicator := _deduplicators.get(token)) is not None:
+        return deduplicator
+
+    with _deduplicators_lock:
+        if token not in _deduplicators:
+            _deduplicators[token] = UpdateDeduplicator(
+                token,
+                size=settings.TELEGRAM_UPDATE_DEDUP_WINDOW,
+                persist=settings.TELEGRAM_UPDATE_DEDUP_PERSIST,
+            )
+        return _deduplicators[token]
+
+
+def is_duplicate(json_update: dict, token: str) -> bool:
+    """Return True if the update was already received by the bot and must be dropped"""
+    update_id = json_update.get("update_id")
+    if update_id is None:
+        return False
+
+    deduplicator = get_deduplicator(token)
+    if not deduplicator.is_duplicate(update_id):
+        return False
+
+    LOG.info("Dropped duplicated update %d (%d duplicates so far)", update_id, deduplicator.duplicates)
+    return True
+
+
+def duplicates_dropped() -> int:
+    """Return the number of duplicated updates dropped by this process"""
+    return sum(deduplicator.duplicates for deduplicator in list(_deduplicators.values()))
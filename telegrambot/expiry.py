@@ -0,0 +1,214 @@
+"""Expiry of the messages sent by the bots: welcome messages, moderation notices, service messages...
+
+Handlers only insert a (chat_id, message_id, due_at) row in the ScheduledDeletion
+table. The `process_deletions` management command runs a DeletionScheduler,
+which keeps the rows due soon in a heap, and when they expire deletes the
+messages of every chat with bulk deleteMessages calls of up to 100 IDs,
+submitted to telegrambot.outbound with the DELETION priority. The scheduler
+never waits for the calls: their outcome is applied to the table by the next
+iteration, so a rate-limited chat never holds back the others.
+"""
+import heapq
+import logging as logg
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from functools import partial
+
+import telegram
+from django.db import close_old_connections
+from django.db.models import Min
+from telegram import Message
+
+from telegrambot import bots, cache, outbound
+from telegrambot.outbound import Priority
+from telegrambot.models import ScheduledDeletion
+
+
+LOG = logg.getLogger(__name__)
+
+# Seconds after which the messages are deleted, unless specified otherwise
+DEFAULT_DELAY = 90
+# Maximum number of message IDs of a deleteMessages call
+MAX_BATCH = 100
+# Seconds after which the deletions which failed for a transient error are tried again
+RETRY_DELAY = 30
+
+
+def schedule(chat_id: int, message_id: int, delay: float = DEFAULT_DELAY) -> None:
+    """Delete a message after delay seconds"""
+    ScheduledDeletion.objects.create(
+        chat_id=chat_id,
+        message_id=message_id,
+        due_at=datetime.now() + timedelta(seconds=delay),
+    )
+
+
+def delete_sent_message(future: Future) -> None:
+    """Schedule the deletion of a message submitted to telegrambot.outbound, once it's been sent.
+    Meant to be used as a done callback of the Future.
+    """
+    if future.exception() is not None:
+        return
+    message: Message = future.result()
+    close_old_connections()
+    schedule(message.chat_id, message.message_id)
+
+
+def lag() -> float:
+    """Return how many seconds the oldest expired message has been waiting to be deleted"""
+    oldest = ScheduledDeletion.objects.filter(due_at__lte=datetime.now()).aggregate(oldest=Min("due_at"))["oldest"]
+    return (datetime.now() - oldest).total_seconds() if oldest else 0.0
+
+
+def delete_messages(bot: telegram.Bot, chat_id: int, message_ids: list[int]) -> bool:
+    """Delete up to 100 messages of a chat with a single call.
+    The messages which can't be found or deleted are skipped by Telegram.
+
+    python-telegram-bot 13.8 predates deleteMessages (Bot API 7.0) and has no method for it:
+    the request is made with the bot's Request object, like the Bot methods do.
+    """
+    return bot.request.post(f"{bot.base_url}/deleteMessages", {"chat_id": chat_id, "message_ids": message_ids})
+
+
+class DeletionScheduler:
+    """Load the deletions due within the next poll_interval seconds in a heap,
+    and carry out the expired ones in bulk.
+    """
+    def __init__(self, poll_interval: float = 1.0, batch_size: int = 5000):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+
+        self._heap: list[tuple[datetime, int, int, int]] = []  # (due_at, id, chat_id, message_id)
+        self._loaded: set[int] = set()
+        self._in_flight: set[int] = set()  # the rows whose call has been submitted and not applied yet
+        self._results: queue.SimpleQueue = queue.SimpleQueue()  # (row IDs, error or None) of the finished calls
+        self._stop = threading.Event()
+        self.deleted = 0
+        self.calls = 0
+        self.max_lag = 0.0
+
+    def load(self) -> int:
+        """Load the deletions due before the next poll; return how many were added to the heap"""
+        horizon = datetime.now() + timedelta(seconds=self.poll_interval)
+        rows = ScheduledDeletion.objects.filter(due_at__lte=horizon)\
+            .order_by("due_at")\
+            .values_list("due_at", "id", "chat_id", "message_id")[:self.batch_size]
+        added = 0
+        for row in rows:
+            if row[1] not in self._loaded and row[1] not in self._in_flight:
+                heapq.heappush(self._heap, row)
+                self._loaded.add(row[1])
+                added += 1
+        return added
+
+    def pop_expired(self) -> dict[int, list[tuple[int, int]]]:
+        """Take the expired deletions out of the heap, grouped by chat: {chat_id: [(id, message_id), ...]}"""
+        now = datetime.now()
+        chats = defaultdict(list)
+        while self._heap and self._heap[0][0] <= now:
+            due_at, id_, chat_id, message_id = heapq.heappop(self._heap)
+            self._loaded.discard(id_)
+            self.max_lag = max(self.max_lag, (now - due_at).total_seconds())
+            chats[chat_id].append((id_, message_id))
+        return chats
+
+    def run_once(self) -> int:
+        """Submit the expired deletions; return the number of rows submitted or dropped.
+        The rows of the chats no bot can act in are dropped immediately, the others when
+        their outcome is applied, see apply_results.
+        """
+        chats = self.pop_expired()
+        dropped = []
+        submitted = 0
+        for chat_id, deletions in chats.items():
+            group = cache.groups.get(chat_id)
+            token = bots.get_token(group.bot_id) if group is not None else None
+            if token is None:
+                LOG.info("No bot can delete %d messages in chat %d", len(deletions), chat_id)
+                dropped.extend(id_ for id_, _ in deletions)
+                continue
+
+            bot = bots.get_bot(token)
+            for i in range(0, len(deletions), MAX_BATCH):
+                batch = deletions[i:i + MAX_BATCH]
+                ids = [id_ for id_, _ in batch]
+                message_ids = [message_id for _, message_id in batch]
+                self._in_flight.update(ids)
+                outbound.scheduler.submit_call(
+                    bot, partial(delete_messages, bot, chat_id, message_ids), chat_id, Priority.DELETION,
+                ).add_done_callback(partial(self._finished, ids))
+                self.calls += 1
+                submitted += len(ids)
+
+        if dropped:
+            ScheduledDeletion.objects.filter(id__in=dropped).delete()
+            self.deleted += len(dropped)
+        return submitted + len(dropped)
+
+    def _finished(self, ids: list[int], future: Future) -> None:
+        # Called by the outbound threads: the table is updated by the scheduler thread
+        self._results.put((ids, future.exception()))
+
+    def apply_results(self, timeout: float = 0.0) -> int:
+        """Apply the outcome of the finished calls; return the number of deleted rows.
+        The rows are removed when Telegram deletes the messages or refuses to (e.g. they're
+        already gone); the ones which failed for a transient error are rescheduled.
+
+        :param timeout: how long to wait for the calls still in flight
+        """
+        deadline = time.monotonic() + timeout
+        waiting = set(self._in_flight)
+        done, retry = [], []
+        while waiting:
+            try:
+                ids, error = self._results.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            waiting.difference_update(ids)
+            if error is None:
+                done.extend(ids)
+            elif isinstance(error, telegram.error.BadRequest):
+                LOG.info("Can't delete the expired messages: %s", error)
+                done.extend(ids)
+            else:
+                LOG.info("Can't delete the expired messages, retrying in %d seconds: %s", RETRY_DELAY, error)
+                retry.extend(ids)
+
+        ScheduledDeletion.objects.filter(id__in=done).delete()
+        if retry:
+            ScheduledDeletion.objects.filter(id__in=retry)\
+                .update(due_at=datetime.now() + timedelta(seconds=RETRY_DELAY))
+        self._in_flight.difference_update(done)
+        self._in_flight.difference_update(retry)
+        self.deleted += len(done)
+        return len(done)
+
+    def wait_time(self) -> float:
+        """Seconds until the next expiry in the heap or the next poll, whichever comes first"""
+        if not self._heap:
+            return self.poll_interval
+        return min(self.poll_interval, max(0.0, (self._heap[0][0] - datetime.now()).total_seconds()))
+
+    def run(self, report_interval: float = 60) -> None:
+        next_report = time.monotonic() + report_interval
+        while not self._stop.is_set():
+            try:
+                self.apply_results()
+                self.load()
+                self.run_once()
+            except Exception as e:
+                LOG.exception("Deletions failed: %s", e)
+                close_old_connections()
+
+            if time.monotonic() >= next_report:
+                LOG.info("%d messages deleted with %d calls, lag: %.1f s now, %.1f s at most",
+                         self.deleted, self.calls, lag(), self.max_lag)
+                next_report = time.monotonic() + report_interval
+            self._stop.wait(self.wait_time())
+
+    def stop(self) -> None:
+        self._stop.set()
@@ -0,0 +1,217 @@
+"""Refresh of the Telegram info of the groups: title, description, invite link, owner and administrators.
+
+Every group is refreshed after settings.TELEGRAM_GROUP_SYNC_INTERVAL seconds, or
+after TELEGRAM_GROUP_SYNC_IDLE_INTERVAL seconds if nobody wrote in it recently;
+the most out of date groups come first. After a failure, e.g. because the bot
+was removed from the group, the group is retried with an exponential backoff. The Bot API calls of all the groups are
+submitted at once to telegrambot.outbound, so the groups of different bots are
+refreshed concurrently under the per-bot rate limits, and each group is saved
+with a few bulk statements as soon as its answers arrive.
+
+Between two refreshes the handlers apply the changes Telegram pushes to the
+bots (new titles and photos, promotions and demotions) with the functions at
+the bottom of this module, which mark the groups as fresh: the periodic
+refresh only has to repair the changes the bots missed.
+"""
+import logging as logg
+from datetime import datetime, timedelta
+from typing import Iterable, List
+
+import telegram
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import F, Q
+
+from telegrambot import bookkeeping, bots, cache, outbound
+from telegrambot.outbound import Priority
+from telegrambot.models import (
+    Group as DBGroup,
+    GroupMembership as DBGroupMembership,
+)
+
+
+LOG = logg.getLogger(__name__)
+
+_ADMIN_STATUSES = (DBGroupMembership.MembershipStatus.CREATOR, DBGroupMembership.MembershipStatus.ADMINISTRATOR)
+
+# Maximum delay between two attempts in a group which keeps failing
+MAX_BACKOFF = timedelta(days=7)
+
+# The fields saved by apply; the other ones may have been changed in the admin in the meantime
+_INFO_FIELDS = ["title", "invite_link", "description", "owner", "info_updated_at", "info_attempted_at",
+                "info_failures"]
+
+
+def apply(group: DBGroup, chat: telegram.Chat, administrators: List[telegram.ChatMember]) -> None:
+    """Save the Telegram info of a group.
+
+    :param group: the group to update
+    :param chat: the answer of getChat
+    :param administrators: the answer of getChatAdministrators
+    """
+    group.title = chat.title
+    group.invite_link = chat.invite_link
+    group.description = chat.description
+    group.info_updated_at = group.info_attempted_at = datetime.now()
+    group.info_failures = 0
+
+    statuses = {member.user.id: member.status for member in administrators}
+    owner_ids = [member.user.id for member in administrators if member.status == telegram.ChatMember.CREATOR]
+    if owner_ids:
+        group.owner_id = owner_ids[0]
+
+    with transaction.atomic():
+        bookkeeping.upsert_users([bookkeeping.user_row(member.user, datetime.now()) for member in administrators])
+        bookkeeping.upsert_membership_statuses(group.id, statuses)
+        # The members which are not administrators anymore
+        DBGroupMembership.objects\
+            .filter(group_id=group.id, status__in=_ADMIN_STATUSES)\
+            .exclude(user_id__in=list(statuses))\
+            .update(status=DBGroupMembership.MembershipStatus.MEMBER)
+        group.save(update_fields=_INFO_FIELDS)
+
+
+def record_failure(group: DBGroup) -> None:
+    """Record a failed refresh of a group, to retry it later with a backoff"""
+    DBGroup.objects.filter(id=group.id).update(info_attempted_at=datetime.now(), info_failures=F("info_failures") + 1)
+
+
+def _backoff(failures: int) -> timedelta:
+    return min(timedelta(seconds=settings.TELEGRAM_GROUP_SYNC_INTERVAL) * 2 ** failures, MAX_BACKOFF)
+
+
+def due_groups(now: datetime = None) -> list[DBGroup]:
+    """Return the groups whose info should be refreshed, the most out of date first"""
+    now = now or datetime.now()
+    active_interval = timedelta(seconds=settings.TELEGRAM_GROUP_SYNC_INTERVAL)
+    idle_interval = timedelta(seconds=settings.TELEGRAM_GROUP_SYNC_IDLE_INTERVAL)
+    groups = list(DBGroup.objects.exclude(bot=None).filter(
+        Q(info_failures__gt=0) | Q(info_updated_at=None)
+        | Q(info_updated_at__lte=now - min(active_interval, idle_interval))
+    ))
+    # Only the groups refreshed in the last idle_interval need to know whether somebody wrote in them
+    recent = [group.id for group in groups
+              if not group.info_failures and group.info_updated_at and now - group.info_updated_at < idle_interval]
+    active = set(
+        DBGroupMembership.objects
+        .filter(group_id__in=recent, last_seen__gt=now - idle_interval)
+        .values_list("group_id", flat=True).distinct()
+    ) if recent else set()
+
+    due = []
+    for group in groups:
+        if group.info_failures:
+            age, interval = now - group.info_attempted_at, _backoff(group.info_failures)
+            if age >= interval:
+                due.append((age / interval, group))
+            continue
+
+        if group.info_updated_at is None:
+            due.append((float("inf"), group))
+            continue
+
+        interval = active_interval if group.id in active else idle_interval
+        age = now - group.info_updated_at
+        if age >= interval:
+            due.append((age / interval, group))
+
+    due.sort(key=lambda item: item[0], reverse=True)
+    return [group for _, group in due]
+
+
+def sync(groups: Iterable[DBGroup]) -> dict[str, int]:
+    """Fetch and save the Telegram info of the groups.
+
+    :return: how many groups were updated and how many failed
+    """
+    pending = []
+    for group in groups:
+        token = bots.get_token(group.bot_id)
+        if token is None:
+            continue
+        bot = bots.get_bot(token)
+        pending.append((
+            group,
+            outbound.submit(bot, "get_chat", Priority.SYNC, chat_id=group.id),
+            outbound.submit(bot, "get_chat_administrators", Priority.SYNC, chat_id=group.id),
+        ))
+
+    report = {"updated": 0, "failed": 0}
+    for group, chat, administrators in pending:
+        try:
+            apply(group, chat.result(), administrators.result())
+        except telegram.error.TelegramError as e:
+            LOG.info("Can't fetch the info of group %d: %s", group.id, e)
+            record_failure(group)
+            report["failed"] += 1
+        except Exception as e:
+            # Don't give up on the other groups
+            LOG.exception("Can't save the info of group %d: %s", group.id, e)
+            record_failure(group)
+            report["failed"] += 1
+        else:
+            report["updated"] += 1
+    return report
+
+
+def update_title(chat_id: int, title: str) -> None:
+    """Save the new title of a group, from a new_chat_title service message"""
+    DBGroup.objects.filter(id=chat_id).update(title=title, info_updated_at=datetime.now())
+    cache.groups.invalidate(chat_id)
+
+
+def update_photo(chat_id: int, photo: List[telegram.PhotoSize]) -> None:
+    """Schedule the download of the new picture of a group, from a new_chat_photo service message.
+    The download runs in a background task, so the handler doesn't wait for Telegram.
+
+    :param photo: the sizes of the picture; the largest one is saved
+    """
+    from telegrambot.tasks import download_group_photo  # the tasks module can't be imported while loading the models
+
+    largest = max(photo, key=lambda size: size.width * size.height)
+    transaction.on_commit(lambda: download_group_photo(chat_id, largest.file_id))
+
+
+def download_photo(chat_id: int, file_id: str) -> None:
+    """Download and save the picture of a group, deleting the file of the old one"""
+    group = DBGroup.objects.filter(id=chat_id).first()
+    token = bots.get_token(group.bot_id) if group is not None else None
+    if token is None:
+        return
+
+    file: telegram.File = outbound.call(bots.get_bot(token), "get_file", Priority.SYNC, file_id=file_id)
+    content = ContentFile(bytes(file.download_as_bytearray()))
+    old_name = group.profile_picture.name
+    group.profile_picture.save(f"{file.file_unique_id}.jpg", content, save=False)
+    group.info_updated_at = datetime.now()
+    group.save(update_fields=["profile_picture", "info_updated_at"])
+    if old_name and old_name != group.profile_picture.name:
+        group.profile_picture.storage.delete(old_name)
+
+
+def delete_photo(chat_id: int) -> None:
+    """Remove the picture of a group and its file, from a delete_chat_photo service message"""
+    group = DBGroup.objects.filter(id=chat_id).first()
+    if group is None:
+        return
+
+    old_name = group.profile_picture.name
+    DBGroup.objects.filter(id=chat_id).update(profile_picture=None, info_updated_at=datetime.now())
+    if old_name:
+        storage = group.profile_picture.storage
+        transaction.on_commit(lambda: storage.delete(old_name))
+
+
+def update_member_status(chat_id: int, old: telegram.ChatMember, new: telegram.ChatMember) -> None:
+    """Save the new status of a member of a group, from a chat_member update.
+    Promotions, demotions and changes of owner also mark the group as fresh.
+    """
+    bookkeeping.upsert_membership_statuses(chat_id, {new.user.id: new.status})
+    if old.status not in _ADMIN_STATUSES and new.status not in _ADMIN_STATUSES:
+        return
+
+    fields = {"info_updated_at": datetime.now()}
+    if new.status == telegram.ChatMember.CREATOR:
+        fields["owner_id"] = new.user.id
+    DBGroup.objects.filter(id=chat_id).update(**fields)
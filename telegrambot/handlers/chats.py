@@ -0,0 +1,17 @@
+from telegram import Update, Message, Chat
+from telegram.ext import CallbackContext
+
+from telegrambot import groupsync
+
+
+def handle_chat_info_updates(update: Update, context: CallbackContext) -> None:
+    """Save the new title or picture of a group, from its service messages"""
+    message: Message = update.message
+    chat: Chat = message.chat
+
+    if message.new_chat_title:
+        groupsync.update_title(chat.id, message.new_chat_title)
+    elif message.new_chat_photo:
+        groupsync.update_photo(chat.id, message.new_chat_photo)
+    elif message.delete_chat_photo:
+        groupsync.delete_photo(chat.id)
@@ -1,40 +1,71 @@
 import logging as logg
+import os
+import threading
+import time
 
-from telegram import Update
-from telegram.ext import MessageHandler, Filters, CommandHandler, ChatMemberHandler, CallbackQueryHandler, Updater
+from telegram import Update, TelegramError
+from telegram.ext import (
+    MessageHandler,
+    Filters,
+    CommandHandler,
+    ChatMemberHandler,
+    CallbackQueryHandler,
+    Updater,
+    Dispatcher,
+    Handler,
+)
 
-from telegrambot.handlers import messages, members, moderation, errors, memes
+from telegrambot import bots, dedup
+from telegrambot.handlers import chats, messages, members, moderation, errors, memes
 
 
 LOG = logg.getLogger(__name__)
-dispatchers = {}
+dispatchers: dict[str, Dispatcher] = {}
+_dispatchers_lock = threading.Lock()
 
+# Update types requested to Telegram; chat_member updates are not sent unless explicitly requested
+ALLOWED_UPDATES = [
+    "message",
+    "edited_message",
+    "callback_query",
+    "chat_member",
+    "my_chat_member",
+]
 
-def setup_dispatcher(dispatcher):
-    dispatcher.add_error_handler(errors.telegram_error_handler)
 
+# The handler graph is built once and shared by the dispatchers of all bots:
+# handlers keep no per-bot state, so the same instances can be safely reused.
+HANDLERS: tuple[tuple[Handler, int], ...] = (
     # Pre-processing
-    dispatcher.add_handler(MessageHandler(
+    (MessageHandler(
         filters=Filters.chat_type.groups,
         callback=messages.handle_group_messages,
-    ), group=0)
+    ), 0),
 
     # Groups
-    dispatcher.add_handler(ChatMemberHandler(
+    (ChatMemberHandler(
         callback=members.handle_chat_member_updates,
         chat_member_types=ChatMemberHandler.ANY_CHAT_MEMBER,
-    ), group=1)
-    dispatcher.add_handler(MessageHandler(
+    ), 1),
+    (MessageHandler(
+        filters=Filters.chat_type.groups & (
+            Filters.status_update.new_chat_title |
+            Filters.status_update.new_chat_photo |
+            Filters.status_update.delete_chat_photo
+        ),
+        callback=chats.handle_chat_info_updates,
+    ), 1),
+    (MessageHandler(
         filters=Filters.status_update,
         callback=members.handle_left_chat_member_updates,
-    ), group=1)
-    dispatcher.add_handler(MessageHandler(
+    ), 1),
+    (MessageHandler(
         filters=Filters.chat_type.groups,
         callback=messages.handle_admin_tagging,
-    ), group=1)
+    ), 1),
 
     # Admin commands
-    dispatcher.add_handler(CommandHandler(
+    (CommandHandler(
         command=[
             "info",
             "warn",
@@ -47,52 +78,98 @@ def setup_dispatcher(dispatcher):
             "del",
         ],
         callback=moderation.handle_moderation_command,
-    ), group=2)
-    dispatcher.add_handler(CommandHandler(
+    ), 2),
+    (CommandHandler(
         command="claim",
         callback=members.claim_command,
-    ), group=2)
-    dispatcher.add_handler(CommandHandler(
+    ), 2),
+    (CommandHandler(
         command="creation",
         callback=moderation.handle_creation_command,
-    ), group=2)
-    dispatcher.add_handler(CommandHandler(
+    ), 2),
+    (CommandHandler(
         command="whitelistbot",
         callback=moderation.handle_whitelisting_command,
-    ), group=2)
-    dispatcher.add_handler(CommandHandler(
+    ), 2),
+    (CommandHandler(
         command="ignore_admin",
         callback=moderation.handle_toggle_admin_tagging,
-    ), group=2)
-    dispatcher.add_handler(CommandHandler(
+    ), 2),
+    (CommandHandler(
         command="broadcast",
         callback=messages.request_broadcast_message,
-    ), group=2)
-    dispatcher.add_handler(CallbackQueryHandler(
+    ), 2),
+    (CallbackQueryHandler(
         callback=messages.handle_broadcast_confirm,
         pattern="^broadcast_send$"
-    ), group=2)
-    dispatcher.add_handler(CallbackQueryHandler(
+    ), 2),
+    (CallbackQueryHandler(
         callback=messages.handle_broadcast_discard,
         pattern="^broadcast_discard$"
-    ), group=2)
+    ), 2),
 
     # User commands
-    dispatcher.add_handler(CommandHandler(
+    (CommandHandler(
         command="respects",
         callback=memes.init_respects,
-    ), group=3)
-    dispatcher.add_handler(CallbackQueryHandler(
+    ), 3),
+    (CallbackQueryHandler(
         callback=memes.add_respect,
         pattern="^press_f$",
-    ), group=3)
+    ), 3),
+)
+
+
+def setup_dispatcher(dispatcher: Dispatcher) -> None:
+    dispatcher.add_error_handler(errors.telegram_error_handler)
+    for handler, group in HANDLERS:
+        dispatcher.add_handler(handler, group=group)
+
+
+def get_dispatcher(token: str) -> Dispatcher:
+    """Get the dispatcher of a bot, building it the first time it's needed"""
+    if (dispatcher := dispatchers.get(token)) is not None:
+        return dispatcher
+
+    with _dispatchers_lock:
+        if token not in dispatchers:
+            dispatcher = Updater(bot=bots.get_bot(token)).dispatcher
+            setup_dispatcher(dispatcher)
+            dispatchers[token] = dispatcher
+        return dispatchers[token]
+
+
+def warm_up() -> list[tuple[str, float, float]]:
+    """Build the dispatcher of every authorized bot and fetch its identity from Telegram,
+    so that the first update received by each bot doesn't pay for it.
+
+    :return: a list of (bot username, build time in ms, get_me time in ms)
+    """
+    report = []
+    started = time.perf_counter()
+    for token in bots.all_tokens():
+        build_started = time.perf_counter()
+        dispatcher = get_dispatcher(token)
+        built = time.perf_counter()
+        try:
+            username = f"@{dispatcher.bot.get_me().username}"
+        except TelegramError as e:
+            username = f"[{token.split(':')[0]}: {e.message}]"
+        report.append((username, (built - build_started) * 1000, (time.perf_counter() - built) * 1000))
+
+    LOG.info("Dispatchers warm-up (pid %d): %d bots in %.0f ms",
+             os.getpid(), len(report), (time.perf_counter() - started) * 1000)
+    for username, build_ms, get_me_ms in report:
+        LOG.info("  %s: dispatcher built in %.1f ms, get_me in %.1f ms", username, build_ms, get_me_ms)
+    return report
 
 
-# Tokens that are sent to this function have already been checked againts the DB
+# Tokens that are sent to this function have already been checked against the bot registry
 def dispatch_telegram_update(json_update: dict, token: str) -> None:
-    if token not in dispatchers.keys():
-        dispatchers[token] = Updater(token=token).dispatcher
-        setup_dispatcher(dispatchers[token])
+    if dedup.is_duplicate(json_update, token):
+        # Telegram sent the update again because we were too slow to answer
+        return
 
-    update = Update.de_json(json_update, dispatchers[token].bot)
-    dispatchers[token].process_update(update)
+    dispatcher = get_dispatcher(token)
+    update = Update.de_json(json_update, dispatcher.bot)
+    dispatcher.process_update(update)
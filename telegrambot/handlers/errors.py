@@ -1,12 +1,25 @@
+import logging as logg
+from concurrent.futures import Future
+from typing import Callable
+
 from django.conf import settings
-from telegram import Update, TelegramError
-from telegram.ext import CallbackContext
+from django.db import connection, DatabaseError
+from telegram import Update, Chat, TelegramError
+from telegram.ext import CallbackContext, DispatcherHandlerStop
 
 from telegrambot import logging
 
 
+LOG = logg.getLogger(__name__)
+
+
 def telegram_error_handler(update: Update, context: CallbackContext) -> None:
     error = context.error
+    if isinstance(error, DatabaseError) and connection.in_atomic_block:
+        # The transaction is aborted: the next handlers would fail too, or act on writes which will be rolled back
+        LOG.error("Database error while handling an update, skipping its other handlers: %s", error)
+        raise DispatcherHandlerStop()
+
     if not isinstance(error, TelegramError):
         if settings.DEBUG:
             raise error
@@ -14,3 +27,14 @@ def telegram_error_handler(update: Update, context: CallbackContext) -> None:
 
     if update.effective_chat:
         logging.log(logging.TELEGRAM_ERROR, update.effective_chat, error_message=error.message)
+
+
+def report_failure(chat: Chat) -> Callable[[Future], None]:
+    """Build a done callback logging the failure of a call submitted to telegrambot.outbound,
+    like telegram_error_handler does for the errors raised by the handlers.
+    """
+    def callback(future: Future) -> None:
+        error = future.exception()
+        if isinstance(error, TelegramError):
+            logging.log(logging.TELEGRAM_ERROR, chat, error_message=error.message)
+    return callback
@@ -3,11 +3,11 @@ from django.utils.translation import gettext_lazy as _
 from telegram import Update, User, Message, Chat, InlineKeyboardMarkup, InlineKeyboardButton, ChatMember
 from telegram.ext import CallbackContext
 
-from telegrambot import tasks, logging
+from telegrambot import expiry, groupsync, logging, cache, outbound
 from telegrambot.handlers import utils
+from telegrambot.outbound import Priority
 from telegrambot.models import (
     User as DBUser,
-    Group as DBGroup,
     BotWhitelist,
 )
 
@@ -24,6 +24,7 @@ def handle_chat_member_updates(update: Update, context: CallbackContext) -> None
     new: ChatMember = update.chat_member.new_chat_member
 
     utils.save_user(new.user, chat)
+    groupsync.update_member_status(chat.id, old, new)
 
     if new.status == ChatMember.LEFT:
         logging.log(logging.USER_LEFT, chat=chat, target=user)
@@ -33,7 +34,7 @@ def handle_chat_member_updates(update: Update, context: CallbackContext) -> None
             return
 
         if new.user.is_bot and not BotWhitelist.objects.filter(username=f"@{new.user.username}").exists():
-            context.bot.kickChatMember(chat.id, new.user.id)
+            outbound.submit(context.bot, "ban_chat_member", Priority.MODERATION, chat_id=chat.id, user_id=new.user.id)
             return
 
         dbuser: DBUser = utils.save_user(new.user, chat)
@@ -41,12 +42,13 @@ def handle_chat_member_updates(update: Update, context: CallbackContext) -> None
         utils.set_admin_rights(dbuser, chat)
         logging.log(logging.USER_JOINED, chat=chat, target=new.user)
 
-        dbgroup: DBGroup = DBGroup.objects.get(id=chat.id)
+        dbgroup: cache.CachedGroup = cache.groups.get(chat.id)
 
         if dbuser.banned:
-            context.bot.banChatMember(chat.id, new.user.id)
+            outbound.submit(context.bot, "ban_chat_member", Priority.MODERATION, chat_id=chat.id, user_id=new.user.id)
 
-        msg: Message = context.bot.send_message(
+        outbound.submit(
+            context.bot, "send_message", Priority.WELCOME,
             chat_id=chat.id,
             text=dbgroup.generate_welcome_message([new.user, ]),
             parse_mode="html",
@@ -73,8 +75,7 @@ def handle_chat_member_updates(update: Update, context: CallbackContext) -> None
                     ),
                 ],
             ]),
-        )
-        tasks.delete_message(chat.id, msg.message_id)
+        ).add_done_callback(expiry.delete_sent_message)
 
 
 def claim_command(update: Update, _: CallbackContext) -> None:
@@ -85,7 +86,7 @@ def claim_command(update: Update, _: CallbackContext) -> None:
     dbuser = DBUser.objects.get(id=user.id)
 
     utils.set_admin_rights(dbuser, chat)
-    message.delete()
+    outbound.submit(message.bot, "delete_message", Priority.MODERATION, chat_id=chat.id, message_id=message.message_id)
 
 
 def handle_left_chat_member_updates(update: Update, _: CallbackContext):
@@ -97,7 +98,8 @@ def handle_left_chat_member_updates(update: Update, _: CallbackContext):
 
     # Delete the "user joined" message if the group has more of 50 members
     if message.new_chat_members and chat.get_member_count() >= 50:
-        tasks.delete_message(chat.id, message.message_id)
+        expiry.schedule(chat.id, message.message_id)
 
     if message.left_chat_member:
-        update.message.delete()
+        outbound.submit(message.bot, "delete_message", Priority.DELETION,
+                        chat_id=chat.id, message_id=message.message_id)
@@ -1,13 +1,18 @@
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, TelegramError
 from telegram.ext import CallbackContext, DispatcherHandlerStop
 
+from telegrambot import outbound
+from telegrambot.outbound import Priority
+
 
 def init_respects(update: Update, context: CallbackContext) -> None:
     message = update.message
     chat = message.chat
 
-    chat.send_message(
-        "Press F to pay respects.\n0 users have paid their respects",
+    outbound.submit(
+        context.bot, "send_message", Priority.INTERACTIVE,
+        chat_id=chat.id,
+        text="Press F to pay respects.\n0 users have paid their respects",
         disable_notification=True,
         reply_markup=InlineKeyboardMarkup([
             [
@@ -18,7 +23,7 @@ def init_respects(update: Update, context: CallbackContext) -> None:
             ]
         ])
     )
-    message.delete()
+    outbound.submit(context.bot, "delete_message", Priority.MODERATION, chat_id=chat.id, message_id=message.message_id)
 
 
 def add_respect(update: Update, context: CallbackContext) -> None:
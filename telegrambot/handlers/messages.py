@@ -1,22 +1,19 @@
 import logging as logg
-import telegram
-from polymorphic.query import PolymorphicQuerySet
 
 from django.utils.translation import gettext_lazy as _
 
 from telegram import Update, User, Message, Chat, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import CallbackContext, DispatcherHandlerStop
 from django.conf import settings
-from django.db.models import Q, QuerySet
 
-from roles.models import Moderator, SuperAdministrator, Administrator, BaseRole
-from telegrambot import logging, tasks
+from roles.models import get_staff_users
+from telegrambot import logging, expiry, cache, outbound
 from telegrambot.handlers import utils
+from telegrambot.outbound import Priority
 from telegrambot.models import (
     Group as DBGroup,
     User as DBUser,
 )
-from university.models import Degree
 
 
 LOG = logg.getLogger(__name__)
@@ -36,18 +33,15 @@ def handle_group_messages(update: Update, context: CallbackContext) -> None:
         # Ignore messages sent by the bot itself
         raise DispatcherHandlerStop
 
-    try:
-        dbgroup = DBGroup.objects.get(id=chat.id)
-        dbgroup.title = chat.title
-        dbgroup.save(force_update=True, update_fields=["title", ])
-    except DBGroup.DoesNotExist:
+    if cache.groups.get(chat.id) is None:
         # The group is not in the database; ignore all updates from it
         logging.log(logging.CHAT_DOES_NOT_EXIST, chat)
         # TODO: re-enable this line
         # context.bot.leave_chat(chat_id=chat.id)
         raise DispatcherHandlerStop
+    cache.groups.update_title(chat.id, chat.title)
 
-    utils.save_user(sender, chat, count_message=True)
+    utils.record_message(sender, chat)
 
 
 def handle_admin_tagging(update: Update, context: CallbackContext) -> None:
@@ -64,11 +58,8 @@ def handle_admin_tagging(update: Update, context: CallbackContext) -> None:
     if not any([targets[target][1:] == "admin" for target in targets]):
         return
 
-    dbgroup = DBGroup.objects.filter(id=chat.id)
-    if len(dbgroup) == 0:
-        return
-    dbgroup = dbgroup[0]
-    if dbgroup.ignore_admin_tagging:
+    dbgroup = cache.groups.get(chat.id)
+    if dbgroup is None or dbgroup.ignore_admin_tagging:
         return
 
     try:
@@ -86,34 +77,26 @@ def handle_admin_tagging(update: Update, context: CallbackContext) -> None:
     logging.log(logging.USER_CALLED_ADMIN, chat, target=dbtarget, issuer=dbuser, msg=reply_to)
 
     # Get users with privileges (>= Moderator) on the group
-    degrees: QuerySet[Degree] = Degree.objects.filter(
-        Q(courses__group__id=chat.id) | Q(group__id=chat.id)
-    )
-    if degrees:
-        roles: PolymorphicQuerySet[BaseRole] = BaseRole.objects.filter(
-            Q(degrees__in=degrees) | Q(all_groups=True)
-        )
-    else:
-        roles: PolymorphicQuerySet[BaseRole] = BaseRole.objects.filter(extra_groups=True)
-    roles = roles.instance_of(Moderator) | roles.instance_of(Administrator) | roles.instance_of(SuperAdministrator)
+    admins = get_staff_users(utils.get_group_degrees(chat.id))
 
-    caption = utils.generate_admin_tagging_notification(dbuser, dbgroup, roles, reply_to)
-    context.bot.send_message(
-        settings.TELEGRAM_ADMIN_GROUP_ID,
-        caption,
+    caption = utils.generate_admin_tagging_notification(dbuser, dbgroup, admins, reply_to)
+    outbound.submit(
+        context.bot, "send_message", Priority.INTERACTIVE,
+        chat_id=settings.TELEGRAM_ADMIN_GROUP_ID,
+        text=caption,
         parse_mode="html",
         disable_web_page_preview=True,
     )
 
     utils.activate_group_language(dbgroup, dbuser)
-    sent_msg: Message = context.bot.send_message(
-        chat.id,
-        str(_("👮 <b>Thanks for your report</b>, admins have been notified.")),
+    outbound.submit(
+        context.bot, "send_message", Priority.INTERACTIVE,
+        chat_id=chat.id,
+        text=str(_("👮 <b>Thanks for your report</b>, admins have been notified.")),
         parse_mode="html",
         disable_web_page_preview=True,
-    )
-    context.bot.delete_message(chat.id, message.message_id)
-    tasks.delete_message(chat.id, sent_msg.message_id)
+    ).add_done_callback(expiry.delete_sent_message)
+    outbound.submit(context.bot, "delete_message", Priority.MODERATION, chat_id=chat.id, message_id=message.message_id)
 
 
 def request_broadcast_message(update: Update, _: CallbackContext):
@@ -124,8 +107,10 @@ def request_broadcast_message(update: Update, _: CallbackContext):
     if not utils.is_superadmin(issuer):
         return
 
-    issuer.send_message(
-        message.text_markdown_v2[11:],
+    outbound.submit(
+        message.bot, "send_message", Priority.INTERACTIVE,
+        chat_id=issuer.id,
+        text=message.text_markdown_v2[11:],
         reply_markup=InlineKeyboardMarkup([
             [
                 InlineKeyboardButton(
@@ -140,7 +125,8 @@ def request_broadcast_message(update: Update, _: CallbackContext):
         ]),
         parse_mode="markdown"
     )
-    message.delete()
+    outbound.submit(message.bot, "delete_message", Priority.MODERATION,
+                    chat_id=message.chat_id, message_id=message.message_id)
 
 
 def handle_broadcast_confirm(update: Update, context: CallbackContext):
@@ -151,16 +137,16 @@ def handle_broadcast_confirm(update: Update, context: CallbackContext):
     if not utils.is_superadmin(issuer):
         return
 
-    message.edit_text(message.text_markdown_v2)
+    outbound.submit(bot, "edit_message_text", Priority.INTERACTIVE,
+                    chat_id=message.chat_id, message_id=message.message_id, text=message.text_markdown_v2)
 
+    # The calls to the groups which fail are only logged by outbound
     for group in DBGroup.objects.all():
-        try:
-            bot.send_message(group.id, message.text_markdown_v2, parse_mode="markdown")
-        except telegram.TelegramError:
-            continue
+        outbound.submit(bot, "send_message", Priority.INTERACTIVE,
+                        chat_id=group.id, text=message.text_markdown_v2, parse_mode="markdown")
 
     logging.log(logging.BROADCAST, None, issuer=issuer, msg=message)
-    message.delete()
+    outbound.submit(bot, "delete_message", Priority.MODERATION, chat_id=message.chat_id, message_id=message.message_id)
 
 
 def handle_broadcast_discard(update: Update, _: CallbackContext):
@@ -169,4 +155,6 @@ def handle_broadcast_discard(update: Update, _: CallbackContext):
     if not utils.is_superadmin(issuer):
         return
 
-    update.callback_query.message.delete()
+    message = update.callback_query.message
+    outbound.submit(message.bot, "delete_message", Priority.MODERATION,
+                    chat_id=message.chat_id, message_id=message.message_id)
@@ -1,18 +1,20 @@
 import logging as logg
-from time import sleep
+from concurrent.futures import Future
+from functools import partial
 
 from django.utils.translation import gettext_lazy as _
 from telegram import Update, Message, User, Chat, ChatPermissions, MessageEntity, Bot
 from telegram.ext import CallbackContext
-from telegram.error import RetryAfter
 
-from telegrambot import tasks, logging
+from telegrambot import expiry, jobs, logging, outbound
 from telegrambot.logging import EventTypes
-from telegrambot.handlers import utils
+from telegrambot.handlers import utils, errors
+from telegrambot.outbound import Priority
 from telegrambot.models import (
     Group as DBGroup,
     User as DBUser,
-    BotWhitelist
+    BotWhitelist,
+    NetworkJob,
 )
 
 
@@ -47,6 +49,8 @@ class ModerationCommand:
         self.event = self._match_command()
         self.target, self.reason = self._decode_args()
         self.target_message = self._message.reply_to_message
+        # The log entry, see logging.prepare
+        self.prepared_entry: Future | None = None
 
         if self.event == logging.EventTypes.MODERATION_DEL and not self.target_message:
             raise NoTargetsInCommand()
@@ -162,73 +166,79 @@ class ModerationCommand:
 
         # User must start the bot in private before he can receive messages from it
         for text in texts:
-            while True:
-                try:
-                    self.issuer.send_message(text, parse_mode="html", disable_web_page_preview=True)
-                    break
-                except RetryAfter as e:
-                    sleep(e.retry_after)
+            outbound.submit(
+                self.bot, "send_message", Priority.INTERACTIVE,
+                chat_id=self.issuer.id, text=text, parse_mode="html", disable_web_page_preview=True,
+            )
+
+    def _submit(self, method: str, chat_id: int, **kwargs) -> None:
+        outbound.submit(self.bot, method, Priority.MODERATION, chat_id=chat_id, **kwargs)\
+            .add_done_callback(errors.report_failure(self._message.chat))
 
     def delete(self):
-        self.target_message.delete()
+        delete = partial(self._submit, "delete_message", self._chat_id, message_id=self.target_message.message_id)
+        if self.prepared_entry is None:
+            delete()
+        else:
+            # The message is deleted once it's been forwarded to the log chat
+            self.prepared_entry.add_done_callback(lambda _: delete())
 
     def warn(self):
         self.target.warn_count += 1
         self.target.save()
 
     def kick(self, chat_id=None):
-        self.bot.unban_chat_member(
+        self._submit(
+            "unban_chat_member",
             chat_id=chat_id or self._chat_id,
             user_id=self.target.id,
         )
 
     def mute(self, chat_id=None):
-        self.bot.restrict_chat_member(
+        self._submit(
+            "restrict_chat_member",
             chat_id=chat_id or self._chat_id,
             user_id=self.target.id,
             permissions=ChatPermissions(can_send_messages=False),
         )
 
     def ban(self, chat_id=None):
-        self.bot.ban_chat_member(
+        self._submit(
+            "ban_chat_member",
             chat_id=chat_id or self._chat_id,
             user_id=self.target.id,
         )
 
     def free(self, chat_id=None):
-        self.bot.unban_chat_member(
+        # The calls to a chat are executed in order: the user is unbanned before being unrestricted
+        self._submit(
+            "unban_chat_member",
             chat_id=chat_id or self._chat_id,
             user_id=self.target.id,
             only_if_banned=True,
         )
-        self.bot.restrict_chat_member(
+        self._submit(
+            "restrict_chat_member",
             chat_id=chat_id or self._chat_id,
             user_id=self.target.id,
-            permissions=ChatPermissions(
-                can_send_messages=True,
-                can_send_media_messages=True,
-                can_send_polls=True,
-                can_send_other_messages=True,
-                can_add_web_page_previews=True,
-                can_change_info=True,
-                can_invite_users=True,
-                can_pin_messages=True,
-            ),
+            permissions=utils.FREE_PERMISSIONS,
         )
 
-    def superban(self):
-        for group in DBGroup.objects.filter(members__id=self.target.id):
-            self.ban(group.id)
+    def _other_groups(self):
+        return DBGroup.objects.filter(members__id=self.target.id).exclude(id=self._chat_id)
 
+    def superban(self):
+        # The user is banned from this group right away, and from the others by a network job
+        self.ban()
         self.target.banned = True
         self.target.save()
+        jobs.enqueue(NetworkJob.Kinds.SUPERBAN, self.target, self._other_groups())
 
     def superfree(self):
-        for group in DBGroup.objects.filter(members__id=self.target.id):
-            self.free(group.id)
-
+        self.free()
         self.target.banned = False
         self.target.save()
+        jobs.enqueue(NetworkJob.Kinds.SUPERFREE, self.target, self._other_groups())
 
 
 def handle_moderation_command(update: Update, context: CallbackContext) -> None:
@@ -240,7 +250,8 @@ def handle_moderation_command(update: Update, context: CallbackContext) -> None:
     try:
         command: ModerationCommand = ModerationCommand(bot, message)
     except NoTargetsInCommand:
-        context.bot.send_message(
+        outbound.submit(
+            bot, "send_message", Priority.INTERACTIVE,
             chat_id=chat.id,
             text=(
                 "❓ <b>Errore: utente non trovato</b>"
@@ -258,12 +269,11 @@ def handle_moderation_command(update: Update, context: CallbackContext) -> None:
         # Insufficient permissions
         return
 
-    prepared_entry = None
     if command.event != EventTypes.MODERATION_INFO:
-        prepared_entry: Message = logging.prepare(msg=command.target_message)
+        command.prepared_entry = logging.prepare(msg=command.target_message)
 
     command.dispatch()
-    message.delete()
+    outbound.submit(bot, "delete_message", Priority.MODERATION, chat_id=chat.id, message_id=message.message_id)
 
     if command.event == EventTypes.MODERATION_INFO:
         # No moderation message or further logging needed
@@ -277,7 +287,7 @@ def handle_moderation_command(update: Update, context: CallbackContext) -> None:
         reason=command.reason,
         msg=command.target_message,
         target_message_deleted=command.delete_target_message,
-        prepared_entry=prepared_entry,
+        prepared_entry=command.prepared_entry,
     )
 
     if command.event == EventTypes.MODERATION_DEL:
@@ -298,13 +308,13 @@ def handle_moderation_command(update: Update, context: CallbackContext) -> None:
         # Translators: This is the proposition before the reason why the user is banned, e.g. "_for_ spamming"
         "reason": _("for <i>%(reason)s</i>") % {"reason": command.reason} if command.reason else '',
     }
-    sent_msg: Message = bot.send_message(
+    outbound.submit(
+        bot, "send_message", Priority.INTERACTIVE,
         chat_id=chat.id,
         text=text,
         parse_mode="html",
         disable_web_page_preview=True,
-    )
-    tasks.delete_message(chat.id, sent_msg.message_id)
+    ).add_done_callback(expiry.delete_sent_message)
 
 
 def handle_creation_command(update: Update, context: CallbackContext) -> None:
@@ -316,9 +326,15 @@ def handle_creation_command(update: Update, context: CallbackContext) -> None:
         return
 
     text = utils.generate_group_creation_message(chat)
-    msg = context.bot.send_message(chat_id=chat.id, text=text, parse_mode="html")
-    msg.pin()
-    message.delete()
+    outbound.submit(context.bot, "send_message", Priority.INTERACTIVE, chat_id=chat.id, text=text, parse_mode="html")\
+        .add_done_callback(partial(_pin_sent_message, context.bot))
+    outbound.submit(context.bot, "delete_message", Priority.MODERATION, chat_id=chat.id, message_id=message.message_id)
+
+
+def _pin_sent_message(bot: Bot, future: Future) -> None:
+    if future.exception() is None:
+        msg: Message = future.result()
+        outbound.submit(bot, "pin_chat_message", Priority.INTERACTIVE, chat_id=msg.chat_id, message_id=msg.message_id)
 
 
 def handle_whitelisting_command(update: Update, _: CallbackContext) -> None:
@@ -342,7 +358,7 @@ def handle_whitelisting_command(update: Update, _: CallbackContext) -> None:
         to_whitelist.whitelisted_by = dbuser
         to_whitelist.save()
         logging.log(logging.WHITELIST_BOT, chat, issuer=sender, bot=bot)
-    message.delete()
+    outbound.submit(message.bot, "delete_message", Priority.MODERATION, chat_id=chat.id, message_id=message.message_id)
 
 
 def handle_toggle_admin_tagging(update: Update, _: CallbackContext) -> None:
@@ -353,17 +369,17 @@ def handle_toggle_admin_tagging(update: Update, _: CallbackContext) -> None:
     if not utils.is_superadmin(sender):
         return
 
+    outbound.submit(message.bot, "delete_message", Priority.MODERATION, chat_id=chat.id, message_id=message.message_id)
     try:
         dbgroup = DBGroup.objects.get(id=chat.id)
     except DBGroup.DoesNotExist:
-        message.delete()
         return
     dbgroup.ignore_admin_tagging = not dbgroup.ignore_admin_tagging
     dbgroup.save()
 
     if dbgroup.ignore_admin_tagging:
-        new_msg = chat.send_message("@admin are now ignored in this group")
+        text = "@admin are now ignored in this group"
     else:
-        new_msg = chat.send_message("@admin are now not ignored in this group")
-    tasks.delete_message(chat_id=chat.id, message_id=new_msg.message_id)
-    message.delete()
+        text = "@admin are now not ignored in this group"
+    outbound.submit(message.bot, "send_message", Priority.INTERACTIVE, chat_id=chat.id, text=text)\
+        .add_done_callback(expiry.delete_sent_message)
@@ -1,10 +1,12 @@
+from concurrent.futures import Future
 from datetime import datetime
+from functools import partial
 import logging as logg
 
 import telegram
 from django.apps import apps
 from django.conf import settings
-from django.db.models import Q, QuerySet
+from django.db.models import Q
 from django.urls import reverse
 from django.utils.translation import activate
 from polymorphic.query import PolymorphicQuerySet
@@ -14,11 +16,24 @@ from telegram.utils.helpers import escape
 
 import telegrambot.models as t_models
 import university.models as u_models
-from telegrambot import logging
+from telegrambot import logging, bookkeeping, bots, cache, outbound
 from telegrambot.logging import EventTypes
+from telegrambot.outbound import Priority
 
 LOG = logg.getLogger(__name__)
 
+# The permissions of a user who is freed from a ban or a mute
+FREE_PERMISSIONS = telegram.ChatPermissions(
+    can_send_messages=True,
+    can_send_media_messages=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True,
+    can_change_info=True,
+    can_invite_users=True,
+    can_pin_messages=True,
+)
+
 
 # def get_bot(chat: Union[Chat, telegrambot.Group, int]) -> telegram.Bot
 def get_bot(chat: Chat) -> telegram.Bot:
@@ -26,14 +41,20 @@ def get_bot(chat: Chat) -> telegram.Bot:
 
     :param chat: the considered Telegram chat
     :return: the telegram.Bot who is in that chat
+    :raises: Group.DoesNotExist if the chat is unknown, TelegramBot.DoesNotExist if no authorized bot is in it
     """
     DBGroup = apps.get_model("telegrambot.Group")
-    if isinstance(chat, DBGroup):
+    if isinstance(chat, (DBGroup, cache.CachedGroup)):
         dbgroup = chat
     else:
-        dbgroup = DBGroup.objects.get(id=chat if isinstance(chat, int) else chat.id)
-    bot = telegram.Bot(dbgroup.bot.token)
-    return bot
+        dbgroup = cache.groups.get(chat if isinstance(chat, int) else chat.id)
+        if dbgroup is None:
+            raise DBGroup.DoesNotExist()
+
+    token = bots.get_token(dbgroup.bot_id) if dbgroup.bot_id is not None else None
+    if token is None:
+        raise apps.get_model("telegrambot.TelegramBot").DoesNotExist(f"No authorized bot is in chat {dbgroup.id}")
+    return bots.get_bot(token)
 
 
 def check_blacklist(dbuser: t_models.User):
@@ -47,6 +68,9 @@ def check_blacklist(dbuser: t_models.User):
         # the user is already banned or blacklisted
         return
 
+    if not cache.bans.is_blacklisted(dbuser.id):
+        return
+
     BlacklistedUser = t_models.BlacklistedUser
     try:
         blacklisted_user: BlacklistedUser = BlacklistedUser.objects.get(user_id=dbuser.id)
@@ -75,40 +99,90 @@ def save_user(user: User, chat: Chat, count_message: bool = False):
     :param count_message: whatever to increment messages_count to GroupMembership or not
     :return: telegrambot.User object representing the user
     """
-    DBUser = apps.get_model("telegrambot.User")
-    dbuser = DBUser.objects.update_or_create(
-        id=user.id,
-        defaults={
-            "first_name": user.first_name,
-            "last_name": user.last_name,
-            "username": user.username,
-            "language": user.language_code,
-            "last_seen": datetime.now(),
-        }
-    )[0]
+    # One upsert per table: messages_count is incremented by the database, so that
+    # concurrent updates from different workers are never lost
+    dbuser = bookkeeping.upsert_user(user)
     check_blacklist(dbuser)
     if dbuser.banned:
         # The user is globally banned from the network
-        bot = get_bot(chat)
-        bot.ban_chat_member(
-            chat_id=chat.id,
-            user_id=user.id,
-        )
+        outbound.submit(get_bot(chat), "ban_chat_member", Priority.MODERATION, chat_id=chat.id, user_id=user.id)
         raise DispatcherHandlerStop
 
-    DBGroupMembership = apps.get_model("telegrambot.GroupMembership")
-    dbmembership = DBGroupMembership.objects.update_or_create(
-        user_id=user.id,
-        group_id=chat.id,
-        defaults={
-            "last_seen": datetime.now(),
-        }
-    )[0]
-    dbmembership.messages_count += 1 if count_message else 0
-    dbmembership.save()
+    bookkeeping.upsert_memberships([(user.id, chat.id, datetime.now(), 1 if count_message else 0)])
     return dbuser
 
 
+def record_message(user: User, chat: Chat) -> None:
+    """Record a message sent by a user in a group.
+    With settings.TELEGRAM_WRITE_BEHIND enabled, only the first message of a user in a group
+    is saved immediately: the following ones are buffered and saved in bulk (see telegrambot.bookkeeping).
+    If the user is globally banned, it will be banned from the chat.
+
+    :param user: the Telegram user who sent the message
+    :param chat: the Telegram chat the message was sent to
+    """
+    buffer = bookkeeping.buffer
+    if not settings.TELEGRAM_WRITE_BEHIND or not buffer.knows(user.id, chat.id):
+        save_user(user, chat, count_message=True)
+        if settings.TELEGRAM_WRITE_BEHIND:
+            buffer.remember(user.id, chat.id)
+        return
+
+    if cache.bans.is_banned(user.id) or cache.bans.is_blacklisted(user.id):
+        DBUser = apps.get_model("telegrambot.User")
+        dbuser = DBUser.objects.get(id=user.id)
+        check_blacklist(dbuser)
+        if dbuser.banned:
+            # The user is globally banned from the network
+            outbound.submit(get_bot(chat), "ban_chat_member", Priority.MODERATION, chat_id=chat.id, user_id=user.id)
+            raise DispatcherHandlerStop
+
+    buffer.record(user, chat.id, count_message=True)
+
+
+# def promote_staff_member(bot: telegram.Bot, dbuser: telegrambot.User, chat: Union[telegram.Chat, telegrambot.Chat])
+def promote_staff_member(bot: telegram.Bot, user, chat, force=False, cached=True) -> list[Future]:
+    """Set the chat admin rights and the custom title of a user in a chat, according to their roles.
+    The calls are submitted to telegrambot.outbound, in this order.
+
+    :param bot: the telegram.Bot who is in that chat
+    :param user: the telegrambot.User to promote
+    :param chat: the considered Telegram chat
+    :param force: force privileges setting (use this to remove privileges)
+    :param cached: False to read the roles from the database, e.g. outside of the process where they're changed
+    :return: the Futures of the calls, which fail with a TelegramError if Telegram refuses the promotion
+    """
+    resolve = get_permissions if cached else resolve_permissions
+    _, telegram_permissions, custom_title = resolve(user.id, chat.id)
+    if not force and not any([telegram_permissions[k] for k in telegram_permissions]):
+        return []
+
+    futures = [outbound.submit(
+        bot, "promote_chat_member", Priority.MODERATION,
+        chat_id=chat.id,
+        user_id=user.id,
+        **telegram_permissions,
+    )]
+    if custom_title:
+        futures.append(outbound.submit(
+            bot, "set_chat_administrator_custom_title", Priority.MODERATION,
+            chat_id=chat.id,
+            user_id=user.id,
+            custom_title=custom_title,
+        ))
+    return futures
+
+
+def _log_promotion_failure(bot: telegram.Bot, chat, future: Future) -> None:
+    error = future.exception()
+    if not isinstance(error, TelegramError):
+        return
+    if error.message == "Chat not found":
+        logging.log(logging.CHAT_DOES_NOT_EXIST, chat=chat, target=bot)
+    elif error.message == "Not enough rights":
+        logging.log(logging.NOT_ENOUGH_RIGHTS, chat=chat, target=bot)
+
+
 # def set_admin_rights(dbuser: telegrambot.User, chat: Union[telegram.Chat, telegrambot.Chat]) -> None
 def set_admin_rights(user, chat, force=False) -> None:
     """Try to set chat admin rights in a chat if the user has privileges.
@@ -118,27 +192,11 @@ def set_admin_rights(user, chat, force=False) -> None:
     :param force: force privileges setting (use this to remove privileges)
     :return: None
     """
-    _, telegram_permissions, custom_title = get_permissions(user.id, chat.id)
-
     bot = get_bot(chat)
-    try:
-        if force or any([telegram_permissions[k] for k in telegram_permissions]):
-            bot.promote_chat_member(
-                chat_id=chat.id,
-                user_id=user.id,
-                **telegram_permissions,
-            )
-            if custom_title:
-                bot.set_chat_administrator_custom_title(
-                    chat_id=chat.id,
-                    user_id=user.id,
-                    custom_title=custom_title,
-                )
-    except TelegramError as e:
-        if e.message == "Chat not found":
-            logging.log(logging.CHAT_DOES_NOT_EXIST, chat=chat, target=bot)
-        elif e.message == "Not enough rights":
-            logging.log(logging.NOT_ENOUGH_RIGHTS, chat=chat, target=bot)
+    futures = promote_staff_member(bot, user, chat, force=force)
+    if futures:
+        # The custom title fails for the same reason as the promotion
+        futures[0].add_done_callback(partial(_log_promotion_failure, bot, chat))
 
 
 def get_user_language(user: User) -> str:
@@ -184,16 +242,31 @@ def activate_group_language(group, user: User = None) -> None:
     if hasattr(group, "language"):
         lang = group.language
     else:
-        dbgroup = t_models.Group.objects.get(id=group.id)
-        lang = dbgroup.language
-    activate(lang)
+        cached_group = cache.groups.get(group.id)
+        lang = cached_group.language if cached_group is not None else None
+    # The groups which are not in the database, or have no language, use the default one
+    activate(lang or settings.LANGUAGE_CODE)
+
+
+def get_group_degrees(chat_id: int) -> list[int]:
+    """Get the IDs of the degrees a chat belongs to, as the main group of the degree
+    or as the group of one of its courses.
+
+    :param chat_id: the Telegram chat ID
+    :return: the IDs of the degrees, empty if the chat is not associated to any degree
+    """
+    return list(u_models.GroupDegree.objects.filter(group_id=chat_id).values_list("degree_id", flat=True))
 
 
 def get_permissions(user_id: int, chat_id: int) -> tuple[list[EventTypes | None], dict[str, bool], str | None]:
+    """Get the moderation permissions, the Telegram admin rights and the custom title of a user in a chat"""
+    return cache.permissions.get(user_id, chat_id, resolve_permissions)
+
+
+def resolve_permissions(user_id: int, chat_id: int) -> tuple[list[EventTypes | None], dict[str, bool], str | None]:
+    """Compute the permissions of a user in a chat from their roles, bypassing the cache"""
     BaseRole = apps.get_model("roles.BaseRole")
-    group_degrees: QuerySet[u_models.Degree] = u_models.Degree.objects.filter(
-        Q(courses__group_id=chat_id) | Q(group__id=chat_id)
-    )
+    group_degrees = get_group_degrees(chat_id)
     roles: PolymorphicQuerySet[BaseRole] = BaseRole.objects.filter(tg_user=user_id)
     if group_degrees:
         roles = roles.filter(Q(degrees__in=group_degrees) | Q(all_groups=True))
@@ -318,8 +391,7 @@ def format_user_info(dbuser):
 
 
 def generate_group_creation_message(group: telegram.Chat) -> str:
-    dbgroup = t_models.Group.objects.get(id=group.id)
-    dbdegree = u_models.Degree.objects.get(group_id=dbgroup.id)
+    dbdegree = u_models.GroupDegree.objects.select_related("degree").get(group_id=group.id, main=True).degree
     degree_type = ""
     for t in u_models.DEGREE_TYPES:
         if t[0] == dbdegree.type:
@@ -350,15 +422,15 @@ def generate_group_creation_message(group: telegram.Chat) -> str:
     return text
 
 
-def generate_admin_tagging_notification(sender, chat, roles, reply_to: Message) -> str:
-    admins = ""
-    for admin in {role.tg_user for role in roles}:
-        admins += f"{admin.generate_mention()} "
+def generate_admin_tagging_notification(sender, chat, admins, reply_to: Message) -> str:
+    mentions = ""
+    for admin in admins:
+        mentions += f"{admin.generate_mention()} "
     name = sender.username if sender.username else sender.first_name
     text = f"A user has tagged @admin\n"\
            f"👤 <b>Issuer</b>: {escape(name)} [<a href=\"tg://user?id={sender.id}\">{sender.id}</a>]\n"\
            f"👥 <b>Group</b>: {escape(chat.title)} [<a href=\"{chat.invite_link}\">{chat.id}</a>]\n"\
-           f"👮 <b>Please respond</b> {admins}"
+           f"👮 <b>Please respond</b> {mentions}"
     if reply_to is not None:
         text += f"\n<b>Target</b>: {escape(reply_to.from_user.name)} [<a href=\"tg://user?id={reply_to.from_user.id}\">{reply_to.from_user.id}</a>]"
         text += f"\n📜 <b>Message</b>: {reply_to.text}[<a href='https://t.me/c/1{str(reply_to.chat.id)[5:]}/{reply_to.message_id}'>{reply_to.message_id}</a>]"
@@ -0,0 +1,290 @@
+"""Ingestion of the Telegram updates outside of the webhook request.
+
+When settings.TELEGRAM_WEBHOOK_QUEUE is enabled the webhook view only stores the
+incoming update in the TelegramUpdate table and answers Telegram straight away.
+The `process_updates` management command then drains the table with a pool of
+workers; every chat is pinned to a single worker, so the updates of a chat are
+always processed in the order they were received.
+
+As an alternative to the webhook, the `run_bots` management command long-polls
+getUpdates for every bot (see BotPoller).
+"""
+import logging as logg
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+import telegram.error
+from django.db import close_old_connections, connection, transaction, DatabaseError
+from django.db.models import Q
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from telegrambot import bots, dedup, outbound
+from telegrambot.handlers.dispatcher import dispatch_telegram_update, get_dispatcher, ALLOWED_UPDATES
+from telegrambot.models import TelegramUpdate
+
+
+LOG = logg.getLogger(__name__)
+
+# Seconds after which an update claimed by a worker is considered abandoned, e.g. after a crash
+CLAIM_TIMEOUT = 300
+
+# The key of the Postgres advisory lock held by the process draining the queue
+FETCHER_LOCK = 0x7E1E_0001
+
+# Keys of a Telegram update which carry a chat object
+_CHAT_UPDATE_KEYS = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+    "chat_member",
+    "my_chat_member",
+    "chat_join_request",
+)
+
+
+def chat_id_of(json_update: dict) -> int | None:
+    """Get the ID of the chat an update belongs to, without deserializing it.
+
+    :param json_update: the update as received from Telegram
+    :return: the chat ID, the user ID for chat-less updates, or None
+    """
+    for key in _CHAT_UPDATE_KEYS:
+        if key in json_update:
+            return json_update[key].get("chat", {}).get("id")
+
+    if callback_query := json_update.get("callback_query"):
+        if message := callback_query.get("message"):
+            return message["chat"]["id"]
+        return callback_query["from"]["id"]
+    return None
+
+
+def enqueue(json_update: dict, bot_id: int) -> TelegramUpdate:
+    """Persist an update received from Telegram, to be processed later by the workers.
+
+    :param json_update: the update as received from Telegram
+    :param bot_id: the ID of the telegrambot.TelegramBot the update was sent to
+    :return: the queued update
+    """
+    return TelegramUpdate.objects.create(
+        bot_id=bot_id,
+        chat_id=chat_id_of(json_update),
+        payload=json_update,
+    )
+
+
+def depth() -> int:
+    """Return the number of updates waiting to be processed"""
+    return TelegramUpdate.objects.count()
+
+
+class UpdateQueueWorkers:
+    """A pool of threads draining the TelegramUpdate table.
+
+    A single fetcher claims the unclaimed updates in insertion order, skipping
+    the rows locked by the transactions of other pools, and routes every update
+    to the worker its chat is pinned to. An update is removed from the table only
+    after being processed, so a crash never loses updates: the updates claimed
+    and never removed are claimed again after CLAIM_TIMEOUT seconds, unless they
+    are still queued or being processed by this pool.
+
+    The order of the updates of a chat is only kept inside a pool, so only one
+    pool drains the queue at a time: run() waits for the FETCHER_LOCK advisory
+    lock, and the other pools stand by until its holder exits.
+    """
+    def __init__(self, workers: int = 4, batch_size: int = 100, poll_interval: float = 0.5):
+        self.workers = max(workers, 1)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+
+        self._queues: list[queue.Queue] = [queue.Queue(maxsize=batch_size) for _ in range(self.workers)]
+        self._processed = 0
+        self._stop = threading.Event()
+        # The IDs of the updates which are queued or being processed, never claimed again
+        self._in_flight: set[int] = set()
+        self._in_flight_lock = threading.Lock()
+
+    def _worker_for(self, update: TelegramUpdate) -> int:
+        key = update.chat_id if update.chat_id is not None else update.payload.get("update_id", 0)
+        return key % self.workers
+
+    def _work(self, updates: queue.Queue) -> None:
+        while True:
+            update: TelegramUpdate | None = updates.get()
+            if update is None:
+                return
+
+            try:
+                dispatch_telegram_update(update.payload, update.bot.token)
+            except Exception as e:
+                # Never retry an update that breaks the dispatcher, or it would block its chat forever
+                LOG.exception("Can't process the queued update %d: %s", update.id, e)
+
+            TelegramUpdate.objects.filter(id=update.id).delete()
+            with self._in_flight_lock:
+                self._in_flight.discard(update.id)
+            self._processed += 1
+            close_old_connections()
+
+    def _claim(self) -> list[TelegramUpdate]:
+        """Claim the next batch of unclaimed updates.
+        No cursor is kept: an update committed after a newer one is claimed by the next fetch.
+        """
+        now = datetime.now()
+        with self._in_flight_lock:
+            in_flight = list(self._in_flight)
+        with transaction.atomic():
+            updates = list(
+                TelegramUpdate.objects
+                .select_for_update(skip_locked=True, of=("self", ))
+                .filter(Q(claimed=None) | Q(claimed__lt=now - timedelta(seconds=CLAIM_TIMEOUT)))
+                .exclude(id__in=in_flight)
+                .select_related("bot")
+                .order_by("id")[:self.batch_size]
+            )
+            TelegramUpdate.objects.filter(id__in=[update.id for update in updates]).update(claimed=now)
+        with self._in_flight_lock:
+            self._in_flight.update(update.id for update in updates)
+        return updates
+
+    def _fetch(self) -> int:
+        updates = self._claim()
+        for update in updates:
+            self._queues[self._worker_for(update)].put(update)
+        return len(updates)
+
+    def _acquire_fetcher_lock(self) -> bool:
+        """Wait until this pool is the only one draining the queue; return False if stopped first.
+        The lock is held by the database session, so it's released when the process exits.
+        """
+        waiting = False
+        while not self._stop.is_set():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", [FETCHER_LOCK])
+                if cursor.fetchone()[0]:
+                    return True
+            if not waiting:
+                LOG.info("Another process is draining the update queue, standing by")
+                waiting = True
+            self._stop.wait(self.poll_interval * 10)
+        return False
+
+    def stats(self) -> dict[str, int]:
+        """Return the queue depth and the number of updates processed (or dropped as duplicates) by this pool"""
+        return {
+            "depth": depth(),
+            "in_flight": sum(q.qsize() for q in self._queues),
+            "processed": self._processed,
+            "duplicates": dedup.duplicates_dropped(),
+        }
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def run(self, report_interval: float = 60) -> None:
+        """Start the workers and drain the queue until stop() is called or the process is interrupted"""
+        if not self._acquire_fetcher_lock():
+            return
+
+        threads = [
+            threading.Thread(target=self._work, args=(q, ), name=f"update-worker-{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in threads:
+            thread.start()
+
+        last_report = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                if not self._fetch():
+                    self._stop.wait(self.poll_interval)
+
+                if time.monotonic() - last_report >= report_interval:
+                    LOG.info("Update queue: %(depth)d queued, %(in_flight)d in flight, %(processed)d processed "
+                             "(%(duplicates)d duplicates dropped)",
+                             self.stats())
+                    LOG.info("Bot API: %(requests)d requests, %(new_connections)d connections opened, "
+                             "%(pool_hits)d pooled connections reused, %(avg_latency_ms).1f ms average latency",
+                             bots.request_stats())
+                    last_report = time.monotonic()
+        finally:
+            for q in self._queues:
+                q.put(None)
+            for thread in threads:
+                thread.join()
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [FETCHER_LOCK])
+
+
+def process_batch(dispatcher: Dispatcher, updates: list[Update]) -> None:
+    """Process a batch of updates of the same bot inside a single database transaction.
+
+    Every update runs in its own savepoint: a database error only discards the
+    writes of the update which caused it, not the ones of the whole batch (the
+    error handler stops the other handlers of the update, see
+    handlers.errors.telegram_error_handler). The Bot API calls submitted to
+    telegrambot.outbound are held until the transaction is over.
+    """
+    with outbound.deferred(), transaction.atomic():
+        for update in updates:
+            try:
+                with transaction.atomic():
+                    dispatcher.process_update(update)
+            except DatabaseError as e:
+                LOG.exception("Database error while processing update %d: %s", update.update_id, e)
+
+
+class BotPoller(threading.Thread):
+    """Long-poll getUpdates for a bot and process every batch of updates as soon as it's received"""
+    def __init__(self, token: str, stop: threading.Event, timeout: int = 30, limit: int = 100):
+        super().__init__(name=f"poller-{token.split(':')[0]}", daemon=True)
+        self.token = token
+        self.timeout = timeout
+        self.limit = limit
+        self.processed = 0
+        self._stop_event = stop
+
+    def run(self) -> None:
+        dispatcher = get_dispatcher(self.token)
+        bot = dispatcher.bot
+        try:
+            # getUpdates doesn't work while a webhook is set
+            bot.delete_webhook()
+        except telegram.error.TelegramError as e:
+            LOG.error("Can't start polling for bot %s: %s", self.name, e.message)
+            return
+
+        offset = None
+        while not self._stop_event.is_set():
+            try:
+                updates = bot.get_updates(
+                    offset=offset,
+                    limit=self.limit,
+                    timeout=self.timeout,
+                    allowed_updates=ALLOWED_UPDATES,
+                )
+            except telegram.error.RetryAfter as e:
+                self._stop_event.wait(e.retry_after)
+                continue
+            except (telegram.error.Unauthorized, telegram.error.InvalidToken) as e:
+                LOG.error("Stopped polling for bot %s: %s", self.name, e.message)
+                return
+            except (telegram.error.TimedOut, telegram.error.NetworkError):
+                self._stop_event.wait(1)
+                continue
+
+            if not updates:
+                continue
+
+            try:
+                process_batch(dispatcher, updates)
+            except Exception as e:
+                LOG.exception("Can't process a batch of %d updates: %s", len(updates), e)
+            # Never fetch a batch again, even if it failed: it would fail again forever
+            offset = updates[-1].update_id + 1
+            self.processed += len(updates)
+            close_old_connections()
@@ -0,0 +1,188 @@
+"""Background jobs which carry out an action on a user in many groups of the network.
+
+Creating a job only writes a NetworkJob row and one NetworkJobGroup row per
+group, then schedules the run_network_job background task. The task works on
+the groups of every bot in a separate thread, paced to
+settings.TELEGRAM_NETWORK_JOB_RATE calls per second per bot, and waits when
+Telegram answers with RetryAfter or can't be reached. Every group is marked
+as done or failed as soon as it's processed, so the progress is visible in
+the admin and an interrupted job resumes from the groups still pending. The
+progress of the superban and superfree jobs is also reported in the log chat.
+"""
+import threading
+import time
+from datetime import datetime
+from itertools import groupby
+from typing import Callable, Iterable
+
+import telegram
+from django.conf import settings
+from django.db import connection, transaction
+
+from telegrambot import bots, logging, outbound
+from telegrambot.handlers.utils import promote_staff_member, FREE_PERMISSIONS
+from telegrambot.outbound import Priority
+from telegrambot.models import (
+    User as DBUser,
+    Group as DBGroup,
+    NetworkJob,
+    NetworkJobGroup,
+)
+
+
+# Maximum number of attempts in a group, when Telegram keeps answering with RetryAfter or can't be reached
+MAX_ATTEMPTS = 5
+# Seconds to wait before retrying a call which failed because of the network, doubled at every attempt
+NETWORK_RETRY_DELAY = 2
+
+
+def _set_admin_rights(bot: telegram.Bot, job: NetworkJob, group: DBGroup) -> None:
+    # The roles have just changed, in another process: the cached permissions may be stale
+    for future in promote_staff_member(bot, job.target, group, force=True, cached=False):
+        future.result()
+
+
+def _superban(bot: telegram.Bot, job: NetworkJob, group: DBGroup) -> None:
+    outbound.call(bot, "ban_chat_member", Priority.MODERATION, chat_id=group.id, user_id=job.target_id)
+
+
+def _superfree(bot: telegram.Bot, job: NetworkJob, group: DBGroup) -> None:
+    # Unbanning a user who is not banned is a no-op, so the action can be safely retried
+    outbound.call(bot, "unban_chat_member", Priority.MODERATION, chat_id=group.id, user_id=job.target_id,
+                  only_if_banned=True)
+    outbound.call(bot, "restrict_chat_member", Priority.MODERATION, chat_id=group.id, user_id=job.target_id,
+                  permissions=FREE_PERMISSIONS)
+
+
+# The action carried out in every group, for each kind of job
+ACTIONS: dict[str, Callable[[telegram.Bot, NetworkJob, DBGroup], None]] = {
+    NetworkJob.Kinds.SET_ADMIN_RIGHTS: _set_admin_rights,
+    NetworkJob.Kinds.SUPERBAN: _superban,
+    NetworkJob.Kinds.SUPERFREE: _superfree,
+}
+
+# The event of the jobs whose progress is reported in the log chat
+LOGGED_EVENTS: dict[str, logging.EventTypes] = {
+    NetworkJob.Kinds.SUPERBAN: logging.MODERATION_SUPERBAN,
+    NetworkJob.Kinds.SUPERFREE: logging.MODERATION_SUPERFREE,
+}
+
+
+def enqueue(kind: NetworkJob.Kinds, target: DBUser, groups: Iterable[DBGroup]) -> NetworkJob | None:
+    """Create a job and schedule it once the current transaction is committed.
+
+    :param kind: the kind of the job
+    :param target: the user the job is about
+    :param groups: the groups where the job has to be carried out
+    :return: the created NetworkJob, or None if there are no groups
+    """
+    group_ids = {group.id for group in groups}
+    if not group_ids:
+        return None
+
+    with transaction.atomic():
+        job = NetworkJob.objects.create(kind=kind, target=target)
+        NetworkJobGroup.objects.bulk_create([
+            NetworkJobGroup(job=job, group_id=group_id) for group_id in sorted(group_ids)
+        ])
+
+    from telegrambot.tasks import run_network_job  # the tasks module can't be imported while loading the models
+    transaction.on_commit(lambda: run_network_job(job.id))
+    return job
+
+
+class _BotWorker:
+    """Carry out a job in the groups of a single bot, one group at a time"""
+    def __init__(self, job: NetworkJob, bot_id: int | None, rows: list[NetworkJobGroup]):
+        self.job = job
+        self.bot_id = bot_id
+        self.rows = rows
+        self.interval = 1 / settings.TELEGRAM_NETWORK_JOB_RATE
+
+    def _finish(self, row: NetworkJobGroup, status: NetworkJobGroup.Statuses, error: str = None) -> None:
+        row.status = status
+        row.error = error
+        row.save(update_fields=["status", "attempts", "error"])
+        if self.job.kind in LOGGED_EVENTS:
+            logging.log_job_group(LOGGED_EVENTS[self.job.kind], self.job.id, row.group, error)
+
+    def run(self) -> None:
+        token = bots.get_token(self.bot_id) if self.bot_id is not None else None
+        if token is None:
+            for row in self.rows:
+                self._finish(row, NetworkJobGroup.Statuses.FAILED, "The group has no authorized bot")
+            return
+
+        bot = bots.get_bot(token)
+        action = ACTIONS[self.job.kind]
+        for row in self.rows:
+            self._process(bot, action, row)
+
+    def run_in_thread(self) -> None:
+        try:
+            self.run()
+        finally:
+            connection.close()
+
+    def _process(self, bot: telegram.Bot, action, row: NetworkJobGroup) -> None:
+        while True:
+            row.attempts += 1
+            started = time.monotonic()
+            try:
+                action(bot, self.job, row.group)
+            except telegram.error.RetryAfter as e:
+                if row.attempts >= MAX_ATTEMPTS:
+                    self._finish(row, NetworkJobGroup.Statuses.FAILED, str(e))
+                    return
+                time.sleep(e.retry_after)
+                continue
+            except telegram.error.BadRequest as e:
+                self._finish(row, NetworkJobGroup.Statuses.FAILED, e.message)
+            except telegram.error.NetworkError as e:
+                # Also TimedOut; BadRequest is a NetworkError too, but retrying it is pointless
+                if row.attempts >= MAX_ATTEMPTS:
+                    self._finish(row, NetworkJobGroup.Statuses.FAILED, e.message)
+                    return
+                time.sleep(NETWORK_RETRY_DELAY * 2 ** (row.attempts - 1))
+                continue
+            except telegram.error.TelegramError as e:
+                self._finish(row, NetworkJobGroup.Statuses.FAILED, e.message)
+            else:
+                self._finish(row, NetworkJobGroup.Statuses.DONE)
+
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+            return
+
+
+def run(job_id: int) -> NetworkJob:
+    """Carry out a job in all its pending groups, with a thread per bot"""
+    job = NetworkJob.objects.select_related("target").get(id=job_id)
+    job.status = NetworkJob.Statuses.RUNNING
+    job.started = job.started or datetime.now()
+    job.save(update_fields=["status", "started"])
+
+    rows = job.groups.filter(status=NetworkJobGroup.Statuses.PENDING)\
+        .select_related("group")\
+        .order_by("group__bot_id", "group_id")
+    workers = [
+        _BotWorker(job, bot_id, list(bot_rows))
+        for bot_id, bot_rows in groupby(rows, key=lambda row: row.group.bot_id)
+    ]
+    threads = [
+        threading.Thread(target=worker.run_in_thread, name=f"network-job-{job.id}-{worker.bot_id}")
+        for worker in workers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    failed = job.groups.filter(status=NetworkJobGroup.Statuses.FAILED).count()
+    job.status = NetworkJob.Statuses.FAILED if failed else NetworkJob.Statuses.DONE
+    job.finished = datetime.now()
+    job.save(update_fields=["status", "finished"])
+
+    if job.kind in LOGGED_EVENTS:
+        done = job.groups.filter(status=NetworkJobGroup.Statuses.DONE).count()
+        logging.log_job_report(LOGGED_EVENTS[job.kind], job.id, job.target, done, failed)
+    return job
@@ -1,11 +1,23 @@
+import atexit
+import logging as logg
+import threading
+import time
+from concurrent.futures import Future
 from datetime import datetime
+from functools import partial
 from enum import Enum
 
-import telegram
 from telegram import Message, Chat
 from django.conf import settings
+from django.db import transaction, close_old_connections
 from django.utils.translation import gettext_lazy as _
 
+from telegrambot import bots, outbound
+from telegrambot.outbound import Priority
+
+
+LOG = logg.getLogger(__name__)
+
 
 class EventTypes(Enum):
     CHAT_DOES_NOT_EXIST = 0, '❗️', None
@@ -51,6 +63,12 @@ USER_CALLED_ADMIN = EventTypes.USER_CALLED_ADMIN
 MODERATION_DEL = EventTypes.MODERATION_DEL
 BROADCAST = EventTypes.BROADCAST
 
+# Frequent, low-severity events: their lines are sent together in a single message, see LogShipper
+COALESCED_EVENTS = (
+    EventTypes.USER_JOINED,
+    EventTypes.USER_LEFT,
+)
+
 
 def _normalize_group_id(group_id) -> str:
     if not group_id:
@@ -83,19 +101,39 @@ def _format_user(user) -> str:
     return f"{text} {_normalize_user_id(getattr(user, 'id'))}"
 
 
-def prepare(msg: Message = None) -> Message:
+def _copy_result(source: Future, destination: Future) -> None:
+    if source.exception() is not None:
+        destination.set_exception(source.exception())
+    else:
+        destination.set_result(source.result())
+
+
+def prepare(msg: Message = None) -> Future:
     """Prepare a log entry before executing an action.
     Useful for commands like /del to log the deleted message before it disappears.
+    The calls are only submitted, so the caller never waits for the log chat.
 
     :param msg: the message that prompted the action
-    :return: a message to pass to log
+    :return: a Future with the message to edit, resolved once msg has been forwarded too: pass it to log,
+             and delete msg only when it's done
     """
-    bot = telegram.Bot(settings.LOGGING_BOT_TOKEN)
-    sent_msg: Message = bot.send_message(chat_id=settings.LOGGING_CHAT_ID, text="...", parse_mode="html")
+    # The placeholder is sent now: the collected lines of the previous events must come first
+    shipper.flush()
+    bot = bots.get_bot(settings.LOGGING_BOT_TOKEN)
+    entry: Future = outbound.submit(
+        bot, "send_message", Priority.LOG,
+        chat_id=settings.LOGGING_CHAT_ID, text="...", parse_mode="html",
+    )
+    if not msg:
+        return entry
 
-    if msg:
-        msg.forward(chat_id=settings.LOGGING_CHAT_ID)
-    return sent_msg
+    forward = outbound.submit(
+        bot, "forward_message", Priority.LOG,
+        chat_id=settings.LOGGING_CHAT_ID, from_chat_id=msg.chat_id, message_id=msg.message_id,
+    )
+    prepared = Future()
+    forward.add_done_callback(lambda _: entry.add_done_callback(lambda _: _copy_result(entry, prepared)))
+    return prepared
 
 
 def log_db_save(
@@ -108,30 +146,134 @@ def log_db_save(
         msg: Message = None,
         msg_deleted: bool = None,
 ) -> None:
-    """Save event onto DB"""
-    from telegrambot.models import (
-        TelegramLog,
-        User as DBUser,
-        Group as DBGroup,
-    )  # Circular import
-
-    db_log = TelegramLog()
-    db_log.event = event.value[0]
-    db_log.timestamp = datetime.now()
-    if chat:
-        db_log.chat = DBGroup.objects.get(id=chat.id)
-    if target:
-        db_log.target = DBUser.objects.get(id=target.id)
-    if issuer:
-        db_log.issuer = DBUser.objects.get(id=issuer.id)
-    if reason:
-        db_log.reason = reason
-    if error_message and not reason:
-        db_log.reason = error_message
-    if msg:
-        db_log.message = msg.text_markdown_v2
-        db_log.message_deleted = bool(msg_deleted)
-    db_log.save()
+    """Save event onto DB, in bulk with the other events of the same flush window (see LogWriter).
+    The event is only recorded when the current transaction commits: the events of an update
+    which is rolled back are never saved.
+    """
+    transaction.on_commit(partial(
+        writer.add,
+        event.value[0],
+        chat_id=chat.id if chat else None,
+        target=target,
+        issuer=issuer,
+        reason=reason or error_message or None,
+        message=msg.text_markdown_v2 if msg else None,
+        message_deleted=bool(msg_deleted) if msg else None,
+    ))
+
+
+class LogWriter:
+    """Collect the TelegramLog rows and save them with a single bulk INSERT,
+    every settings.TELEGRAM_LOG_DB_INTERVAL seconds or TELEGRAM_LOG_DB_SIZE events.
+
+    The rows reference the chat, the target and the issuer by ID. The users which
+    may not be in the database yet are saved as stubs with a single
+    INSERT ... ON CONFLICT DO NOTHING; the chats which are not in the database
+    (according to telegrambot.cache) are not referenced. If the INSERT fails
+    anyway, the rows are saved one by one, so only the bad ones are lost.
+    """
+    def __init__(self, flush_interval: float, flush_size: int):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+
+        self._rows: list[dict] = []
+        self._users: dict[int, tuple] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer: threading.Thread | None = None
+
+    def _user_id(self, user) -> int | None:
+        """Return the ID of a telegrambot.User or of a Telegram user, remembering it as a stub"""
+        if user is None:
+            return None
+        self._users[user.id] = (user.first_name, user.last_name, user.username)
+        return user.id
+
+    def add(self, event: int, chat_id: int | None, target=None, issuer=None, **fields) -> None:
+        """Record an event.
+
+        :param event: the TelegramLog.Events value
+        :param chat_id: the Telegram chat ID
+        :param target: the target, a telegrambot.User or a Telegram user
+        :param issuer: the issuer, a telegrambot.User or a Telegram user
+        :param fields: the other TelegramLog fields
+        """
+        with self._lock:
+            self._rows.append(dict(
+                event=event,
+                timestamp=datetime.now(),
+                chat_id=chat_id,
+                target_id=self._user_id(target),
+                issuer_id=self._user_id(issuer),
+                **fields,
+            ))
+            full = len(self._rows) >= self.flush_size
+
+        self._start_timer()
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        """Save all the recorded events"""
+        from telegrambot import cache
+        from telegrambot.models import TelegramLog, User as DBUser  # Circular import
+
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                users, self._users = self._users, {}
+            if not rows:
+                return
+
+            for row in rows:
+                if row["chat_id"] is not None and cache.groups.get(row["chat_id"]) is None:
+                    row["chat_id"] = None
+            try:
+                # The stubs are kept even if some log rows are bad
+                if users:
+                    DBUser.objects.bulk_create([
+                        DBUser(id=user_id, first_name=first_name or "", last_name=last_name, username=username)
+                        for user_id, (first_name, last_name, username) in sorted(users.items())
+                    ], ignore_conflicts=True)
+                with transaction.atomic():
+                    TelegramLog.objects.bulk_create([TelegramLog(**row) for row in rows])
+            except Exception as e:
+                LOG.warning("Can't save %d log events at once, saving them one by one: %s", len(rows), e)
+                self._save_one_by_one(rows)
+
+    @staticmethod
+    def _save_one_by_one(rows: list[dict]) -> None:
+        from telegrambot.models import TelegramLog  # Circular import
+
+        for row in rows:
+            try:
+                with transaction.atomic():
+                    TelegramLog.objects.create(**row)
+            except Exception as e:
+                LOG.exception("Can't save the log event %r: %s", row, e)
+
+    def _start_timer(self) -> None:
+        if self._timer is not None:
+            return
+
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Thread(target=self._run_timer, name="log-writer", daemon=True)
+            self._timer.start()
+
+    def _run_timer(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+            close_old_connections()
+
+
+writer = LogWriter(
+    flush_interval=settings.TELEGRAM_LOG_DB_INTERVAL,
+    flush_size=settings.TELEGRAM_LOG_DB_SIZE,
+)
+atexit.register(writer.flush)
 
 
 def log(
@@ -143,7 +285,7 @@ def log(
         bot=None,
         msg: Message = None,
         target_message_deleted: bool = None,
-        prepared_entry: Message = None,
+        prepared_entry: Future = None,
         **kwargs
 ) -> None:
     """Log an event to the log chat.
@@ -222,11 +364,123 @@ def log(
     if msg:
         text += f"\n📜 <b>Message</b>: <i>see below</i>"
 
-    bot = telegram.Bot(settings.LOGGING_BOT_TOKEN)
-    if not prepared_entry:
-        bot.send_message(chat_id=settings.LOGGING_CHAT_ID, text=text, parse_mode="html")
+    if event in COALESCED_EVENTS and not prepared_entry and not msg:
+        shipper.add(text)
     else:
-        prepared_entry.edit_text(text=text, parse_mode="html")
+        shipper.ship(text, prepared_entry=prepared_entry, forward=None if prepared_entry else msg)
+
+
+def log_job_group(event: EventTypes, job_id: int, group, error: str = None) -> None:
+    """Report the outcome of a network job in a group to the log chat.
+    The lines are sent together with the other collected ones, see LogShipper.
+
+    :param event: the event of the job, e.g. MODERATION_SUPERBAN
+    :param job_id: the NetworkJob ID
+    :param group: the group
+    :param error: why the job failed in the group, or None if it succeeded
+    """
+    text = f"{'✅' if error is None else '❌'} #{event.name} #job_{job_id}\n👥 <b>Group</b>: {_format_chat(group)}"
+    if error is not None:
+        text += f"\n💬 <b>Error</b>: {error}"
+    shipper.add(text)
+
+
+def log_job_report(event: EventTypes, job_id: int, target, done: int, failed: int) -> None:
+    """Report the end of a network job to the log chat"""
+    shipper.ship(
+        f"{event.value[1]} #{event.name} #job_{job_id} completed"
+        f"\n👤 <b>Target user</b>: {_format_user(target)}"
+        f"\n📊 <b>Groups</b>: {done} done, {failed} failed"
+    )
+
+
+class LogShipper:
+    """Send the lines of the log chat in background, through telegrambot.outbound.
+
+    The lines of the COALESCED_EVENTS are collected and sent together, in
+    messages of up to 4096 characters, every settings.TELEGRAM_LOG_BATCH_INTERVAL
+    seconds. Any other line is sent immediately, after the lines collected until
+    then, so that the log chat always shows the events in order.
+    """
+    MAX_LENGTH = 4096
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lines: list[str] = []
+        self._length = 0
+        self._lock = threading.Lock()
+        self._timer: threading.Thread | None = None
+
+    def _bot(self):
+        return bots.get_bot(settings.LOGGING_BOT_TOKEN)
+
+    def _send(self, text: str) -> None:
+        outbound.submit(self._bot(), "send_message", Priority.LOG,
+                        chat_id=settings.LOGGING_CHAT_ID, text=text, parse_mode="html")
+
+    def _edit(self, text: str, prepared_entry: Future) -> None:
+        if prepared_entry.exception() is not None:
+            # The placeholder message couldn't be sent
+            self._send(text)
+            return
+        entry: Message = prepared_entry.result()
+        outbound.submit(self._bot(), "edit_message_text", Priority.LOG, chat_id=entry.chat_id,
+                        message_id=entry.message_id, text=text, parse_mode="html")
+
+    def _flush_locked(self) -> None:
+        if self._lines:
+            self._send("\n\n".join(self._lines))
+            self._lines, self._length = [], 0
+
+    def add(self, text: str) -> None:
+        """Collect a line, to be sent with the other collected lines"""
+        with self._lock:
+            if self._lines and self._length + len(text) + 2 > self.MAX_LENGTH:
+                self._flush_locked()
+            self._lines.append(text)
+            self._length += len(text) + 2
+        self._start_timer()
+
+    def ship(self, text: str, prepared_entry: Future = None, forward: Message = None) -> None:
+        """Send a line immediately, after the collected ones.
+
+        :param text: the text of the line
+        :param prepared_entry: the Future of the message to edit with the text, instead of sending a new one
+        :param forward: a message to forward after the line
+        """
+        with self._lock:
+            self._flush_locked()
+            bot = self._bot()
+            if prepared_entry is None:
+                self._send(text)
+            else:
+                prepared_entry.add_done_callback(partial(self._edit, text))
+            if forward is not None:
+                outbound.submit(
+                    bot, "forward_message", Priority.LOG,
+                    chat_id=settings.LOGGING_CHAT_ID, from_chat_id=forward.chat_id, message_id=forward.message_id,
+                )
+
+    def flush(self) -> None:
+        """Send the collected lines"""
+        with self._lock:
+            self._flush_locked()
+
+    def _start_timer(self) -> None:
+        if self._timer is not None:
+            return
+
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Thread(target=self._run_timer, name="log-shipper", daemon=True)
+            self._timer.start()
+
+    def _run_timer(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
 
-    if msg and not prepared_entry:
-        msg.forward(chat_id=settings.LOGGING_CHAT_ID)
+shipper = LogShipper(interval=settings.TELEGRAM_LOG_BATCH_INTERVAL)
+atexit.register(shipper.flush)
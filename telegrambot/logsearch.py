@@ -0,0 +1,135 @@
+"""Search and keyset pagination of the TelegramLog rows, for the admin and the staff API and export.
+
+The search never joins the users and groups tables to the log: numeric terms
+match the chat, target and issuer IDs, "@username" terms match the users with
+that username, any other term is looked up in the users names and in the
+groups titles first, and in reason and message with the full-text index.
+
+Pages are ordered by (timestamp, id), newest first, and the next page starts
+after a cursor: the (timestamp, id) of the last row, so no page costs an OFFSET.
+"""
+import re
+from datetime import datetime
+
+from django.contrib.postgres.search import SearchQuery, SearchVector
+from django.db.models import Q, QuerySet
+
+from telegrambot.models import (
+    User as DBUser,
+    Group as DBGroup,
+    TelegramLog,
+)
+
+
+# The full-text vector of reason and message; it must match the index created by migration 0032
+TEXT = SearchVector("reason", "message", config="simple")
+
+# The query string parameter with the cursor
+CURSOR_VAR = "before"
+
+# Maximum number of users or groups a text term is expanded to
+_MAX_MATCHES = 500
+
+_ID_RE = re.compile(r"^-?\d+$")
+
+# The query string parameters of filter_logs and the fields they filter
+_FILTERS = {"chat": "chat_id", "target": "target_id", "issuer": "issuer_id"}
+
+
+def _matching_ids(queryset: QuerySet) -> list[int]:
+    return list(queryset.values_list("id", flat=True)[:_MAX_MATCHES])
+
+
+def parse_event(value: str) -> int:
+    """Parse an event filter: a TelegramLog.Events value or name, e.g. 3 or moderation_ban.
+    Raise ValueError if it's unknown.
+    """
+    value = value.strip()
+    if _ID_RE.match(value):
+        return TelegramLog.Events(int(value)).value
+    try:
+        return TelegramLog.Events[value.upper()].value
+    except KeyError:
+        raise ValueError(f"Unknown event: {value}")
+
+
+def search(queryset: QuerySet, term: str) -> QuerySet:
+    """Filter the log rows matching a search term.
+
+    :param queryset: the TelegramLog rows
+    :param term: an ID, a @username or some text
+    :return: the filtered rows
+    """
+    term = term.strip()
+    if not term:
+        return queryset
+
+    if _ID_RE.match(term):
+        value = int(term)
+        return queryset.filter(Q(chat_id=value) | Q(target_id=value) | Q(issuer_id=value))
+
+    if term.startswith("@"):
+        user_ids = _matching_ids(DBUser.objects.filter(username__iexact=term[1:]))
+        return queryset.filter(Q(target_id__in=user_ids) | Q(issuer_id__in=user_ids))
+
+    user_ids = _matching_ids(DBUser.objects.filter(
+        Q(first_name__icontains=term) | Q(last_name__icontains=term) | Q(username__icontains=term)
+    ))
+    chat_ids = _matching_ids(DBGroup.objects.filter(title__icontains=term))
+    return queryset.alias(text=TEXT).filter(
+        Q(text=SearchQuery(term, config="simple")) |
+        Q(target_id__in=user_ids) | Q(issuer_id__in=user_ids) | Q(chat_id__in=chat_ids)
+    )
+
+
+def filter_logs(queryset: QuerySet, params) -> QuerySet:
+    """Filter the log rows by the query string parameters of the staff API:
+    - chat, target, issuer: IDs;
+    - user: the ID of the target or of the issuer;
+    - event: one or more comma-separated TelegramLog.Events values or names;
+    - since, until: ISO dates or datetimes, until excluded;
+    - q: a search term, see search.
+    Raise ValueError if a parameter is malformed.
+    """
+    for param, field in _FILTERS.items():
+        if params.get(param):
+            queryset = queryset.filter(**{field: int(params[param])})
+    if params.get("user"):
+        user_id = int(params["user"])
+        queryset = queryset.filter(Q(target_id=user_id) | Q(issuer_id=user_id))
+    if params.get("event"):
+        queryset = queryset.filter(event__in=[parse_event(event) for event in params["event"].split(",")])
+    if params.get("since"):
+        queryset = queryset.filter(timestamp__gte=datetime.fromisoformat(params["since"]))
+    if params.get("until"):
+        queryset = queryset.filter(timestamp__lt=datetime.fromisoformat(params["until"]))
+    return search(queryset, params.get("q", ""))
+
+
+def encode_cursor(timestamp: datetime, id_: int) -> str:
+    return f"{timestamp.isoformat()}_{id_}"
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Parse a cursor; raise ValueError if it's malformed"""
+    timestamp, id_ = cursor.rsplit("_", 1)
+    return datetime.fromisoformat(timestamp), int(id_)
+
+
+def page(queryset: QuerySet, cursor: str | None, size: int) -> tuple[list, str | None]:
+    """Get a page of log rows, newest first.
+
+    :param queryset: the TelegramLog rows
+    :param cursor: where the page starts (None: from the newest row), see encode_cursor
+    :param size: the maximum number of rows
+    :return: the rows and the cursor of the next page, or None if this is the last one
+    """
+    if cursor:
+        timestamp, id_ = decode_cursor(cursor)
+        queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=id_))
+
+    rows = list(queryset.order_by("-timestamp", "-id")[:size + 1])
+    if len(rows) <= size:
+        return rows, None
+    rows = rows[:size]
+    return rows, encode_cursor(rows[-1].timestamp, rows[-1].id)
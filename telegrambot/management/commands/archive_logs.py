@@ -0,0 +1,35 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from telegrambot import partitions
+
+
+class Command(BaseCommand):
+    help = "Export the monthly TelegramLog partitions older than the retention period to gzipped NDJSON " \
+           "files, then drop them"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--months", type=int, default=settings.TELEGRAM_LOG_RETENTION_MONTHS,
+                            help="Number of months to keep, including the current one")
+        parser.add_argument("--directory", type=Path, default=settings.TELEGRAM_LOG_ARCHIVE_DIR,
+                            help="Where the archives are written")
+        parser.add_argument("--dry-run", action="store_true", help="Only list the partitions to archive")
+
+    def handle(self, *args, **options):
+        if options["months"] < 1:
+            raise CommandError("The retention period must be at least one month (see TELEGRAM_LOG_RETENTION_MONTHS)")
+
+        expired = partitions.expired_partitions(options["months"])
+        if not expired:
+            self.stdout.write("No partitions to archive")
+            return
+
+        for partition in expired:
+            if options["dry_run"]:
+                self.stdout.write(f"Would archive {partition.name}")
+                continue
+            count = partitions.archive_partition(partition, options["directory"])
+            self.stdout.write(f"Archived {count} events of {partition.name} "
+                              f"to {options['directory'] / partition.archive_name}")
@@ -0,0 +1,19 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from telegrambot import partitions
+
+
+class Command(BaseCommand):
+    help = "Load TelegramLog archives written by archive_logs back into the database, e.g. for an audit"
+
+    def add_arguments(self, parser):
+        parser.add_argument("archives", nargs="+", type=Path, help="The .ndjson.gz archives to import")
+
+    def handle(self, *args, **options):
+        for path in options["archives"]:
+            if not path.exists():
+                raise CommandError(f"{path} does not exist")
+            count = partitions.import_archive(path)
+            self.stdout.write(f"Imported {count} events from {path}")
@@ -0,0 +1,31 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from telegrambot import expiry
+
+
+class Command(BaseCommand):
+    help = "Delete the expired messages of the bots in bulk (see telegrambot.expiry)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds between two reads of the scheduled deletions")
+        parser.add_argument("--report-interval", type=float, default=60,
+                            help="Seconds between two reports of the deletions lag")
+        parser.add_argument("--lag", action="store_true",
+                            help="Only print how many seconds the expired messages are waiting to be deleted")
+
+    def handle(self, *args, **options):
+        if options["lag"]:
+            self.stdout.write(f"{expiry.lag():.1f}")
+            return
+
+        scheduler = expiry.DeletionScheduler(poll_interval=options["poll_interval"])
+        signal.signal(signal.SIGTERM, lambda *_: scheduler.stop())
+        self.stdout.write(f"Processing the scheduled deletions (lag: {expiry.lag():.1f} s)")
+        try:
+            scheduler.run(report_interval=options["report_interval"])
+        except KeyboardInterrupt:
+            scheduler.stop()
+        self.stdout.write(f"Stopped, {scheduler.deleted} messages deleted")
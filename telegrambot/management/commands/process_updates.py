@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from telegrambot.ingestion import UpdateQueueWorkers
+
+
+class Command(BaseCommand):
+    help = "Process the Telegram updates queued by the webhook (see TELEGRAM_WEBHOOK_QUEUE)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=settings.TELEGRAM_WEBHOOK_QUEUE_WORKERS,
+                            help="Number of workers; every chat is always processed by the same worker")
+        parser.add_argument("--batch-size", type=int, default=100,
+                            help="Maximum number of updates fetched from the queue at once")
+
+    def handle(self, *args, **options):
+        workers = UpdateQueueWorkers(workers=options["workers"], batch_size=options["batch_size"])
+        stats = workers.stats()
+        self.stdout.write(f"Processing the update queue with {workers.workers} workers "
+                          f"({stats['depth']} updates queued)")
+        try:
+            workers.run()
+        except KeyboardInterrupt:
+            workers.stop()
+        self.stdout.write(f"Stopped, {workers.stats()['processed']} updates processed")
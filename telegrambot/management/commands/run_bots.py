@@ -0,0 +1,41 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from telegrambot import bots
+from telegrambot.ingestion import BotPoller
+
+
+class Command(BaseCommand):
+    help = "Receive the updates of every bot by long polling getUpdates, instead of the webhook. " \
+           "Starting this command deletes the webhook of all the bots."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--timeout", type=int, default=30,
+                            help="Long polling timeout, in seconds")
+        parser.add_argument("--limit", type=int, default=100,
+                            help="Maximum number of updates fetched (and processed in a transaction) at once")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+        pollers = [
+            BotPoller(token, stop, timeout=options["timeout"], limit=options["limit"])
+            for token in bots.all_tokens()
+        ]
+        for poller in pollers:
+            poller.start()
+        self.stdout.write(f"Polling updates for {len(pollers)} bots")
+
+        try:
+            while any(poller.is_alive() for poller in pollers):
+                for poller in pollers:
+                    poller.join(timeout=1)
+        except KeyboardInterrupt:
+            stop.set()
+
+        for poller in pollers:
+            poller.join()
+        self.stdout.write(f"Stopped, {sum(poller.processed for poller in pollers)} updates processed")
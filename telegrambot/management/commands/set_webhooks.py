@@ -0,0 +1,28 @@
+import telegram
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from telegrambot import bots
+from telegrambot.handlers.dispatcher import ALLOWED_UPDATES
+
+
+class Command(BaseCommand):
+    help = "Set the webhook of every authorized bot, authenticated with the secret token header"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default=f"{settings.REAL_HOST}/telegrambot/",
+                            help="The webhook URL (default: %(default)s)")
+
+    def handle(self, *args, **options):
+        for token in bots.all_tokens():
+            bot = telegram.Bot(token)
+            try:
+                bot.set_webhook(
+                    url=options["url"],
+                    allowed_updates=ALLOWED_UPDATES,
+                    api_kwargs={"secret_token": bots.webhook_secret(token)},
+                )
+            except telegram.error.TelegramError as e:
+                self.stderr.write(f"Can't set the webhook of bot {token.split(':')[0]}: {e.message}")
+                continue
+            self.stdout.write(f"Webhook set for bot {token.split(':')[0]}")
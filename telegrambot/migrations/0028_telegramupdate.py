@@ -0,0 +1,30 @@
+# Generated by Django 3.2.9 on 2026-10-18 07:44
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0027_auto_20231022_1324'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelegramUpdate',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('chat_id', models.BigIntegerField(blank=True, null=True, verbose_name='chat ID')),
+                ('payload', models.JSONField(verbose_name='payload')),
+                ('received', models.DateTimeField(default=datetime.datetime.now, verbose_name='received')),
+                ('bot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='queued_updates', to='telegrambot.telegrambot')),
+            ],
+            options={
+                'verbose_name': 'Queued Telegram update',
+                'verbose_name_plural': 'Queued Telegram updates',
+                'ordering': ['id'],
+            },
+        ),
+    ]
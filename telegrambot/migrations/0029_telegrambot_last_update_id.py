@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2026-10-18 07:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0028_telegramupdate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='telegrambot',
+            name='last_update_id',
+            field=models.BigIntegerField(blank=True, help_text='High-water mark of the processed updates, used to drop the updates delivered twice', null=True, verbose_name='last update ID'),
+        ),
+    ]
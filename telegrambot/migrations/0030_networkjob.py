@@ -0,0 +1,48 @@
+# Generated by Django 3.2.9 on 2026-10-18 08:00
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0029_telegrambot_last_update_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NetworkJob',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('AR', 'Set admin rights')], max_length=2, verbose_name='kind')),
+                ('status', models.CharField(choices=[('P', 'Pending'), ('R', 'Running'), ('D', 'Done'), ('F', 'Done with errors')], default='P', max_length=1, verbose_name='status')),
+                ('created', models.DateTimeField(default=datetime.datetime.now, verbose_name='created')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='started')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='finished')),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='network_jobs', to='telegrambot.user')),
+            ],
+            options={
+                'verbose_name': 'Network job',
+                'verbose_name_plural': 'Network jobs',
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='NetworkJobGroup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('P', 'Pending'), ('D', 'Done'), ('F', 'Failed')], default='P', max_length=1, verbose_name='status')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='attempts')),
+                ('error', models.TextField(blank=True, null=True, verbose_name='error')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='telegrambot.group')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='groups', to='telegrambot.networkjob')),
+            ],
+            options={
+                'verbose_name': 'Network job group',
+                'verbose_name_plural': 'Network job groups',
+                'unique_together': {('job', 'group')},
+            },
+        ),
+    ]
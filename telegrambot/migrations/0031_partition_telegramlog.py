@@ -0,0 +1,91 @@
+# Partition TelegramLog by month, see telegrambot.partitions.
+# The primary key of a partitioned table must include the partition key, so it becomes (id, timestamp).
+# Rolling back copies the rows into a plain table again, with the original primary key, indexes and foreign keys.
+from datetime import date
+
+from django.db import migrations
+
+
+TABLE = "telegrambot_telegramlog"
+
+# Partitions created after the current month; the later ones are created by the maintain_telegram_logs task
+MONTHS_AHEAD = 2
+
+
+def _next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def create_monthly_partitions(apps, schema_editor):
+    """Create a partition for every month from the oldest row to MONTHS_AHEAD months from now.
+    This is a copy of telegrambot.partitions.ensure_partitions at the time of the migration.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"SELECT MIN(timestamp) FROM {TABLE}_unpartitioned")
+        oldest = cursor.fetchone()[0]
+
+        today = date.today()
+        month = date((oldest or today).year, (oldest or today).month, 1)
+        last = date(today.year, today.month, 1)
+        for _ in range(MONTHS_AHEAD):
+            last = _next_month(last)
+
+        while month <= last:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {TABLE}_p{month:%Y_%m} PARTITION OF {TABLE} "
+                f"FOR VALUES FROM (%s) TO (%s)",
+                [month, _next_month(month)],
+            )
+            month = _next_month(month)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0030_networkjob'),
+    ]
+
+    operations = [
+        migrations.RunSQL(f"""
+            ALTER TABLE {TABLE} RENAME TO {TABLE}_unpartitioned;
+            ALTER SEQUENCE {TABLE}_id_seq OWNED BY NONE;
+            CREATE TABLE {TABLE} (LIKE {TABLE}_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp);
+            CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT;
+        """, reverse_sql=f"""
+            DROP TABLE {TABLE};
+            ALTER TABLE {TABLE}_unpartitioned RENAME TO {TABLE};
+            ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id;
+
+            ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id);
+            CREATE INDEX {TABLE}_chat_id_a1bddd92 ON {TABLE} (chat_id);
+            CREATE INDEX {TABLE}_issuer_id_60e996cf ON {TABLE} (issuer_id);
+            CREATE INDEX {TABLE}_target_id_10c9bcc1 ON {TABLE} (target_id);
+            ALTER TABLE {TABLE} ADD CONSTRAINT telegrambot_telegram_chat_id_a1bddd92_fk_telegramb
+                FOREIGN KEY (chat_id) REFERENCES telegrambot_group (id) DEFERRABLE INITIALLY DEFERRED;
+            ALTER TABLE {TABLE} ADD CONSTRAINT telegrambot_telegram_issuer_id_60e996cf_fk_telegramb
+                FOREIGN KEY (issuer_id) REFERENCES telegrambot_user (id) DEFERRABLE INITIALLY DEFERRED;
+            ALTER TABLE {TABLE} ADD CONSTRAINT telegrambot_telegram_target_id_10c9bcc1_fk_telegramb
+                FOREIGN KEY (target_id) REFERENCES telegrambot_user (id) DEFERRABLE INITIALLY DEFERRED;
+        """),
+        migrations.RunPython(create_monthly_partitions, migrations.RunPython.noop),
+        migrations.RunSQL(f"""
+            INSERT INTO {TABLE} SELECT * FROM {TABLE}_unpartitioned;
+            DROP TABLE {TABLE}_unpartitioned;
+            ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id;
+
+            ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id, timestamp);
+            CREATE INDEX {TABLE}_chat_id_a1bddd92 ON {TABLE} (chat_id);
+            CREATE INDEX {TABLE}_issuer_id_60e996cf ON {TABLE} (issuer_id);
+            CREATE INDEX {TABLE}_target_id_10c9bcc1 ON {TABLE} (target_id);
+            ALTER TABLE {TABLE} ADD CONSTRAINT telegrambot_telegram_chat_id_a1bddd92_fk_telegramb
+                FOREIGN KEY (chat_id) REFERENCES telegrambot_group (id) DEFERRABLE INITIALLY DEFERRED;
+            ALTER TABLE {TABLE} ADD CONSTRAINT telegrambot_telegram_issuer_id_60e996cf_fk_telegramb
+                FOREIGN KEY (issuer_id) REFERENCES telegrambot_user (id) DEFERRABLE INITIALLY DEFERRED;
+            ALTER TABLE {TABLE} ADD CONSTRAINT telegrambot_telegram_target_id_10c9bcc1_fk_telegramb
+                FOREIGN KEY (target_id) REFERENCES telegrambot_user (id) DEFERRABLE INITIALLY DEFERRED;
+        """, reverse_sql=f"""
+            ALTER SEQUENCE {TABLE}_id_seq OWNED BY NONE;
+            CREATE TABLE {TABLE}_unpartitioned (LIKE {TABLE} INCLUDING DEFAULTS);
+            INSERT INTO {TABLE}_unpartitioned SELECT * FROM {TABLE};
+        """),
+    ]
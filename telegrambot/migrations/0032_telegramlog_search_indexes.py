@@ -0,0 +1,51 @@
+# Generated by Django 3.2.9 on 2026-10-18 08:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0031_partition_telegramlog'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='telegramlog',
+            name='chat',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='telegrambot.group'),
+        ),
+        migrations.AlterField(
+            model_name='telegramlog',
+            name='issuer',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.RESTRICT, related_name='log_as_issuer', to='telegrambot.user'),
+        ),
+        migrations.AlterField(
+            model_name='telegramlog',
+            name='target',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.RESTRICT, related_name='log_as_target', to='telegrambot.user'),
+        ),
+        migrations.AddIndex(
+            model_name='telegramlog',
+            index=models.Index(fields=['target', 'timestamp'], name='log_target_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='telegramlog',
+            index=models.Index(fields=['issuer', 'timestamp'], name='log_issuer_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='telegramlog',
+            index=models.Index(fields=['chat', 'timestamp'], name='log_chat_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='telegramlog',
+            index=models.Index(fields=['event', 'timestamp'], name='log_event_timestamp_idx'),
+        ),
+        # The expression of telegrambot.logsearch.TEXT
+        migrations.RunSQL(
+            "CREATE INDEX log_text_search_idx ON telegrambot_telegramlog USING gin "
+            "(to_tsvector('simple'::regconfig, COALESCE(reason, '') || ' ' || COALESCE(message, '')))",
+            "DROP INDEX log_text_search_idx",
+        ),
+    ]
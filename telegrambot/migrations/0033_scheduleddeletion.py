@@ -0,0 +1,50 @@
+# Generated by Django 3.2.9 on 2026-10-18 08:17
+
+import json
+
+from django.db import migrations, models
+
+
+def convert_delete_message_tasks(apps, schema_editor):
+    """Move the deletions queued as background tasks to the new table"""
+    Task = apps.get_model("background_task", "Task")
+    ScheduledDeletion = apps.get_model("telegrambot", "ScheduledDeletion")
+
+    tasks = Task.objects.filter(task_name="telegrambot.tasks.delete_message")
+    deletions = []
+    for task in tasks.iterator():
+        args, kwargs = json.loads(task.task_params)
+        params = dict(zip(("chat_id", "message_id"), args), **kwargs)
+        deletions.append(ScheduledDeletion(due_at=task.run_at, **params))
+    ScheduledDeletion.objects.bulk_create(deletions, batch_size=1000)
+    tasks.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('background_task', '0002_auto_20170927_1109'),
+        ('telegrambot', '0032_telegramlog_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledDeletion',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('chat_id', models.BigIntegerField(verbose_name='chat ID')),
+                ('message_id', models.BigIntegerField(verbose_name='message ID')),
+                ('due_at', models.DateTimeField(verbose_name='due at')),
+            ],
+            options={
+                'verbose_name': 'Scheduled deletion',
+                'verbose_name_plural': 'Scheduled deletions',
+                'ordering': ['due_at', 'id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='scheduleddeletion',
+            index=models.Index(fields=['due_at'], name='deletion_due_at_idx'),
+        ),
+        migrations.RunPython(convert_delete_message_tasks, migrations.RunPython.noop),
+    ]
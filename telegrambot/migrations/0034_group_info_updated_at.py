@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2026-10-18 08:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0033_scheduleddeletion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='info_updated_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Telegram info updated at'),
+        ),
+    ]
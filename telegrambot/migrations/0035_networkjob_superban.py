@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2026-10-18 08:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0034_group_info_updated_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='networkjob',
+            name='kind',
+            field=models.CharField(choices=[('AR', 'Set admin rights'), ('SB', 'Superban'), ('SF', 'Superfree')], max_length=2, verbose_name='kind'),
+        ),
+    ]
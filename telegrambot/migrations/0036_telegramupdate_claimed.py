@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2026-10-18 08:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0035_networkjob_superban'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='telegramupdate',
+            name='claimed',
+            field=models.DateTimeField(blank=True, help_text='When a worker took the update, which is being processed', null=True, verbose_name='claimed'),
+        ),
+    ]
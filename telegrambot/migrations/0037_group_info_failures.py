@@ -0,0 +1,23 @@
+# Generated by Django 3.2.9 on 2026-10-18 08:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0036_telegramupdate_claimed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='info_attempted_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Telegram info last fetched at'),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='info_failures',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Telegram info consecutive failures'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 3.2.9 on 2026-10-18 08:41
+
+import datetime
+from django.db import migrations, models
+
+
+# Track when banned changes in the database, so that every process can read the new bans (see cache.BanCache)
+# whatever wrote them: model saves, bulk updates or raw SQL.
+# LOCALTIMESTAMP is in the connection time zone, like the other naive datetimes.
+TRIGGER = """
+    CREATE FUNCTION telegrambot_user_banned_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            IF NEW.banned THEN
+                NEW.banned_changed_at := LOCALTIMESTAMP;
+            END IF;
+        ELSIF NEW.banned IS DISTINCT FROM OLD.banned THEN
+            NEW.banned_changed_at := LOCALTIMESTAMP;
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER telegrambot_user_banned_changed
+        BEFORE INSERT OR UPDATE OF banned ON telegrambot_user
+        FOR EACH ROW EXECUTE FUNCTION telegrambot_user_banned_changed();
+"""
+
+DROP_TRIGGER = """
+    DROP TRIGGER telegrambot_user_banned_changed ON telegrambot_user;
+    DROP FUNCTION telegrambot_user_banned_changed();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0037_group_info_failures'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blacklisteduser',
+            name='created',
+            field=models.DateTimeField(db_index=True, default=datetime.datetime.now, verbose_name='created'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='banned_changed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='banned changed at'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['banned_changed_at'], name='banned_changed_at_idx'),
+        ),
+        migrations.RunSQL(TRIGGER, DROP_TRIGGER),
+    ]
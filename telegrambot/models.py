@@ -26,6 +26,7 @@ class User(models.Model):
             models.Index(fields=["id"], name="id_idx"),
             models.Index(fields=["id", "banned"], name="banned_idx"),
             models.Index(fields=["first_name", "last_name"], name="name_idx"),
+            models.Index(fields=["banned_changed_at"], name="banned_changed_at_idx"),
         ]
 
     id = models.PositiveBigIntegerField("Telegram user ID", primary_key=True, unique=True)
@@ -36,6 +37,8 @@ class User(models.Model):
     reputation = models.IntegerField("reputation", default=0)
     warn_count = models.IntegerField("warn count", default=0)
     banned = models.BooleanField("banned?", default=False)
+    # Set by a database trigger whenever banned changes, however the row is written (see migration 0038)
+    banned_changed_at = models.DateTimeField("banned changed at", null=True, blank=True, editable=False)
     permissions_level = models.IntegerField("permission level", default=0)
     last_seen = models.DateTimeField(default=datetime.now)
 
@@ -52,6 +55,33 @@ class User(models.Model):
         return f"<a href=\"tg://user?id={self.id}\">{f'@{self.username}' if self.username else self.name}</a>"
 
 
+def format_welcome_message(welcome_model: str | None, title: str, members: List[User]) -> str:
+    """Generate a customized welcome message by filling a welcome model.
+
+    :param welcome_model: the welcome model of the group, or None for the default one
+    :param title: the title of the group
+    :param members: list of new members who just joined the group
+    :return: the welcome message
+    """
+    greetings = ngettext_lazy(
+        "Welcome",
+        "Welcome",
+        len(members),
+    ) + " " + ", ".join(member.name for member in members)
+
+    welcome_model = welcome_model or _(
+        "👋 <b>{greetings}</b> to the group <b>{title}</b>!"
+        "\n🌐 This group is part of the <b>Network StudentiUniMi</b>, make sure you "
+        "<a href=\"https://studentiunimi.it/rules\">read the rules</a> first."
+        "\n\n➕ Join the <b>other groups</b> and explore our <b>extra services</b> by clicking the buttons below!"
+        "\n💡 <b>Tip</b>: use <b>@admin</b> if you need to contact the group administrators."
+    )
+    return welcome_model.format(
+        greetings=greetings,
+        title=title,
+    )
+
+
 class Group(models.Model):
     """A Telegram group.
     Unlike the User class, the objects of this class are not created automatically,
@@ -86,40 +116,24 @@ class Group(models.Model):
     ignore_admin_tagging = models.BooleanField("Ignore @admin tagging", default=False, null=False)
     welcome_model = models.TextField("Welcome model", null=True, blank=True,
                                      help_text="Available format parameters: {greetings} and {title}")
+    info_updated_at = models.DateTimeField("Telegram info updated at", null=True, blank=True, editable=False)
+    info_attempted_at = models.DateTimeField("Telegram info last fetched at", null=True, blank=True, editable=False)
+    info_failures = models.PositiveSmallIntegerField("Telegram info consecutive failures", default=0, editable=False)
 
     def __str__(self) -> str:
         return f"{self.title} [{self.id}]"
 
     def generate_welcome_message(self, members: List[User]) -> str:
-        """Generate a customized welcome message by filling the welcome_model.
-
-        :param members: list of new members who just joined the group
-        :return: the welcome message
-        """
-        greetings = ngettext_lazy(
-            "Welcome",
-            "Welcome",
-            len(members),
-        ) + " " + ", ".join(member.name for member in members)
-
-        welcome_model = self.welcome_model or _(
-            "👋 <b>{greetings}</b> to the group <b>{title}</b>!"
-            "\n🌐 This group is part of the <b>Network StudentiUniMi</b>, make sure you "
-            "<a href=\"https://studentiunimi.it/rules\">read the rules</a> first."
-            "\n\n➕ Join the <b>other groups</b> and explore our <b>extra services</b> by clicking the buttons below!"
-            "\n💡 <b>Tip</b>: use <b>@admin</b> if you need to contact the group administrators."
-        )
-        return welcome_model.format(
-            greetings=greetings,
-            title=self.title,
-        )
+        """Generate a customized welcome message by filling the welcome_model, see format_welcome_message"""
+        return format_welcome_message(self.welcome_model, self.title, members)
 
     def update_info(self):
         """Update Telegram info"""
         if not self.bot:
             return False
 
-        bot = telegram.Bot(self.bot.token)
+        from telegrambot import bots, groupsync  # Circular import
+        bot = bots.get_bot(self.bot.token)
         try:
             chat: telegram.Chat = bot.get_chat(chat_id=self.id)
             administrators: List[telegram.ChatMember] = bot.get_chat_administrators(chat_id=self.id)
@@ -127,20 +141,7 @@ class Group(models.Model):
             print(f"Bad chat {self.id}")
             return False
 
-        self.title = chat.title
-        self.invite_link = chat.invite_link
-        self.description = chat.description
-
-        for member in administrators:
-            user = member.user
-            dbmember = User.objects.get_or_create(id=user.id)[0]
-            if member.status == member.CREATOR:
-                self.owner = dbmember
-
-            dbmembership = GroupMembership.objects.get_or_create(group_id=chat.id, user=dbmember)[0]
-            dbmembership.status = member.status
-            dbmembership.save()
-        self.save()
+        groupsync.apply(self, chat, administrators)
         return True
 
 
@@ -297,9 +298,14 @@ class TelegramBot(models.Model):
     token = models.CharField("token", max_length=64, unique=True)
     notes = models.TextField("notes", blank=True, null=True)
     username = models.CharField("username", max_length=32, blank=True)
+    last_update_id = models.BigIntegerField(
+        "last update ID", null=True, blank=True,
+        help_text="High-water mark of the processed updates, used to drop the updates delivered twice",
+    )
 
     def save(self, *args, **kwargs):
-        bot = telegram.Bot(self.token)
+        from telegrambot import bots  # Circular import
+        bot = bots.get_bot(self.token)
         try:
             self.username = f"@{bot.username}"
         except (telegram.error.Unauthorized, telegram.error.InvalidToken):
@@ -345,7 +351,19 @@ class BotWhitelist(models.Model):
 
 
 class TelegramLog(models.Model):
-    """Logs for various things like joined/left channel or moderation commands"""
+    """Logs for various things like joined/left channel or moderation commands.
+    The table is partitioned by month, see telegrambot.partitions.
+    """
+    class Meta:
+        # The lookups by chat, target and issuer are covered by these indexes.
+        # The full-text index on reason and message is created by migration 0032, see telegrambot.logsearch
+        indexes = [
+            models.Index(fields=["target", "timestamp"], name="log_target_timestamp_idx"),
+            models.Index(fields=["issuer", "timestamp"], name="log_issuer_timestamp_idx"),
+            models.Index(fields=["chat", "timestamp"], name="log_chat_timestamp_idx"),
+            models.Index(fields=["event", "timestamp"], name="log_event_timestamp_idx"),
+        ]
+
     class Events(models.IntegerChoices):
         CHAT_DOES_NOT_EXIST = 0, "CHAT_DOES_NOT_EXIST"
         MODERATION_INFO = 5, "MODERATION_INFO"
@@ -367,9 +385,11 @@ class TelegramLog(models.Model):
 
     id = models.BigAutoField(primary_key=True)
     event = models.IntegerField(choices=Events.choices)
-    chat = models.ForeignKey(Group, null=True, on_delete=models.SET_NULL)
-    target = models.ForeignKey(User, related_name="log_as_target", null=True, on_delete=models.RESTRICT)
-    issuer = models.ForeignKey(User, related_name="log_as_issuer", null=True, on_delete=models.RESTRICT)
+    chat = models.ForeignKey(Group, null=True, on_delete=models.SET_NULL, db_index=False)
+    target = models.ForeignKey(User, related_name="log_as_target", null=True, on_delete=models.RESTRICT,
+                               db_index=False)
+    issuer = models.ForeignKey(User, related_name="log_as_issuer", null=True, on_delete=models.RESTRICT,
+                               db_index=False)
     reason = models.TextField(null=True, blank=True)
     message = models.TextField(null=True, blank=True)
     message_deleted = models.BooleanField(null=True, blank=True)
@@ -401,6 +421,7 @@ class BlacklistedUser(models.Model):
 
     user_id = models.PositiveBigIntegerField("Telegram user ID", primary_key=True, unique=True)
     source = models.CharField("source", choices=BlacklistSource.choices, max_length=2)
+    created = models.DateTimeField("created", default=datetime.now, db_index=True)
 
     def __str__(self):
         return f"{self.user_id} ({self.get_source_display()})"
@@ -412,3 +433,99 @@ class BlacklistedUser(models.Model):
             handlers.utils.check_blacklist(dbuser)
         except User.DoesNotExist:
             pass
+
+
+class TelegramUpdate(models.Model):
+    """A Telegram update received through the webhook and not processed yet.
+    Only used when settings.TELEGRAM_WEBHOOK_QUEUE is enabled: see telegrambot.ingestion.
+    """
+    class Meta:
+        ordering = ["id"]
+        verbose_name = "Queued Telegram update"
+        verbose_name_plural = "Queued Telegram updates"
+
+    id = models.BigAutoField(primary_key=True)
+    bot = models.ForeignKey(TelegramBot, on_delete=models.CASCADE, related_name="queued_updates")
+    chat_id = models.BigIntegerField("chat ID", null=True, blank=True)
+    payload = models.JSONField("payload")
+    received = models.DateTimeField("received", default=datetime.now)
+    claimed = models.DateTimeField("claimed", null=True, blank=True,
+                                   help_text="When a worker took the update, which is being processed")
+
+    def __str__(self) -> str:
+        return f"Update {self.payload.get('update_id')} [{self.chat_id}]"
+
+
+class ScheduledDeletion(models.Model):
+    """A message the bot must delete when it expires, like welcome messages and moderation notices.
+    The deletions are carried out in bulk by `manage.py process_deletions`: see telegrambot.expiry.
+    """
+    class Meta:
+        ordering = ["due_at", "id"]
+        verbose_name = "Scheduled deletion"
+        verbose_name_plural = "Scheduled deletions"
+        indexes = [
+            models.Index(fields=["due_at"], name="deletion_due_at_idx"),
+        ]
+
+    id = models.BigAutoField(primary_key=True)
+    chat_id = models.BigIntegerField("chat ID")
+    message_id = models.BigIntegerField("message ID")
+    due_at = models.DateTimeField("due at")
+
+    def __str__(self) -> str:
+        return f"Message {self.message_id} [{self.chat_id}] at {self.due_at}"
+
+
+class NetworkJob(models.Model):
+    """An action on a user to carry out in many groups of the network, like propagating the admin rights
+    of a staff member or a superban. Jobs run in background under the Telegram rate limits: see telegrambot.jobs.
+    """
+    class Meta:
+        ordering = ["-id"]
+        verbose_name = "Network job"
+        verbose_name_plural = "Network jobs"
+
+    class Kinds(models.TextChoices):
+        SET_ADMIN_RIGHTS = "AR", "Set admin rights"
+        SUPERBAN = "SB", "Superban"
+        SUPERFREE = "SF", "Superfree"
+
+    class Statuses(models.TextChoices):
+        PENDING = "P", "Pending"
+        RUNNING = "R", "Running"
+        DONE = "D", "Done"
+        FAILED = "F", "Done with errors"
+
+    id = models.BigAutoField(primary_key=True)
+    kind = models.CharField("kind", choices=Kinds.choices, max_length=2)
+    target = models.ForeignKey(User, on_delete=models.CASCADE, related_name="network_jobs")
+    status = models.CharField("status", choices=Statuses.choices, max_length=1, default=Statuses.PENDING)
+    created = models.DateTimeField("created", default=datetime.now)
+    started = models.DateTimeField("started", null=True, blank=True)
+    finished = models.DateTimeField("finished", null=True, blank=True)
+
+    def __str__(self) -> str:
+        return f"{self.get_kind_display()} -> {self.target} [{self.get_status_display()}]"
+
+
+class NetworkJobGroup(models.Model):
+    """A group where a NetworkJob has to be carried out"""
+    class Meta:
+        verbose_name = "Network job group"
+        verbose_name_plural = "Network job groups"
+        unique_together = ("job", "group")
+
+    class Statuses(models.TextChoices):
+        PENDING = "P", "Pending"
+        DONE = "D", "Done"
+        FAILED = "F", "Failed"
+
+    job = models.ForeignKey(NetworkJob, on_delete=models.CASCADE, related_name="groups")
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name="+")
+    status = models.CharField("status", choices=Statuses.choices, max_length=1, default=Statuses.PENDING)
+    attempts = models.PositiveSmallIntegerField("attempts", default=0)
+    error = models.TextField("error", null=True, blank=True)
+
+    def __str__(self) -> str:
+        return f"{self.group} [{self.get_status_display()}]"
@@ -0,0 +1,320 @@
+"""Central scheduler of the calls to the Telegram Bot API.
+
+Handlers submit their calls instead of making them: the scheduler executes
+them in a pool of threads, by priority, within the limits Telegram enforces:
+- settings.TELEGRAM_OUTBOUND_RATE calls per second for every bot;
+- settings.TELEGRAM_OUTBOUND_GROUP_RATE calls per minute in every group;
+- one call per second in every private chat.
+Every limit is a token bucket. Every chat has its own queue, and the next call
+is chosen among the first calls of the chats which are allowed to run, so a
+backlog in a rate-limited chat never holds back the other chats. The calls to
+the same chat are never executed concurrently, so the calls with the same
+priority are executed in order.
+When Telegram answers with RetryAfter, the chat (or the bot) is paused and
+the call is scheduled again.
+Inside deferred(), the submitted calls are held until the block exits: the
+updates are processed in a database transaction, and no call should be made
+before it's committed.
+
+    future = outbound.submit(bot, "send_message", priority=Priority.WELCOME, chat_id=chat_id, text=text)
+    future.add_done_callback(...)
+"""
+import atexit
+import heapq
+import itertools
+import logging as logg
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+from functools import partial
+from typing import Any, Callable, Iterator
+
+import telegram
+from django.conf import settings
+
+LOG = logg.getLogger(__name__)
+
+# Maximum number of RetryAfter answers before a call fails
+_MAX_ATTEMPTS = 5
+
+
+class Priority(IntEnum):
+    """The lower the value, the sooner the call is executed"""
+    MODERATION = 0   # bans, mutes, kicks, deletions requested by the moderators
+    INTERACTIVE = 1  # answers to commands
+    WELCOME = 2      # welcome messages
+    LOG = 3          # lines in the log chat
+    DELETION = 4     # scheduled deletions and cleanup of service messages
+    SYNC = 5         # periodic refresh of the groups info
+
+
+class TokenBucket:
+    """Allow `rate` calls per second, with bursts of up to `capacity` calls"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Return how many seconds to wait before a call is allowed"""
+        if self.paused_until > now:
+            return self.paused_until - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds: float, now: float) -> None:
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+    def idle(self, now: float) -> bool:
+        """Return True if the bucket is full, i.e. forgetting it changes nothing"""
+        return self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+@dataclass(order=True)
+class _Call:
+    priority: int
+    seq: int
+    func: Callable[[], Any] = field(compare=False)
+    token: str = field(compare=False)
+    chat_id: int | None = field(compare=False)
+    future: Future = field(compare=False, default_factory=Future)
+    attempts: int = field(compare=False, default=0)
+
+    @property
+    def chat_key(self) -> tuple[str, int | None]:
+        return self.token, self.chat_id
+
+
+class OutboundScheduler:
+    # Forget the idle buckets when there are more than this
+    MAX_BUCKETS = 10_000
+
+    def __init__(self, rate: float, group_rate: float, workers: int):
+        self.rate = rate
+        self.group_rate = group_rate
+        self.workers = workers
+
+        self._queues: dict[tuple[str, int | None], list[_Call]] = {}  # a heap of calls for every chat
+        self._buckets: dict[tuple[str, int | None], TokenBucket] = {}
+        self._busy: set[tuple[str, int | None]] = set()  # the chats with a call being executed
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._executor: ThreadPoolExecutor | None = None
+        self._thread: threading.Thread | None = None
+        self._held = threading.local()  # the calls held by deferred(), in every thread
+
+    def submit(self, bot: telegram.Bot, method: str, priority: Priority = Priority.INTERACTIVE, **kwargs) -> Future:
+        """Schedule a call to a telegram.Bot method.
+
+        :param bot: the bot making the call
+        :param method: the name of the telegram.Bot method, e.g. "send_message"
+        :param priority: the priority of the call
+        :param kwargs: the arguments of the method; chat_id selects the per-chat limit
+        :return: a Future with the result of the call
+        """
+        return self.submit_call(bot, partial(getattr(bot, method), **kwargs), kwargs.get("chat_id"), priority)
+
+    def submit_call(self, bot: telegram.Bot, func: Callable[[], Any], chat_id: int | None,
+                    priority: Priority = Priority.INTERACTIVE, hold: bool = True) -> Future:
+        """Schedule a function making one or more calls with a bot to a chat.
+
+        :param hold: whether the call is held inside deferred(); a call whose result is awaited must not be
+        """
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            # The chat IDs read from the settings may be strings
+            chat_id = int(chat_id)
+        call = _Call(priority=priority, seq=next(self._seq), func=func, token=bot.token, chat_id=chat_id)
+        held = getattr(self._held, "calls", None)
+        if hold and held is not None:
+            held.append(call)
+            return call.future
+
+        with self._condition:
+            self._push(call)
+            self._condition.notify()
+        self._start()
+        return call.future
+
+    @contextmanager
+    def deferred(self) -> Iterator[None]:
+        """Hold the calls submitted by this thread inside the block, and schedule them when it exits"""
+        if getattr(self._held, "calls", None) is not None:
+            # Nested: the outermost block schedules the calls
+            yield
+            return
+
+        self._held.calls = held = []
+        try:
+            yield
+        finally:
+            self._held.calls = None
+            if held:
+                with self._condition:
+                    for call in held:
+                        self._push(call)
+                    self._condition.notify_all()
+                self._start()
+
+    def pending(self) -> int:
+        """Return the number of calls waiting to be executed"""
+        return sum(len(queue) for queue in list(self._queues.values()))
+
+    def _push(self, call: _Call) -> None:
+        heapq.heappush(self._queues.setdefault(call.chat_key, []), call)
+
+    def _bucket(self, token: str, chat_id: int | None) -> TokenBucket:
+        key = (token, chat_id)
+        if (bucket := self._buckets.get(key)) is None:
+            if chat_id is None:
+                bucket = TokenBucket(self.rate, self.rate)
+            elif isinstance(chat_id, str) or chat_id < 0:
+                # Groups and channels, by ID or by @username
+                bucket = TokenBucket(self.group_rate / 60, 3)
+            else:
+                bucket = TokenBucket(1, 1)
+            self._buckets[key] = bucket
+        return bucket
+
+    def _buckets_of(self, call: _Call) -> list[TokenBucket]:
+        if call.chat_id is None:
+            return [self._bucket(call.token, None)]
+        return [self._bucket(call.token, None), self._bucket(call.token, call.chat_id)]
+
+    def _next_call(self) -> tuple[_Call | None, float | None]:
+        """Take the first call by priority among the chats which are allowed to run now.
+        Otherwise, return how long to wait (None: until something is submitted).
+        """
+        now = time.monotonic()
+        wait = None
+        best: _Call | None = None
+        for chat_key, queue in self._queues.items():
+            if chat_key in self._busy or (best is not None and best < queue[0]):
+                continue
+            delay = max(bucket.wait_time(now) for bucket in self._buckets_of(queue[0]))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            best = queue[0]
+
+        if best is None:
+            return None, wait
+
+        for bucket in self._buckets_of(best):
+            bucket.take()
+        queue = self._queues[best.chat_key]
+        heapq.heappop(queue)
+        if not queue:
+            del self._queues[best.chat_key]
+        self._busy.add(best.chat_key)
+        return best, None
+
+    def _forget_idle_buckets(self) -> None:
+        if len(self._buckets) <= self.MAX_BUCKETS:
+            return
+        now = time.monotonic()
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if not bucket.idle(now)}
+
+    def _start(self) -> None:
+        if self._thread is not None:
+            return
+
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="outbound")
+            self._thread = threading.Thread(target=self._run, name="outbound-scheduler", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            call = None
+            try:
+                with self._condition:
+                    call, wait = self._next_call()
+                    if call is None:
+                        self._forget_idle_buckets()
+                        self._condition.wait(timeout=wait)
+                        continue
+                self._executor.submit(self._execute, call)
+            except Exception as e:
+                # The scheduler thread must never die, or no call would be executed anymore
+                LOG.exception("Outbound scheduler error: %s", e)
+                if call is not None and not call.future.done():
+                    self._done(call)
+                    call.future.set_exception(e)
+                time.sleep(0.1)
+
+    def _execute(self, call: _Call) -> None:
+        call.attempts += 1
+        try:
+            result = call.func()
+        except telegram.error.RetryAfter as e:
+            with self._condition:
+                self._busy.discard(call.chat_key)
+                if call.attempts < _MAX_ATTEMPTS:
+                    # Flood limits are mostly per chat: only pause the whole bot for calls without a chat
+                    self._bucket(call.token, call.chat_id).pause(e.retry_after, time.monotonic())
+                    self._push(call)
+                self._condition.notify()
+            if call.attempts < _MAX_ATTEMPTS:
+                LOG.warning("Telegram asked to retry after %d seconds (chat %s)", e.retry_after, call.chat_id)
+            else:
+                call.future.set_exception(e)
+            return
+        except Exception as e:
+            self._done(call)
+            LOG.info("Telegram call to chat %s failed: %s", call.chat_id, e)
+            call.future.set_exception(e)
+            return
+
+        self._done(call)
+        call.future.set_result(result)
+
+    def _done(self, call: _Call) -> None:
+        with self._condition:
+            self._busy.discard(call.chat_key)
+            self._condition.notify()
+
+    def drain(self, timeout: float) -> None:
+        """Wait for the queued calls to be executed, up to timeout seconds"""
+        deadline = time.monotonic() + timeout
+        while (self._queues or self._busy) and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+
+scheduler = OutboundScheduler(
+    rate=settings.TELEGRAM_OUTBOUND_RATE,
+    group_rate=settings.TELEGRAM_OUTBOUND_GROUP_RATE,
+    workers=settings.TELEGRAM_OUTBOUND_WORKERS,
+)
+atexit.register(scheduler.drain, timeout=10)
+
+
+def submit(bot: telegram.Bot, method: str, priority: Priority = Priority.INTERACTIVE, **kwargs) -> Future:
+    """Schedule a call to a telegram.Bot method, see OutboundScheduler.submit"""
+    return scheduler.submit(bot, method, priority, **kwargs)
+
+
+def call(bot: telegram.Bot, method: str, priority: Priority = Priority.INTERACTIVE, **kwargs) -> Any:
+    """Schedule a call to a telegram.Bot method and wait for its result; it's never held by deferred()"""
+    func = partial(getattr(bot, method), **kwargs)
+    return scheduler.submit_call(bot, func, kwargs.get("chat_id"), priority, hold=False).result()
+
+
+def deferred():
+    """Hold the calls submitted inside the block until it exits, see OutboundScheduler.deferred"""
+    return scheduler.deferred()
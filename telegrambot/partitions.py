@@ -0,0 +1,262 @@
+"""Monthly partitions of the TelegramLog table.
+
+telegrambot_telegramlog is partitioned by range of timestamp (see migration
+0031): every month has its own partition, named after it (e.g.
+telegrambot_telegramlog_p2024_05), and a default partition collects whatever
+falls outside of them. The partitions are created in advance by the
+maintain_telegram_logs task.
+
+When settings.TELEGRAM_LOG_RETENTION_MONTHS is set, the partitions older than
+that are exported to a gzipped NDJSON file in settings.TELEGRAM_LOG_ARCHIVE_DIR
+and then dropped; the import_logs command loads an archive back.
+"""
+import gzip
+import json
+import logging as logg
+import os
+import re
+from dataclasses import dataclass
+from datetime import date, datetime
+from pathlib import Path
+from typing import IO, Iterable
+
+from django.db import connection, transaction
+
+from telegrambot.models import (
+    TelegramLog,
+    User as DBUser,
+    Group as DBGroup,
+)
+
+
+LOG = logg.getLogger(__name__)
+
+TABLE = TelegramLog._meta.db_table
+FIELDS = ("id", "event", "timestamp", "chat_id", "target_id", "issuer_id", "reason", "message", "message_deleted")
+
+# Rows fetched at once while exporting, and inserted at once while importing
+_CHUNK_SIZE = 2000
+
+_NAME_RE = re.compile(rf"^{TABLE}_p(\d{{4}})_(\d{{2}})$")
+
+
+def month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+@dataclass(frozen=True)
+class Partition:
+    name: str
+    start: date  # included
+    end: date    # excluded
+
+    @classmethod
+    def of(cls, month: date) -> "Partition":
+        month = month_start(month)
+        return cls(f"{TABLE}_p{month:%Y_%m}", month, next_month(month))
+
+    @property
+    def archive_name(self) -> str:
+        return f"{self.name}.ndjson.gz"
+
+
+def partitions() -> list[Partition]:
+    """Return the monthly partitions of the table, oldest first"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = %s",
+            [TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+    months = [date(int(m[1]), int(m[2]), 1) for m in map(_NAME_RE.match, names) if m]
+    return [Partition.of(month) for month in sorted(months)]
+
+
+def create_partition(month: date) -> Partition:
+    """Create the partition of a month, if it doesn't exist yet.
+
+    Postgres refuses to create a partition while the default partition holds
+    rows of its range, so those rows are moved into the new partition, which
+    is then attached to the table.
+    """
+    partition = Partition.of(month)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [partition.name])
+        if cursor.fetchone()[0] is not None:
+            return partition
+
+        cursor.execute(
+            f"SELECT EXISTS (SELECT 1 FROM {TABLE}_default WHERE timestamp >= %s AND timestamp < %s)",
+            [partition.start, partition.end],
+        )
+        if not cursor.fetchone()[0]:
+            cursor.execute(
+                f"CREATE TABLE {partition.name} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)",
+                [partition.start, partition.end],
+            )
+            return partition
+
+        cursor.execute(f"CREATE TABLE {partition.name} (LIKE {TABLE} INCLUDING DEFAULTS)")
+        cursor.execute(
+            f"WITH moved AS ("
+            f"DELETE FROM {TABLE}_default WHERE timestamp >= %s AND timestamp < %s RETURNING *"
+            f") INSERT INTO {partition.name} SELECT * FROM moved",
+            [partition.start, partition.end],
+        )
+        LOG.info("Moved %d rows from the default partition to %s", cursor.rowcount, partition.name)
+        cursor.execute(
+            f"ALTER TABLE {TABLE} ATTACH PARTITION {partition.name} FOR VALUES FROM (%s) TO (%s)",
+            [partition.start, partition.end],
+        )
+    return partition
+
+
+def ensure_partitions(since: date = None, months_ahead: int = 2) -> list[Partition]:
+    """Create the partitions from the month of `since` (default: this month)
+    up to `months_ahead` months from now.
+
+    :return: the partitions which should exist, whether they were just created or not
+    """
+    month = month_start(since or date.today())
+    last = month_start(date.today())
+    for _ in range(months_ahead):
+        last = next_month(last)
+
+    created = []
+    while month <= last:
+        created.append(create_partition(month))
+        month = next_month(month)
+    return created
+
+
+def expired_partitions(retention_months: int, today: date = None) -> list[Partition]:
+    """Return the partitions whose rows are all older than retention_months months"""
+    cutoff = month_start(today or date.today())
+    for _ in range(retention_months - 1):
+        cutoff = date(cutoff.year - (cutoff.month == 1), (cutoff.month - 2) % 12 + 1, 1)
+    return [partition for partition in partitions() if partition.end <= cutoff]
+
+
+def serialize(row: dict) -> str:
+    """Convert a row with the FIELDS to a line of an archive"""
+    row["timestamp"] = row["timestamp"].isoformat()
+    return json.dumps(row, ensure_ascii=False)
+
+
+def export_rows(partition: Partition, file: IO[str]) -> int:
+    """Write the rows of a partition to a file, one JSON object per line.
+    The rows are streamed with a server-side cursor.
+
+    :return: the number of rows written
+    """
+    rows = TelegramLog.objects\
+        .filter(timestamp__gte=partition.start, timestamp__lt=partition.end)\
+        .order_by("id")\
+        .values(*FIELDS)\
+        .iterator(chunk_size=_CHUNK_SIZE)
+    count = 0
+    for row in rows:
+        file.write(serialize(row) + "\n")
+        count += 1
+    return count
+
+
+def archive_partition(partition: Partition, directory: Path) -> int:
+    """Export a partition to a gzipped NDJSON file in directory, then drop it.
+
+    The partition is locked against writes while it's exported, and it's only
+    dropped once the archive has been written to disk.
+
+    :return: the number of archived rows
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / partition.archive_name
+    temp_path = path.with_name(path.name + ".part")
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {partition.name} IN SHARE MODE")
+
+        with gzip.open(temp_path, "wt", encoding="utf-8") as file:
+            count = export_rows(partition, file)
+        with open(temp_path, "rb") as file:
+            os.fsync(file.fileno())
+        temp_path.replace(path)
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {partition.name}")
+            cursor.execute(f"DROP TABLE {partition.name}")
+
+    LOG.info("Archived %d log events of %s to %s", count, partition.start.strftime("%Y-%m"), path)
+    return count
+
+
+def apply_retention(retention_months: int, directory: Path) -> dict[str, int]:
+    """Archive and drop the partitions older than retention_months months.
+
+    :return: the number of archived rows of every archived partition
+    """
+    return {
+        partition.name: archive_partition(partition, directory)
+        for partition in expired_partitions(retention_months)
+    }
+
+
+def deserialize(line: str) -> dict:
+    """Convert a line of an archive to a row with the FIELDS"""
+    row = json.loads(line)
+    row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+    return row
+
+
+def _import_chunk(rows: list[dict]) -> int:
+    # The users may have been deleted since the rows were archived: keep their IDs with stubs
+    user_ids = {row[field] for row in rows for field in ("target_id", "issuer_id") if row[field] is not None}
+    DBUser.objects.bulk_create([DBUser(id=user_id, first_name="") for user_id in sorted(user_ids)],
+                               ignore_conflicts=True)
+
+    chat_ids = {row["chat_id"] for row in rows if row["chat_id"] is not None}
+    existing_chats = set(DBGroup.objects.filter(id__in=chat_ids).values_list("id", flat=True))
+    for row in rows:
+        if row["chat_id"] not in existing_chats:
+            row["chat_id"] = None
+
+    for month in {month_start(row["timestamp"]) for row in rows}:
+        create_partition(month)
+    return len(TelegramLog.objects.bulk_create([TelegramLog(**row) for row in rows], ignore_conflicts=True))
+
+
+def import_rows(lines: Iterable[str]) -> int:
+    """Insert the rows of an archive, skipping the ones which are already in the table.
+    The missing monthly partitions are created.
+
+    :param lines: the lines of the archive
+    :return: the number of processed rows
+    """
+    count = 0
+    chunk = []
+    with transaction.atomic():
+        for line in lines:
+            if not line.strip():
+                continue
+            chunk.append(deserialize(line))
+            if len(chunk) >= _CHUNK_SIZE:
+                count += _import_chunk(chunk)
+                chunk = []
+        if chunk:
+            count += _import_chunk(chunk)
+    return count
+
+
+def import_archive(path: Path) -> int:
+    """Insert the rows of a gzipped NDJSON archive, see import_rows"""
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        return import_rows(file)
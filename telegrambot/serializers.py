@@ -3,6 +3,7 @@ from rest_framework import serializers
 from telegrambot.models import (
     User,
     Group,
+    TelegramLog,
 )
 
 
@@ -16,3 +17,12 @@ class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ("id", "first_name", "last_name", "username", )
+
+
+class TelegramLogSerializer(serializers.ModelSerializer):
+    event = serializers.CharField(source="get_event_display")
+
+    class Meta:
+        model = TelegramLog
+        fields = ("id", "timestamp", "event", "chat_id", "target_id", "issuer_id", "reason", "message",
+                  "message_deleted", )
@@ -0,0 +1,30 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from telegrambot import bots, cache
+from telegrambot.models import TelegramBot, Group, User, BlacklistedUser
+
+
+@receiver([post_save, post_delete], sender=TelegramBot)
+def invalidate_bot_registry(**_) -> None:
+    bots.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Group)
+def invalidate_group_cache(instance: Group, **_) -> None:
+    cache.groups.invalidate(instance.id)
+
+
+@receiver(post_save, sender=User)
+def update_banned_users(instance: User, **_) -> None:
+    cache.bans.set_banned(instance.id, instance.banned)
+
+
+@receiver(post_delete, sender=User)
+def remove_banned_user(instance: User, **_) -> None:
+    cache.bans.set_banned(instance.id, False)
+
+
+@receiver(post_save, sender=BlacklistedUser)
+def add_blacklisted_user(instance: BlacklistedUser, **_) -> None:
+    cache.bans.set_blacklisted(instance.user_id)
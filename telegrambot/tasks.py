@@ -1,13 +1,11 @@
 from django.conf import settings
-from django.db.utils import IntegrityError
-import time
 import requests
 
-import telegram.error
 from background_task import background
 from background_task.models import Task
 
-from telegrambot.handlers.utils import get_bot, check_blacklist
+from telegrambot import blocklist, groupsync, jobs, partitions
+from telegrambot.handlers.utils import check_blacklist
 from telegrambot.models import (
     User as DBUser,
     Group as DBGroup,
@@ -15,57 +13,66 @@ from telegrambot.models import (
 )
 
 
-@background(schedule=90)
-def delete_message(chat_id: int, message_id: int) -> None:
-    """Schedule a message deletion in the future"""
-    bot = get_bot(chat_id)
-    try:
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
-    except telegram.error.BadRequest:  # the message was already deleted
-        pass
-
-
 @background(schedule=1)
 def fetch_telegram_info() -> None:
-    dbgroups = list(DBGroup.objects.all())
+    """Refresh the Telegram info of the groups which are due, see telegrambot.groupsync"""
+    dbgroups = groupsync.due_groups()
     print(f"Processing {len(dbgroups)} groups")
+    report = groupsync.sync(dbgroups)
+    print(f"{report['updated']} groups updated, {report['failed']} failed")
+
+
+@background(schedule=1)
+def fetch_groups_telegram_info(group_ids: list[int]) -> None:
+    """Refresh the Telegram info of some groups now, whether they are due or not"""
+    report = groupsync.sync(DBGroup.objects.filter(id__in=group_ids).exclude(bot=None))
+    print(f"{report['updated']} groups updated, {report['failed']} failed")
+
 
-    for dbgroup in dbgroups:
-        try:
-            res = dbgroup.update_info()
-            if not res:
-                print(f"Bad chat {dbgroup.id}")
-        except telegram.error.RetryAfter as e:
-            time.sleep(e.retry_after + 10)
-        except telegram.error.Unauthorized:
-            print(f"Bot is not member of chat {dbgroup.id}")
-    print("DONE\n" + '-' * 15)
+@background(schedule=1)
+def download_group_photo(chat_id: int, file_id: str) -> None:
+    """Download the new picture of a group, see telegrambot.groupsync.update_photo"""
+    groupsync.download_photo(chat_id, file_id)
 
 
 @background(schedule=1)
 def fetch_grouphelp_blocklist() -> None:
-    r = requests.get(settings.GROUPHELP_BLOCKLIST_URL)
-    if not r.status_code == 200:
-        return
-
-    user_ids = r.json().get("result")
-    print(f"Adding {len(user_ids)} users to the blacklist (GroupHelp)")
-    BlacklistedUser.objects.filter(source='GH').delete()
-    for user_id in user_ids:
-        user_id: int = int(user_id)
-        try:
-            BlacklistedUser.objects.create(
-                user_id=user_id,
-                source='GH',
-            )
-        except IntegrityError:  # the user is already blacklisted by another source
-            continue
+    """Sync the GroupHelp blocklist, see telegrambot.blocklist"""
+    with requests.get(settings.GROUPHELP_BLOCKLIST_URL, stream=True, timeout=60) as r:
+        if not r.status_code == 200:
+            return
+        user_ids = set(blocklist.parse_ids(r.iter_content(chunk_size=65536)))
+
+    report = blocklist.sync(user_ids, BlacklistedUser.BlacklistSource.GROUPHELP)
+    print(f"GroupHelp blocklist: {len(user_ids)} users, {report['added']} added, {report['removed']} removed, "
+          f"{report['flagged']} known users banned")
+
+
+@background(schedule=1)
+def run_network_job(job_id: int) -> None:
+    """Carry out a network job in all its pending groups, see telegrambot.jobs"""
+    job = jobs.run(job_id)
+    print(f"Network job {job.id} finished: {job}")
+
+
+@background(schedule=1)
+def maintain_telegram_logs() -> None:
+    """Create the next monthly partitions of TelegramLog and archive the expired ones"""
+    partitions.ensure_partitions()
+    if settings.TELEGRAM_LOG_RETENTION_MONTHS > 0:
+        archived = partitions.apply_retention(settings.TELEGRAM_LOG_RETENTION_MONTHS, settings.TELEGRAM_LOG_ARCHIVE_DIR)
+        print(f"Archived {sum(archived.values())} log events from {len(archived)} partitions")
 
 
 Task.objects.all().filter(task_name="telegrambot.tasks.fetch_telegram_info").delete()
-fetch_telegram_info(schedule=1, verbose_name="Fetch Telegram group info", repeat=Task.HOURLY)
+# Every run only refreshes the groups which are due, see settings.TELEGRAM_GROUP_SYNC_INTERVAL
+fetch_telegram_info(schedule=1, verbose_name="Fetch Telegram group info", repeat=600)
 
 
 Task.objects.all().filter(task_name="telegrambot.tasks.fetch_grouphelp_blocklist").delete()
 if settings.GROUPHELP_BLOCKLIST_URL:
     fetch_grouphelp_blocklist(schedule=1, verbose_name="Fetch GroupHelp blocklist", repeat=Task.DAILY)
+
+
+Task.objects.all().filter(task_name="telegrambot.tasks.maintain_telegram_logs").delete()
+maintain_telegram_logs(schedule=1, verbose_name="Maintain the Telegram logs partitions", repeat=Task.DAILY)
@@ -1,18 +1,47 @@
 import os
+import tempfile
+import threading
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta
+from pathlib import Path
 from unittest import skipIf
+from unittest.mock import patch
 
-from django.test import TestCase
+import telegram
+
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+from django.db.models import Min
+from django.contrib.auth import get_user_model
+from django.test import TestCase, Client, override_settings
+from django.urls import reverse
+from django.utils.translation import get_language
 from rest_framework.renderers import JSONRenderer as Renderer
+from telegram import Update, User, Chat
+from telegram.ext import Dispatcher, DispatcherHandlerStop, TypeHandler
 
+from roles.models import Moderator
+from telegrambot import blocklist, bots, bookkeeping, cache, dedup, expiry, groupsync, ingestion, jobs, logging, logsearch, outbound, partitions
+from telegrambot.handlers import dispatcher, errors, utils
+from telegrambot.logging import MODERATION_DEL
+from telegrambot.outbound import Priority
 from telegrambot.models import (
     User as TgUser,
     Group as TgGroup,
     TelegramBot,
+    TelegramUpdate,
+    GroupMembership,
+    BlacklistedUser,
+    NetworkJob,
+    NetworkJobGroup,
+    TelegramLog,
+    ScheduledDeletion,
 )
 from telegrambot.serializers import (
     UserSerializer,
     GroupSerializer,
 )
+from university.models import Degree, Department
 
 TEST_BOT_TOKEN = os.environ.get("TEST_BOT_TOKEN", None)
 TEST_BOT_USERNAME = os.environ.get("TEST_BOT_USERNAME", None)
@@ -117,3 +146,1115 @@ class TelegramBotTestCase(TestCase):
 
     def test_str(self):
         self.assertEqual(str(self.bot2), f"{TEST_BOT_USERNAME}")
+
+
+class TelegramUpdateQueueTestCase(TestCase):
+    def setUp(self):
+        # bulk_create skips TelegramBot.save, which would contact Telegram
+        self.bot = TelegramBot.objects.bulk_create([
+            TelegramBot(token="123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ", username="@test_bot"),
+        ])[0]
+
+    def test_chat_id_of(self):
+        self.assertEqual(ingestion.chat_id_of({
+            "update_id": 1,
+            "message": {"message_id": 1, "chat": {"id": -1001234567}},
+        }), -1001234567)
+        self.assertEqual(ingestion.chat_id_of({
+            "update_id": 2,
+            "chat_member": {"chat": {"id": -1007654321}},
+        }), -1007654321)
+        self.assertEqual(ingestion.chat_id_of({
+            "update_id": 3,
+            "callback_query": {"from": {"id": 26170256}, "message": {"chat": {"id": -1001234567}}},
+        }), -1001234567)
+        self.assertEqual(ingestion.chat_id_of({
+            "update_id": 4,
+            "callback_query": {"from": {"id": 26170256}},
+        }), 26170256)
+        self.assertIsNone(ingestion.chat_id_of({"update_id": 5, "poll": {}}))
+
+    def test_enqueue(self):
+        ingestion.enqueue({"update_id": 1, "message": {"chat": {"id": -1001234567}}}, self.bot.id)
+        ingestion.enqueue({"update_id": 2, "message": {"chat": {"id": -1007654321}}}, self.bot.id)
+        self.assertEqual(ingestion.depth(), 2)
+        self.assertEqual(
+            list(TelegramUpdate.objects.values_list("chat_id", flat=True)),
+            [-1001234567, -1007654321],
+        )
+
+    def test_chat_pinning(self):
+        workers = ingestion.UpdateQueueWorkers(workers=4)
+        first = ingestion.enqueue({"update_id": 1, "message": {"chat": {"id": -1001234567}}}, self.bot.id)
+        second = ingestion.enqueue({"update_id": 2, "message": {"chat": {"id": -1001234567}}}, self.bot.id)
+        self.assertEqual(workers._worker_for(first), workers._worker_for(second))
+        self.assertIn(workers._worker_for(first), range(4))
+
+    def test_claim(self):
+        workers = ingestion.UpdateQueueWorkers(workers=2)
+        late = ingestion.enqueue({"update_id": 1, "message": {"chat": {"id": -1001234567}}}, self.bot.id)
+        late.delete()
+        newer = ingestion.enqueue({"update_id": 2, "message": {"chat": {"id": -1001234567}}}, self.bot.id)
+        self.assertEqual(workers._claim(), [newer])
+        self.assertEqual(workers._claim(), [])
+
+        # An update committed after a newer one was claimed is not skipped
+        late.save()
+        self.assertEqual(workers._claim(), [late])
+
+        # Nor is an update claimed by a worker which died before processing it
+        TelegramUpdate.objects.filter(id=newer.id).update(claimed=datetime(2024, 5, 1))
+        self.assertEqual(workers._claim(), [])  # ...but still queued by this pool
+        self.assertEqual(ingestion.UpdateQueueWorkers(workers=2)._claim(), [newer])
+
+    def test_single_fetcher(self):
+        ingestion.enqueue({"update_id": 1, "message": {"chat": {"id": -1001234567}}}, self.bot.id)
+        # Another pool, with its own database session, holds the lock
+        other = connection.get_new_connection(connection.get_connection_params())
+        other.cursor().execute("SELECT pg_advisory_lock(%s)", [ingestion.FETCHER_LOCK])
+        workers = ingestion.UpdateQueueWorkers(workers=1, poll_interval=0.01)
+        threading.Timer(0.3, workers.stop).start()
+        try:
+            workers.run()
+        finally:
+            other.close()
+        self.assertEqual(TelegramUpdate.objects.filter(claimed=None).count(), 1)
+
+
+@override_settings(TELEGRAM_WEBHOOK_QUEUE=True)
+class TelegramWebhookTestCase(TestCase):
+    def setUp(self):
+        self.token = "123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ"
+        self.bot = TelegramBot.objects.bulk_create([TelegramBot(token=self.token, username="@test_bot")])[0]
+        bots.invalidate()
+        self.client = Client()
+        self.update = '{"update_id": 1, "message": {"chat": {"id": -1001234567}}}'
+
+    def test_secret_token(self):
+        response = self.client.post(
+            "/telegrambot/", self.update, content_type="application/json",
+            HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN=bots.webhook_secret(self.token),
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(TelegramUpdate.objects.get().bot_id, self.bot.id)
+
+    def test_query_token(self):
+        response = self.client.post(f"/telegrambot/?token={self.token}", self.update, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        with override_settings(TELEGRAM_WEBHOOK_QUERY_TOKEN=True), self.assertLogs("telegrambot.views", "WARNING"):
+            response = self.client.post(f"/telegrambot/?token={self.token}", self.update,
+                                        content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(TelegramUpdate.objects.count(), 1)
+
+    def test_unauthorized(self):
+        response = self.client.post(
+            "/telegrambot/", self.update, content_type="application/json",
+            HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN="not-a-secret",
+        )
+        self.assertEqual(response.status_code, 403)
+        with override_settings(TELEGRAM_WEBHOOK_QUERY_TOKEN=True):
+            response = self.client.post("/telegrambot/?token=123:abc", self.update, content_type="application/json")
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post("/telegrambot/", self.update, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(TelegramUpdate.objects.count(), 0)
+
+    def test_registry_invalidation(self):
+        self.assertTrue(bots.is_authorized(self.token))
+        self.bot.delete()
+        self.assertFalse(bots.is_authorized(self.token))
+
+    def test_pooled_bots(self):
+        self.assertEqual(bots.get_token(self.bot.id), self.token)
+        bot = bots.get_bot(self.token)
+        self.assertIs(bot, bots.get_bot(self.token))
+        self.assertIs(bot.request, bots.get_bot("987654321:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ").request)
+        self.assertEqual(bots.request_stats()["requests"], bots.shared_request().requests)
+
+
+class TelegramDispatcherTestCase(TestCase):
+    def test_shared_handlers(self):
+        first = dispatcher.get_dispatcher("123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ")
+        second = dispatcher.get_dispatcher("987654321:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ")
+        self.assertIs(first, dispatcher.get_dispatcher("123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ"))
+        self.assertIsNot(first.bot, second.bot)
+        self.assertIs(first.bot, bots.get_bot("123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ"))
+        for group in first.handlers:
+            self.assertEqual([id(h) for h in first.handlers[group]], [id(h) for h in second.handlers[group]])
+
+
+class TelegramBatchProcessingTestCase(TestCase):
+    class RecordingDispatcher:
+        """Save a user for every update; a duplicated ID raises an IntegrityError"""
+        def process_update(self, update):
+            TgUser.objects.create(id=update.update_id, first_name=f"User {update.update_id}")
+
+    def test_database_error_is_isolated(self):
+        updates = [Update(update_id=1), Update(update_id=2), Update(update_id=1), Update(update_id=3)]
+        ingestion.process_batch(self.RecordingDispatcher(), updates)
+        self.assertEqual(list(TgUser.objects.values_list("id", flat=True)), [1, 2, 3])
+
+    def test_real_dispatcher(self):
+        """PTB hands the errors of the handlers to the error handler instead of raising them"""
+        bot = telegram.Bot("123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ")
+        ptb_dispatcher = Dispatcher(bot, None)
+        ptb_dispatcher.add_error_handler(errors.telegram_error_handler)
+        handled = []
+
+        def save_user(update, context):
+            TgUser.objects.create(id=update.update_id, first_name=f"User {update.update_id}")
+
+        def later_handler(update, context):
+            handled.append(update.update_id)
+            GroupMembership.objects.count()
+            outbound.submit(bot, "send_message", chat_id=update.update_id, text="Saved")
+
+        ptb_dispatcher.add_handler(TypeHandler(Update, save_user), group=0)
+        ptb_dispatcher.add_handler(TypeHandler(Update, later_handler), group=1)
+        updates = [Update(update_id=1), Update(update_id=2), Update(update_id=1), Update(update_id=3)]
+        with patch.object(outbound.scheduler, "_start", lambda: None):
+            ingestion.process_batch(ptb_dispatcher, updates)
+            # The calls are only submitted once the batch is committed
+            self.assertEqual(outbound.scheduler.pending(), 3)
+            outbound.scheduler._queues.clear()
+
+        self.assertEqual(handled, [1, 2, 3])
+        self.assertEqual(list(TgUser.objects.values_list("id", flat=True)), [1, 2, 3])
+
+
+class TelegramUpdateDeduplicationTestCase(TestCase):
+    def setUp(self):
+        self.token = "123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ"
+        self.bot = TelegramBot.objects.bulk_create([TelegramBot(token=self.token, username="@test_bot")])[0]
+
+    def test_window(self):
+        deduplicator = dedup.UpdateDeduplicator(self.token, size=3)
+        self.assertFalse(deduplicator.is_duplicate(10))
+        self.assertFalse(deduplicator.is_duplicate(11))
+        self.assertTrue(deduplicator.is_duplicate(10))
+        self.assertFalse(deduplicator.is_duplicate(12))
+        self.assertFalse(deduplicator.is_duplicate(13))  # 10 leaves the window...
+        self.assertTrue(deduplicator.is_duplicate(10))   # ...but it's below the high-water mark
+        self.assertFalse(deduplicator.is_duplicate(2))   # far below: Telegram restarted the sequence
+        self.assertEqual(deduplicator.duplicates, 2)
+
+    def test_persisted_high_water_mark(self):
+        deduplicator = dedup.UpdateDeduplicator(self.token, size=10, persist=True)
+        for update_id in range(1000, 1000 + 10 + dedup._PERSIST_EVERY):
+            self.assertFalse(deduplicator.is_duplicate(update_id))
+        self.bot.refresh_from_db()
+        self.assertEqual(self.bot.last_update_id, 1000 + dedup._PERSIST_EVERY - 1)
+
+        restarted = dedup.UpdateDeduplicator(self.token, size=10, persist=True)
+        self.assertTrue(restarted.is_duplicate(self.bot.last_update_id))
+        self.assertFalse(restarted.is_duplicate(self.bot.last_update_id + 1))
+
+
+class TelegramWriteBehindTestCase(TestCase):
+    def setUp(self):
+        self.group = TgGroup.objects.create(id=-1001234567, title="Physics II")
+        TgUser.objects.create(id=26170256, first_name="Marco", last_name="Aceti", username="acetimarco")
+        GroupMembership.objects.create(user_id=26170256, group=self.group, messages_count=10)
+        self.buffer = bookkeeping.WriteBehindBuffer(flush_interval=3600, flush_size=5)
+
+    def test_flush(self):
+        marco = User(id=26170256, first_name="Marco", last_name="Aceti", username="marcoaceti", is_bot=False)
+        sette = User(id=244426552, first_name="Sette", is_bot=False, language_code="it")
+        self.buffer.record(marco, self.group.id, count_message=True)
+        self.buffer.record(marco, self.group.id, count_message=True)
+        self.buffer.record(sette, self.group.id, count_message=True)
+        self.buffer.record(sette, self.group.id)
+        self.assertEqual(GroupMembership.objects.get(user_id=26170256).messages_count, 10)
+
+        self.buffer.flush()
+        self.assertEqual(TgUser.objects.get(id=26170256).username, "marcoaceti")
+        self.assertEqual(TgUser.objects.get(id=244426552).language, "it")
+        self.assertEqual(GroupMembership.objects.get(user_id=26170256).messages_count, 12)
+        self.assertEqual(GroupMembership.objects.get(user_id=244426552).messages_count, 1)
+
+    def test_flush_size(self):
+        marco = User(id=26170256, first_name="Marco", is_bot=False)
+        for _ in range(5):
+            self.buffer.record(marco, self.group.id, count_message=True)
+        self.assertEqual(GroupMembership.objects.get(user_id=26170256).messages_count, 15)
+
+    def test_known_memberships(self):
+        self.assertFalse(self.buffer.knows(26170256, self.group.id))
+        self.buffer.remember(26170256, self.group.id)
+        self.assertTrue(self.buffer.knows(26170256, self.group.id))
+        self.assertFalse(self.buffer.knows(26170256, -1007654321))
+
+
+class TelegramSaveUserTestCase(TestCase):
+    def setUp(self):
+        self.group = TgGroup.objects.create(id=-1001234567, title="Physics II")
+
+    def test_save_user(self):
+        chat = Chat(id=self.group.id, type=Chat.SUPERGROUP, title=self.group.title)
+        user = User(id=26170256, first_name="Marco", last_name="Aceti", username="acetimarco", is_bot=False)
+
+        dbuser = utils.save_user(user, chat)
+        self.assertEqual(str(dbuser), "Marco Aceti [26170256]")
+        self.assertFalse(dbuser.banned)
+        self.assertEqual(GroupMembership.objects.get(user_id=user.id, group=self.group).messages_count, 0)
+
+        user.username = "marcoaceti"
+        dbuser = utils.save_user(user, chat, count_message=True)
+        utils.save_user(user, chat, count_message=True)
+        self.assertEqual(dbuser.username, "marcoaceti")
+        self.assertEqual(TgUser.objects.get(id=user.id).username, "marcoaceti")
+        self.assertEqual(GroupMembership.objects.get(user_id=user.id, group=self.group).messages_count, 2)
+
+    def test_banned_user(self):
+        bot = TelegramBot.objects.bulk_create([
+            TelegramBot(token="123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ", username="@test_bot"),
+        ])[0]
+        TgGroup.objects.filter(id=self.group.id).update(bot=bot)
+        TgUser.objects.create(id=26170256, first_name="Marco", banned=True)
+        bots.invalidate()
+        cache.groups.invalidate()
+        chat = Chat(id=self.group.id, type=Chat.SUPERGROUP, title=self.group.title)
+        user = User(id=26170256, first_name="Marco", is_bot=False)
+
+        submitted = []
+        with patch.object(outbound, "submit", lambda bot, method, priority, **kwargs: submitted.append(
+            (method, priority, kwargs)
+        )), self.assertRaises(DispatcherHandlerStop):
+            utils.save_user(user, chat)
+        self.assertEqual(submitted, [
+            ("ban_chat_member", Priority.MODERATION, {"chat_id": self.group.id, "user_id": 26170256}),
+        ])
+
+
+class TelegramGroupCacheTestCase(TestCase):
+    def setUp(self):
+        self.group = TgGroup.objects.create(id=-1001234567, title="Physics II", language="en")
+        self.cache = cache.GroupCache(ttl=300, missing_ttl=60)
+        cache.groups.invalidate()
+
+    def test_get(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.cache.get(self.group.id).title, "Physics II")
+            self.assertEqual(self.cache.get(self.group.id).language, "en")
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.cache.get(-1007654321))
+            self.assertIsNone(self.cache.get(-1007654321))
+
+    def test_update_title(self):
+        self.cache.get(self.group.id)
+        with self.assertNumQueries(0):
+            self.cache.update_title(self.group.id, "Physics II")
+        self.cache.update_title(self.group.id, "Physics III")
+        self.assertEqual(TgGroup.objects.get(id=self.group.id).title, "Physics III")
+        self.assertEqual(self.cache.get(self.group.id).title, "Physics III")
+
+    def test_signal_invalidation(self):
+        self.assertFalse(cache.groups.get(self.group.id).ignore_admin_tagging)
+        self.group.ignore_admin_tagging = True
+        self.group.save()
+        self.assertTrue(cache.groups.get(self.group.id).ignore_admin_tagging)
+
+    def test_welcome_message(self):
+        members = [User(id=26170256, first_name="Marco", is_bot=False)]
+        self.assertEqual(cache.groups.get(self.group.id).generate_welcome_message(members),
+                         self.group.generate_welcome_message(members))
+
+    def test_missing_values(self):
+        # The group has no bot
+        with self.assertRaises(TelegramBot.DoesNotExist):
+            utils.get_bot(self.group.id)
+        with self.assertRaises(TgGroup.DoesNotExist):
+            utils.get_bot(-1007654321)
+
+        utils.activate_group_language(Chat(id=self.group.id, type="supergroup"))
+        self.assertEqual(get_language(), "en")
+        utils.activate_group_language(Chat(id=-1007654321, type="supergroup"))
+        self.assertEqual(get_language(), settings.LANGUAGE_CODE)
+
+
+class TelegramBanCacheTestCase(TestCase):
+    def setUp(self):
+        self.usr1 = TgUser.objects.create(id=26170256, first_name="Marco")
+        self.usr2 = TgUser.objects.create(id=244426552, first_name="Sette", banned=True)
+        BlacklistedUser.objects.create(user_id=108121631, source=BlacklistedUser.BlacklistSource.GROUPHELP)
+        cache.bans.reload()
+
+    def test_user_id_set(self):
+        ids = cache.UserIdSet([30, 10, 20, 10])
+        self.assertEqual(len(ids), 3)
+        self.assertIn(20, ids)
+        self.assertNotIn(15, ids)
+        ids.add(15)
+        ids.discard(10)
+        ids.discard(12)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual([i for i in range(40) if i in ids], [15, 20, 30])
+
+        ids.MERGE_THRESHOLD = 2
+        ids.add(5)
+        self.assertEqual(list(ids._ids), [5, 15, 20, 30])
+
+    def test_lookups(self):
+        with self.assertNumQueries(0):
+            self.assertTrue(cache.bans.is_banned(244426552))
+            self.assertFalse(cache.bans.is_banned(26170256))
+            self.assertTrue(cache.bans.is_blacklisted(108121631))
+            self.assertFalse(cache.bans.is_blacklisted(26170256))
+            utils.check_blacklist(self.usr1)
+        self.assertFalse(self.usr1.banned)
+
+    def test_signals(self):
+        self.usr1.banned = True
+        self.usr1.save()
+        self.assertTrue(cache.bans.is_banned(26170256))
+        self.usr2.delete()
+        self.assertFalse(cache.bans.is_banned(244426552))
+        BlacklistedUser.objects.create(user_id=26170256, source=BlacklistedUser.BlacklistSource.ADMINISTRATOR)
+        self.assertTrue(cache.bans.is_blacklisted(26170256))
+
+    def test_changes_from_other_processes(self):
+        bans = cache.BanCache(ttl=3600, refresh_interval=0)
+        bans.reload()
+        # Written without signals, like another process would
+        TgUser.objects.filter(id=26170256).update(banned=True)
+        TgUser.objects.filter(id=244426552).update(banned=False)
+        BlacklistedUser.objects.bulk_create([
+            BlacklistedUser(user_id=26170256, source=BlacklistedUser.BlacklistSource.GROUPHELP),
+        ])
+
+        # A thread is already refreshing: the others don't wait for it
+        with bans._refresh_lock, self.assertNumQueries(0):
+            self.assertFalse(bans.is_banned(26170256))
+
+        with self.assertNumQueries(3):
+            self.assertTrue(bans.is_banned(26170256))
+        self.assertFalse(bans.is_banned(244426552))
+        self.assertTrue(bans.is_blacklisted(26170256))
+        self.assertTrue(bans.is_blacklisted(108121631))
+
+        BlacklistedUser.objects.filter(user_id=108121631).delete()
+        with self.assertNumQueries(4):
+            self.assertFalse(bans.is_blacklisted(108121631))
+        self.assertTrue(bans.is_blacklisted(26170256))
+
+
+class TelegramPermissionCacheTestCase(TestCase):
+    def setUp(self):
+        self.usr1 = TgUser.objects.create(id=26170256, first_name="Marco")
+        self.usr2 = TgUser.objects.create(id=244426552, first_name="Sette")
+        self.group = TgGroup.objects.create(id=-1001234567890, title="Computer Science general group")
+        department = Department.objects.create(name="Computer Science Department", slug="computer_science")
+        self.degree = Degree.objects.create(name="Computer Science", type='B', department=department, group=self.group)
+        self.role = Moderator.objects.create(tg_user=self.usr1)
+        self.role.degrees.add(self.degree)
+        cache.permissions.invalidate()
+
+    def test_staff_member(self):
+        permissions, telegram_permissions, custom_title = utils.get_permissions(self.usr1.id, self.group.id)
+        self.assertIn(MODERATION_DEL, permissions)
+        self.assertTrue(telegram_permissions["can_manage_chat"])
+        self.assertEqual(custom_title, "Moderatore")
+        with self.assertNumQueries(0):
+            self.assertEqual(utils.get_permissions(self.usr1.id, self.group.id)[2], "Moderatore")
+
+        self.role.degrees.remove(self.degree)
+        self.assertEqual(utils.get_permissions(self.usr1.id, self.group.id), ([], {}, None))
+
+    def test_ordinary_member(self):
+        utils.get_permissions(self.usr1.id, self.group.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(utils.get_permissions(self.usr2.id, self.group.id), ([], {}, None))
+
+        Moderator.objects.create(tg_user=self.usr2, all_groups=True)
+        self.assertIn(MODERATION_DEL, utils.get_permissions(self.usr2.id, self.group.id)[0])
+
+
+@override_settings(TELEGRAM_NETWORK_JOB_RATE=1000)
+class TelegramNetworkJobTestCase(TestCase):
+    def setUp(self):
+        self.bot = TelegramBot.objects.bulk_create([
+            TelegramBot(token="123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ", username="@test_bot"),
+        ])[0]
+        bots.invalidate()
+        self.usr1 = TgUser.objects.create(id=26170256, first_name="Marco")
+        self.groups = [
+            TgGroup.objects.create(id=-1001000000001, title="Group 1", bot=self.bot),
+            TgGroup.objects.create(id=-1001000000002, title="Group 2", bot=self.bot),
+            TgGroup.objects.create(id=-1001000000003, title="Group 3"),
+        ]
+        for group in self.groups:
+            GroupMembership.objects.create(user=self.usr1, group=group)
+
+    def test_role_change_enqueues_job(self):
+        Moderator.objects.create(tg_user=self.usr1, all_groups=True)
+        job = NetworkJob.objects.get(target=self.usr1)
+        self.assertEqual(job.kind, NetworkJob.Kinds.SET_ADMIN_RIGHTS)
+        self.assertEqual(job.groups.filter(status=NetworkJobGroup.Statuses.PENDING).count(), 3)
+        self.assertIsNone(jobs.enqueue(NetworkJob.Kinds.SET_ADMIN_RIGHTS, self.usr1, []))
+
+    def test_worker(self):
+        job = jobs.enqueue(NetworkJob.Kinds.SET_ADMIN_RIGHTS, self.usr1, self.groups)
+        calls = []
+
+        def action(bot, job, group):
+            calls.append(group.id)
+            if group.id == -1001000000001 and calls.count(group.id) == 1:
+                raise telegram.error.RetryAfter(0)
+            if group.id == -1001000000001 and calls.count(group.id) == 2:
+                raise telegram.error.TimedOut()
+            if group.id == -1001000000002:
+                raise telegram.error.BadRequest("Not enough rights")
+
+        rows = list(job.groups.select_related("group").order_by("group_id"))
+        with patch.dict(jobs.ACTIONS, {NetworkJob.Kinds.SET_ADMIN_RIGHTS: action}), \
+                patch.object(jobs, "NETWORK_RETRY_DELAY", 0):
+            jobs._BotWorker(job, self.bot.id, rows[1:]).run()
+            jobs._BotWorker(job, None, rows[:1]).run()
+
+        self.assertEqual(calls, [-1001000000002, -1001000000001, -1001000000001, -1001000000001])
+        statuses = dict(job.groups.values_list("group_id", "status"))
+        self.assertEqual(statuses, {
+            -1001000000003: NetworkJobGroup.Statuses.FAILED,
+            -1001000000002: NetworkJobGroup.Statuses.FAILED,
+            -1001000000001: NetworkJobGroup.Statuses.DONE,
+        })
+        self.assertEqual(job.groups.get(group_id=-1001000000001).attempts, 3)
+        self.assertEqual(job.groups.get(group_id=-1001000000002).error, "Not enough rights")
+
+    def test_set_admin_rights_reads_the_roles(self):
+        job = jobs.enqueue(NetworkJob.Kinds.SET_ADMIN_RIGHTS, self.usr1, self.groups)
+        promotions = []
+
+        class Bot:
+            token = "123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ"
+
+            def promote_chat_member(self, chat_id, user_id, **rights):
+                promotions.append(rights)
+
+            def set_chat_administrator_custom_title(self, chat_id, user_id, custom_title):
+                promotions.append(custom_title)
+
+        # The permissions cached before the role was deleted in another process
+        stale = ([], {"can_delete_messages": True}, "Moderator")
+        with patch.object(cache.permissions, "get", lambda user_id, chat_id, resolve: stale):
+            jobs.ACTIONS[NetworkJob.Kinds.SET_ADMIN_RIGHTS](Bot(), job, self.groups[0])
+        self.assertEqual(promotions, [{}])
+
+    def test_superban(self):
+        job = jobs.enqueue(NetworkJob.Kinds.SUPERBAN, self.usr1, self.groups)
+        banned, logged = [], []
+
+        class Bot:
+            token = "123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ"
+
+            def ban_chat_member(self, chat_id, user_id):
+                banned.append((chat_id, user_id))
+                if chat_id == -1001000000002:
+                    raise telegram.error.BadRequest("Not enough rights")
+
+        rows = list(job.groups.select_related("group").order_by("group_id"))
+        with patch.object(bots, "get_bot", lambda token: Bot()), \
+                patch.object(logging, "log_job_group", lambda *args: logged.append(args)):
+            jobs._BotWorker(job, self.bot.id, rows[1:]).run()
+
+        self.assertEqual(banned, [(-1001000000002, 26170256), (-1001000000001, 26170256)])
+        self.assertEqual(logged, [
+            (logging.MODERATION_SUPERBAN, job.id, self.groups[1], "Not enough rights"),
+            (logging.MODERATION_SUPERBAN, job.id, self.groups[0], None),
+        ])
+        self.assertEqual(job.groups.get(group_id=-1001000000003).status, NetworkJobGroup.Statuses.PENDING)
+
+
+class FakeBot:
+    """Record the calls to the Bot API instead of making them"""
+    def __init__(self, token: str = "123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ", retry_after: int = 0):
+        self.token = token
+        self.retry_after = retry_after
+        self.calls = []
+
+    def send_message(self, chat_id: int, text: str):
+        if self.retry_after:
+            self.retry_after -= 1
+            raise telegram.error.RetryAfter(0)
+        self.calls.append((chat_id, text))
+        return text
+
+
+class TelegramOutboundTestCase(TestCase):
+    def test_token_bucket(self):
+        bucket = outbound.TokenBucket(rate=1, capacity=2)
+        self.assertEqual(bucket.wait_time(bucket.updated), 0)
+        bucket.take()
+        bucket.take()
+        self.assertAlmostEqual(bucket.wait_time(bucket.updated), 1)
+        self.assertAlmostEqual(bucket.wait_time(bucket.updated + 0.5), 0.5)
+        bucket.pause(10, bucket.updated)
+        self.assertAlmostEqual(bucket.wait_time(bucket.updated - 5), 5)
+
+    def test_priorities(self):
+        scheduler = outbound.OutboundScheduler(rate=1000, group_rate=1000, workers=1)
+        bot = FakeBot()
+        # Queue the calls before starting the scheduler, so that they're all in the queue
+        scheduler._start = lambda: None
+        scheduler.submit(bot, "send_message", Priority.LOG, chat_id=-1001, text="log")
+        scheduler.submit(bot, "send_message", Priority.WELCOME, chat_id=-1002, text="welcome")
+        scheduler.submit(bot, "send_message", Priority.MODERATION, chat_id=-1003, text="ban")
+
+        order = []
+        while (call := scheduler._next_call()[0]) is not None:
+            order.append(call.chat_id)
+        self.assertEqual(order, [-1003, -1002, -1001])
+
+    def test_same_chat(self):
+        scheduler = outbound.OutboundScheduler(rate=1000, group_rate=1000, workers=1)
+        bot = FakeBot()
+        scheduler._start = lambda: None
+        scheduler.submit(bot, "send_message", Priority.LOG, chat_id=-1001, text="first")
+        scheduler.submit(bot, "send_message", Priority.LOG, chat_id=-1001, text="second")
+
+        first, _ = scheduler._next_call()
+        self.assertEqual(scheduler._next_call(), (None, None))  # the chat is busy
+        scheduler._execute(first)
+        second, _ = scheduler._next_call()
+        scheduler._execute(second)
+        self.assertEqual(bot.calls, [(-1001, "first"), (-1001, "second")])
+
+    def test_retry_after(self):
+        scheduler = outbound.OutboundScheduler(rate=1000, group_rate=1000, workers=2)
+        bot = FakeBot(retry_after=2)
+        future = scheduler.submit(bot, "send_message", Priority.INTERACTIVE, chat_id=26170256, text="hi")
+        self.assertEqual(future.result(timeout=10), "hi")
+        self.assertEqual(bot.calls, [(26170256, "hi")])
+
+    def test_string_chat_id(self):
+        scheduler = outbound.OutboundScheduler(rate=1000, group_rate=1000, workers=2)
+        bot = FakeBot()
+        self.assertEqual(scheduler.submit(bot, "send_message", chat_id="-1001000000000", text="log")
+                         .result(timeout=10), "log")
+        self.assertEqual(scheduler.submit(bot, "send_message", chat_id="@channel", text="channel")
+                         .result(timeout=10), "channel")
+        self.assertEqual(scheduler.submit(bot, "send_message", chat_id=26170256, text="hi").result(timeout=10), "hi")
+        self.assertEqual(len(bot.calls), 3)
+
+    def test_backlog_does_not_starve_other_chats(self):
+        scheduler = outbound.OutboundScheduler(rate=1000, group_rate=20, workers=1)
+        bot = FakeBot()
+        scheduler._start = lambda: None
+        for i in range(500):
+            scheduler.submit(bot, "send_message", Priority.MODERATION, chat_id=-1001, text=str(i))
+        scheduler.submit(bot, "send_message", Priority.SYNC, chat_id=-1002, text="other")
+
+        chats = []
+        while (call := scheduler._next_call()[0]) is not None:
+            chats.append(call.chat_id)
+            scheduler._done(call)
+        # The burst of the first chat, then the other chat while the first one is rate limited
+        self.assertEqual(chats, [-1001, -1001, -1001, -1002])
+        self.assertEqual(scheduler.pending(), 497)
+
+
+class TelegramExpiryTestCase(TestCase):
+    def setUp(self):
+        bot = TelegramBot.objects.bulk_create([
+            TelegramBot(token="123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ", username="@test_bot"),
+        ])[0]
+        self.group = TgGroup.objects.create(id=-1007777777, title="Physics II", bot=bot)
+        bots.invalidate()
+        cache.groups.invalidate()
+
+    def test_bulk_deletions(self):
+        for message_id in range(150):
+            expiry.schedule(self.group.id, message_id, delay=-10)
+        expiry.schedule(-1009999999, 1, delay=-10)  # the bot is not in the chat
+        expiry.schedule(self.group.id, 1000)
+        self.assertGreaterEqual(expiry.lag(), 10)
+
+        calls = []
+        scheduler = expiry.DeletionScheduler()
+        with patch.object(expiry, "delete_messages", lambda bot, chat_id, ids: calls.append((chat_id, ids))):
+            self.assertEqual(scheduler.load(), 151)
+            self.assertEqual(scheduler.run_once(), 151)
+            self.assertEqual(scheduler.load(), 0)  # the submitted rows are not loaded again
+            self.assertEqual(scheduler.apply_results(timeout=5), 150)
+
+        self.assertEqual(calls, [(self.group.id, list(range(100))), (self.group.id, list(range(100, 150)))])
+        self.assertEqual(list(ScheduledDeletion.objects.values_list("message_id", flat=True)), [1000])
+        self.assertEqual(expiry.lag(), 0)
+        self.assertGreaterEqual(scheduler.max_lag, 10)
+
+    def test_does_not_wait(self):
+        expiry.schedule(self.group.id, 1, delay=-10)
+        released = threading.Event()
+        scheduler = expiry.DeletionScheduler()
+        with patch.object(expiry, "delete_messages", lambda bot, chat_id, ids: released.wait(5)):
+            scheduler.load()
+            self.assertEqual(scheduler.run_once(), 1)  # returns while the call is still blocked
+            self.assertEqual(scheduler.apply_results(), 0)
+            released.set()
+            self.assertEqual(scheduler.apply_results(timeout=5), 1)
+
+    def test_transient_errors(self):
+        expiry.schedule(self.group.id, 1, delay=-10)
+        expiry.schedule(self.group.id, 2, delay=-10)
+
+        def delete_messages(bot, chat_id, ids):
+            raise telegram.error.TimedOut()
+
+        scheduler = expiry.DeletionScheduler()
+        with patch.object(expiry, "delete_messages", delete_messages):
+            scheduler.load()
+            self.assertEqual(scheduler.run_once(), 2)
+            self.assertEqual(scheduler.apply_results(timeout=5), 0)
+        # Rescheduled, not lost
+        self.assertEqual(ScheduledDeletion.objects.count(), 2)
+        self.assertGreater(ScheduledDeletion.objects.aggregate(Min("due_at"))["due_at__min"], datetime.now())
+
+        def delete_messages(bot, chat_id, ids):
+            raise telegram.error.BadRequest("Message to delete not found")
+
+        ScheduledDeletion.objects.update(due_at=datetime.now())
+        with patch.object(expiry, "delete_messages", delete_messages):
+            scheduler.load()
+            scheduler.run_once()
+            self.assertEqual(scheduler.apply_results(timeout=5), 2)
+        self.assertFalse(ScheduledDeletion.objects.exists())
+
+
+class TelegramGroupSyncTestCase(TestCase):
+    def setUp(self):
+        bot = TelegramBot.objects.bulk_create([
+            TelegramBot(token="123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ", username="@test_bot"),
+        ])[0]
+        self.group = TgGroup.objects.create(id=-1007777777, title="Old title", bot=bot)
+        self.former_admin = TgUser.objects.create(id=108121631, first_name="Former")
+        GroupMembership.objects.create(user=self.former_admin, group=self.group, status="administrator")
+        bots.invalidate()
+        cache.groups.invalidate()
+
+    @staticmethod
+    def _done(result) -> Future:
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def _fake_submit(self, bot, method, priority, chat_id):
+        self.assertEqual(priority, Priority.SYNC)
+        if method == "get_chat":
+            return self._done(Chat(id=chat_id, type="supergroup", title="Physics II", description="Lectures"))
+        return self._done([
+            telegram.ChatMember(User(id=26170256, first_name="Marco", is_bot=False), "creator"),
+            telegram.ChatMember(User(id=244426552, first_name="Sette", is_bot=False), "administrator"),
+        ])
+
+    def test_sync(self):
+        with patch.object(outbound, "submit", self._fake_submit):
+            self.assertEqual(groupsync.sync(groupsync.due_groups()), {"updated": 1, "failed": 0})
+
+        self.group.refresh_from_db()
+        self.assertEqual((self.group.title, self.group.description), ("Physics II", "Lectures"))
+        self.assertEqual(self.group.owner_id, 26170256)
+        statuses = dict(GroupMembership.objects.filter(group=self.group).values_list("user_id", "status"))
+        self.assertEqual(statuses, {26170256: "creator", 244426552: "administrator", 108121631: "member"})
+        self.assertEqual(groupsync.due_groups(), [])
+
+    def test_admin_changes_are_kept(self):
+        group = groupsync.due_groups()[0]
+        TgGroup.objects.filter(id=self.group.id).update(welcome_model="Hello {greetings}")
+        with patch.object(outbound, "submit", self._fake_submit):
+            groupsync.sync([group])
+        self.group.refresh_from_db()
+        self.assertEqual((self.group.title, self.group.welcome_model), ("Physics II", "Hello {greetings}"))
+
+    @override_settings(TELEGRAM_GROUP_SYNC_INTERVAL=3600)
+    def test_failure_backoff(self):
+        def submit(bot, method, priority, chat_id):
+            future = Future()
+            future.set_exception(telegram.error.BadRequest("Chat not found"))
+            return future
+
+        for failures in (1, 2):
+            with patch.object(outbound, "submit", submit):
+                self.assertEqual(groupsync.sync(groupsync.due_groups(datetime.now() + timedelta(days=1))),
+                                 {"updated": 0, "failed": 1})
+            self.group.refresh_from_db()
+            self.assertEqual(self.group.info_failures, failures)
+            self.assertEqual(groupsync.due_groups(), [])
+        # Retried after 2 ** failures hours
+        self.assertEqual(groupsync.due_groups(datetime.now() + timedelta(hours=3)), [])
+        self.assertEqual(groupsync.due_groups(datetime.now() + timedelta(hours=4, minutes=1)), [self.group])
+
+        with patch.object(outbound, "submit", self._fake_submit):
+            groupsync.sync([self.group])
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.info_failures, 0)
+
+    @override_settings(TELEGRAM_GROUP_SYNC_INTERVAL=3600, TELEGRAM_GROUP_SYNC_IDLE_INTERVAL=86400)
+    def test_due_groups(self):
+        now = datetime(2024, 5, 10, 12)
+        idle = TgGroup.objects.create(id=-1008888888, title="Idle", bot=self.group.bot,
+                                      info_updated_at=datetime(2024, 5, 10, 9))
+        never = TgGroup.objects.create(id=-1009999999, title="Never", bot=self.group.bot)
+        TgGroup.objects.filter(id=self.group.id).update(info_updated_at=datetime(2024, 5, 10, 10))
+        GroupMembership.objects.filter(group=self.group).update(last_seen=datetime(2024, 5, 10, 11))
+
+        self.assertEqual(groupsync.due_groups(now), [never, self.group])
+        self.assertEqual(groupsync.due_groups(datetime(2024, 5, 11, 11)), [never, idle, self.group])
+
+        # The memberships are only looked up for the groups which may be due
+        TgGroup.objects.update(info_updated_at=now)
+        with self.assertNumQueries(1):
+            self.assertEqual(groupsync.due_groups(now), [])
+
+    def test_service_updates(self):
+        groupsync.update_title(self.group.id, "Physics III")
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.title, "Physics III")
+        self.assertEqual(cache.groups.get(self.group.id).title, "Physics III")
+        self.assertNotIn(self.group, groupsync.due_groups())
+
+        TgGroup.objects.filter(id=self.group.id).update(info_updated_at=None)
+        user = User(id=108121631, first_name="Former", is_bot=False)
+        groupsync.update_member_status(self.group.id, telegram.ChatMember(user, "member"),
+                                       telegram.ChatMember(user, "restricted"))
+        self.assertIn(self.group, groupsync.due_groups())
+
+        groupsync.update_member_status(self.group.id, telegram.ChatMember(user, "administrator"),
+                                       telegram.ChatMember(user, "creator"))
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.owner_id, 108121631)
+        self.assertEqual(GroupMembership.objects.get(user_id=108121631).status, "creator")
+        self.assertNotIn(self.group, groupsync.due_groups())
+
+    def test_photo(self):
+        sizes = [telegram.PhotoSize(f"file-{size}", f"unique-{size}", size, size) for size in (160, 640, 320)]
+        scheduled = []
+        with self.captureOnCommitCallbacks() as callbacks:
+            groupsync.update_photo(self.group.id, sizes)
+        self.assertEqual(len(callbacks), 1)
+
+        class File:
+            def __init__(self, file_id):
+                self.file_unique_id = file_id.replace("file", "unique")
+
+            def download_as_bytearray(self):
+                return bytearray(b"\xff\xd8\xff")
+
+        def call(bot, method, priority, file_id):
+            scheduled.append((method, file_id))
+            return File(file_id)
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(MEDIA_ROOT=directory), \
+                patch.object(outbound, "call", call):
+            groupsync.download_photo(self.group.id, "file-640")
+            self.group.refresh_from_db()
+            old = Path(self.group.profile_picture.path)
+            self.assertTrue(old.exists())
+
+            groupsync.download_photo(self.group.id, "file-800")
+            self.group.refresh_from_db()
+            self.assertTrue(Path(self.group.profile_picture.path).exists())
+            self.assertFalse(old.exists())
+
+            new = Path(self.group.profile_picture.path)
+            with self.captureOnCommitCallbacks(execute=True):
+                groupsync.delete_photo(self.group.id)
+            self.assertFalse(new.exists())
+        self.assertEqual(scheduled, [("get_file", "file-640"), ("get_file", "file-800")])
+
+
+class TelegramBlocklistTestCase(TestCase):
+    def test_parse_ids(self):
+        body = b'{"ok": true, "result": [108121631, "26170256",\n 244426552]}'
+        chunks = [body[i:i + 5] for i in range(0, len(body), 5)]
+        self.assertEqual(list(blocklist.parse_ids(chunks)), [108121631, 26170256, 244426552])
+        self.assertEqual(list(blocklist.parse_ids([b'{"ok": true, "result": []}'])), [])
+        with self.assertRaises(ValueError):
+            list(blocklist.parse_ids([b'{"ok": true, "result": [108121631, 2617']))
+
+    def test_sync(self):
+        source = BlacklistedUser.BlacklistSource.GROUPHELP
+        BlacklistedUser.objects.bulk_create([
+            BlacklistedUser(user_id=1, source=source),
+            BlacklistedUser(user_id=2, source=source),
+            BlacklistedUser(user_id=3, source=BlacklistedUser.BlacklistSource.ADMINISTRATOR),
+        ])
+        TgUser.objects.create(id=4, first_name="Known")
+        TgUser.objects.create(id=5, first_name="Innocent")
+
+        entries = []
+        with patch.object(logging, "log", lambda **kwargs: entries.append(kwargs["reason"])):
+            # existing rows, savepoint, insert, delete, update, release, 4 to refresh the cache after the deletion
+            with self.assertNumQueries(10):
+                report = blocklist.sync({2, 3, 4}, source)
+        self.assertEqual(report, {"added": 2, "removed": 1, "flagged": 1})
+        self.assertEqual(entries, ["1 known users are blacklisted (source: GroupHelp)"])
+        rows = BlacklistedUser.objects.order_by("user_id").values_list("user_id", "source")
+        self.assertEqual(list(rows), [(2, "GH"), (3, "A"), (4, "GH")])
+        self.assertEqual(list(TgUser.objects.filter(banned=True).values_list("id", flat=True)), [4])
+        self.assertTrue(cache.bans.is_blacklisted(4))
+        self.assertTrue(cache.bans.is_banned(4))
+
+
+class TelegramLogWriterTestCase(TestCase):
+    def setUp(self):
+        self.group = TgGroup.objects.create(id=-1001234567, title="Physics II")
+        self.issuer = TgUser.objects.create(id=26170256, first_name="Marco", last_name="Aceti")
+        self.writer = logging.LogWriter(flush_interval=3600, flush_size=100)
+        self.writer._start_timer = lambda: None
+        cache.groups.invalidate()
+
+    def test_flush(self):
+        target = User(id=244426552, first_name="Sette", is_bot=False)
+        unknown_chat = Chat(id=-1009999999, type="supergroup", title="Unknown")
+        self.writer.add(TelegramLog.Events.USER_JOINED, chat_id=self.group.id, target=target)
+        self.writer.add(TelegramLog.Events.MODERATION_BAN, chat_id=self.group.id, target=target,
+                        issuer=self.issuer, reason="spam")
+        self.writer.add(TelegramLog.Events.CHAT_DOES_NOT_EXIST, chat_id=unknown_chat.id)
+        self.assertFalse(TelegramLog.objects.exists())
+
+        cache.groups.get(self.group.id)
+        cache.groups.get(unknown_chat.id)
+        with self.assertNumQueries(4):  # users stubs, savepoint, log rows, release
+            self.writer.flush()
+        self.assertEqual(TgUser.objects.get(id=244426552).first_name, "Sette")
+        rows = TelegramLog.objects.order_by("id").values_list("event", "chat_id", "target_id", "issuer_id")
+        self.assertEqual(list(rows), [
+            (TelegramLog.Events.USER_JOINED, self.group.id, 244426552, None),
+            (TelegramLog.Events.MODERATION_BAN, self.group.id, 244426552, 26170256),
+            (TelegramLog.Events.CHAT_DOES_NOT_EXIST, None, None, None),
+        ])
+
+    def test_existing_users_are_kept(self):
+        issuer = User(id=26170256, first_name="Someone else", is_bot=False)
+        self.writer.add(TelegramLog.Events.BROADCAST, chat_id=None, issuer=issuer)
+        self.writer.flush()
+        self.assertEqual(TgUser.objects.get(id=26170256).last_name, "Aceti")
+        self.assertEqual(TelegramLog.objects.get().issuer_id, 26170256)
+
+    def test_rolled_back_events(self):
+        with self.captureOnCommitCallbacks(execute=True), patch.object(logging.writer, "_start_timer", lambda: None):
+            try:
+                with transaction.atomic():
+                    logging.log_db_save(logging.USER_JOINED, None, target=self.issuer)
+                    raise DatabaseError()
+            except DatabaseError:
+                pass
+            logging.log_db_save(logging.USER_LEFT, None, target=self.issuer)
+        self.assertEqual([row["event"] for row in logging.writer._rows], [TelegramLog.Events.USER_LEFT])
+        logging.writer._rows.clear()
+        logging.writer._users.clear()
+
+    def test_bad_rows_are_skipped(self):
+        with connection.cursor() as cursor:
+            # The foreign keys are checked when the test transaction would commit
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        unsaved = TgUser(id=244426552, first_name="Sette")
+        self.writer.add(TelegramLog.Events.USER_JOINED, chat_id=self.group.id, target=unsaved)
+        self.writer.add(TelegramLog.Events.USER_LEFT, chat_id=-1009999999, target=unsaved)
+        self.writer.add(TelegramLog.Events.MODERATION_BAN, chat_id=self.group.id, target=unsaved, issuer=self.issuer)
+
+        # The cache claims a chat exists, but it was deleted in the meantime
+        with patch.object(cache.groups, "get", lambda chat_id: True):
+            self.writer.flush()
+        self.assertEqual(TgUser.objects.get(id=244426552).first_name, "Sette")
+        self.assertEqual(list(TelegramLog.objects.order_by("id").values_list("event", flat=True)),
+                         [TelegramLog.Events.USER_JOINED, TelegramLog.Events.MODERATION_BAN])
+
+
+class TelegramLogPartitionTestCase(TestCase):
+    def setUp(self):
+        self.group = TgGroup.objects.create(id=-1001234567, title="Physics II")
+        TgUser.objects.create(id=26170256, first_name="Marco")
+        self.march = partitions.create_partition(date(2020, 3, 14))
+        partitions.create_partition(date(2020, 4, 1))
+        TelegramLog.objects.bulk_create([
+            TelegramLog(event=TelegramLog.Events.USER_JOINED, chat=self.group, target_id=26170256,
+                        timestamp=datetime(2020, 3, day, 12)) for day in range(1, 11)
+        ] + [TelegramLog(event=TelegramLog.Events.USER_LEFT, timestamp=datetime(2020, 4, 1))])
+        # A partition with pending foreign key checks can't be dropped
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+    def test_expired_partitions(self):
+        names = [p.name for p in partitions.expired_partitions(1, today=date(2020, 4, 20))]
+        self.assertEqual(names, ["telegrambot_telegramlog_p2020_03"])
+        self.assertEqual(partitions.expired_partitions(2, today=date(2020, 4, 20)), [])
+        self.assertIn(partitions.Partition.of(date.today()), partitions.ensure_partitions())
+
+    def test_archive_and_import(self):
+        ids = list(TelegramLog.objects.filter(event=TelegramLog.Events.USER_JOINED).values_list("id", flat=True))
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(partitions.archive_partition(self.march, Path(directory)), 10)
+            self.assertNotIn(self.march, partitions.partitions())
+            self.assertEqual(TelegramLog.objects.count(), 1)
+
+            TgUser.objects.filter(id=26170256).delete()
+            path = Path(directory) / self.march.archive_name
+            self.assertEqual(partitions.import_archive(path), 10)
+            partitions.import_archive(path)
+
+        self.assertIn(self.march, partitions.partitions())
+        restored = TelegramLog.objects.filter(event=TelegramLog.Events.USER_JOINED).order_by("id")
+        self.assertEqual([log.id for log in restored], ids)
+        self.assertEqual(TelegramLog.objects.count(), 11)
+        self.assertEqual({(log.chat_id, log.target_id) for log in restored}, {(self.group.id, 26170256)})
+
+    def test_rows_in_default_partition(self):
+        TelegramLog.objects.bulk_create([
+            TelegramLog(event=TelegramLog.Events.USER_LEFT, timestamp=datetime(2020, 5, day)) for day in (1, 31)
+        ] + [TelegramLog(event=TelegramLog.Events.USER_LEFT, timestamp=datetime(2020, 6, 1))])
+        may = partitions.create_partition(date(2020, 5, 1))
+        self.assertIn(may, partitions.partitions())
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {may.name}")
+            self.assertEqual(cursor.fetchone()[0], 2)
+            cursor.execute(f"SELECT COUNT(*) FROM {partitions.TABLE}_default")
+            self.assertEqual(cursor.fetchone()[0], 1)
+        self.assertEqual(TelegramLog.objects.count(), 14)
+
+
+class TelegramLogSearchTestCase(TestCase):
+    def setUp(self):
+        self.group = TgGroup.objects.create(id=-1001234567, title="Physics II")
+        TgUser.objects.create(id=26170256, first_name="Marco", last_name="Aceti", username="acetimarco")
+        TgUser.objects.create(id=244426552, first_name="Sette")
+        TelegramLog.objects.bulk_create([
+            TelegramLog(event=TelegramLog.Events.USER_JOINED, chat=self.group, target_id=244426552,
+                        timestamp=datetime(2024, 5, 1, 12, i)) for i in range(30)
+        ] + [
+            TelegramLog(event=TelegramLog.Events.MODERATION_BAN, chat=self.group, target_id=244426552,
+                        issuer_id=26170256, reason="Spam of crypto scams", timestamp=datetime(2024, 5, 1, 12, 0)),
+        ])
+
+    def search(self, term: str) -> set[int]:
+        return set(logsearch.search(TelegramLog.objects.all(), term).values_list("event", flat=True))
+
+    def test_search(self):
+        self.assertEqual(self.search("26170256"), {TelegramLog.Events.MODERATION_BAN})
+        self.assertEqual(self.search("@AcetiMarco"), {TelegramLog.Events.MODERATION_BAN})
+        self.assertEqual(self.search("crypto"), {TelegramLog.Events.MODERATION_BAN})
+        self.assertEqual(self.search("Aceti"), {TelegramLog.Events.MODERATION_BAN})
+        self.assertEqual(len(logsearch.search(TelegramLog.objects.all(), "physics")), 31)
+        self.assertEqual(self.search("nothing"), set())
+
+    def test_keyset_pages(self):
+        seen, cursor = [], None
+        while True:
+            logs, cursor = logsearch.page(TelegramLog.objects.all(), cursor, 7)
+            seen += [log.id for log in logs]
+            if cursor is None:
+                break
+        expected = TelegramLog.objects.order_by("-timestamp", "-id").values_list("id", flat=True)
+        self.assertEqual(seen, list(expected))
+
+    def test_api(self):
+        url = reverse("api-telegram-logs")
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        staff = get_user_model().objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(staff)
+        response = self.client.get(url, {"target": 244426552, "limit": 20}, HTTP_ACCEPT="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["results"]), 20)
+        response = self.client.get(url, {"target": 244426552, "before": response.json()["next"]},
+                                   HTTP_ACCEPT="application/json")
+        self.assertEqual(len(response.json()["results"]), 11)
+        self.assertIsNone(response.json()["next"])
+        self.assertEqual(self.client.get(url, {"before": "yesterday"}).status_code, 400)
+
+        response = self.client.get(reverse("admin:telegrambot_telegramlog_changelist"), {"q": "crypto"})
+        self.assertContains(response, "MODERATION_BAN")
+        response = self.client.get(reverse("admin:telegrambot_telegramlog_changelist"),
+                                   {"before": logsearch.encode_cursor(datetime(2024, 5, 1, 12, 10), 0)})
+        self.assertEqual(len(response.context["cl"].result_list), 11)
+        response = self.client.get(reverse("admin:telegrambot_telegramlog_changelist"),
+                                   {"timestamp__gte": "2024-05-02", "timestamp__lt": "2024-05-03"})
+        self.assertEqual(len(response.context["cl"].result_list), 0)
+        response = self.client.get(reverse("admin:telegrambot_user_change", args=[244426552]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_export(self):
+        url = reverse("api-telegram-logs-export")
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        staff = get_user_model().objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(staff)
+        events = f"{TelegramLog.Events.MODERATION_BAN},{TelegramLog.Events.MODERATION_WARN}"
+        response = self.client.get(url, {"chat": self.group.id, "event": events})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], ",".join(partitions.FIELDS))
+        self.assertEqual(len(lines), 2)
+        self.assertIn("MODERATION_BAN", lines[1])
+
+        response = self.client.get(url, {"format": "ndjson", "user": 244426552, "since": "2024-05-01T12:10",
+                                         "until": "2024-05-01T12:20"})
+        rows = [partitions.deserialize(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row["timestamp"].minute for row in rows], list(range(10, 20)))
+        self.assertEqual(self.client.get(url, {"since": "last week"}).status_code, 400)
+
+        response = self.client.get(url, {"event": "moderation_ban,MODERATION_WARN"})
+        self.assertEqual(len(b"".join(response.streaming_content).decode().splitlines()), 2)
+        self.assertEqual(self.client.get(url, {"event": "NO_SUCH_EVENT"}).status_code, 400)
+
+        TelegramLog.objects.create(event=TelegramLog.Events.MODERATION_WARN, chat=self.group,
+                                   reason='=HYPERLINK("http://example.com")', message="-1+2",
+                                   timestamp=datetime(2024, 5, 2))
+        response = self.client.get(url, {"event": "MODERATION_WARN"})
+        line = b"".join(response.streaming_content).decode().splitlines()[1]
+        self.assertIn("'=HYPERLINK", line)
+        self.assertIn("'-1+2", line)
+
+
+@override_settings(LOGGING_CHAT_ID=-1001000000000, LOGGING_BOT_TOKEN="123456789:cXoh8Mf3SHxvWD4eVThAhvjziny4xSZP8HQ")
+class TelegramLogShipperTestCase(TestCase):
+    def setUp(self):
+        self.shipper = logging.LogShipper(interval=3600)
+        self.shipper._start_timer = lambda: None
+        self.submitted = []
+        submit = patch.object(outbound, "submit", lambda bot, method, priority, **kwargs: self.submitted.append(
+            (method, kwargs.get("text"))
+        ))
+        submit.start()
+        self.addCleanup(submit.stop)
+
+    def test_coalescing(self):
+        self.shipper.add("➕ #USER_JOINED 1")
+        self.shipper.add("➖ #USER_LEFT 2")
+        self.assertEqual(self.submitted, [])
+        self.shipper.ship("🔴 #MODERATION_BAN")
+        self.assertEqual(self.submitted, [
+            ("send_message", "➕ #USER_JOINED 1\n\n➖ #USER_LEFT 2"),
+            ("send_message", "🔴 #MODERATION_BAN"),
+        ])
+
+    def test_message_length(self):
+        for i in range(100):
+            self.shipper.add(f"➕ #USER_JOINED {i:0>80}")
+        self.shipper.flush()
+        self.assertEqual(len(self.submitted), 3)
+        self.assertTrue(all(len(text) <= 4096 for _, text in self.submitted))
+        self.assertEqual(sum(text.count("#USER_JOINED") for _, text in self.submitted), 100)
+
+    def test_prepared_entry(self):
+        futures = {}
+
+        def submit(bot, method, priority, **kwargs):
+            futures[method] = Future()
+            self.submitted.append((method, kwargs.get("text")))
+            return futures[method]
+
+        msg = telegram.Message(5, datetime.now(), Chat(id=-1001234567, type="supergroup"))
+        self.shipper.add("➕ #USER_JOINED 1")
+        with patch.object(outbound, "submit", submit), patch.object(logging, "shipper", self.shipper):
+            prepared = logging.prepare(msg)  # doesn't wait for the log chat
+            self.shipper.ship("✏️ #MODERATION_DEL", prepared_entry=prepared)
+            log_chat = Chat(id=-1001000000000, type="supergroup")
+            futures["send_message"].set_result(telegram.Message(7, datetime.now(), log_chat))
+            self.assertFalse(prepared.done())
+            futures["forward_message"].set_result(None)
+
+        self.assertEqual(prepared.result().message_id, 7)
+        # The collected lines are sent before the placeholder
+        self.assertEqual(self.submitted[:2], [("send_message", "➕ #USER_JOINED 1"), ("send_message", "...")])
+        self.assertEqual([method for method, _ in self.submitted[2:]], ["forward_message", "edit_message_text"])
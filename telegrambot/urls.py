@@ -4,5 +4,7 @@ from django.views.decorators.csrf import csrf_exempt
 from . import views
 
 urlpatterns = [
-    path("", csrf_exempt(views.TelegramBotWebhookView.as_view()))
+    path("", csrf_exempt(views.TelegramBotWebhookView.as_view())),
+    path("logs", views.telegram_logs, name="api-telegram-logs"),
+    path("logs/export", views.export_telegram_logs, name="api-telegram-logs-export"),
 ]
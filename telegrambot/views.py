@@ -1,27 +1,130 @@
+import csv
 import json
+import logging as logg
 
-from django.http import JsonResponse
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views import View
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
 
+from telegrambot import bots, ingestion, logsearch, partitions
 from telegrambot.handlers.dispatcher import dispatch_telegram_update
-from telegrambot.models import TelegramBot
+from telegrambot.models import TelegramLog
+from telegrambot.serializers import TelegramLogSerializer
+
+LOG = logg.getLogger(__name__)
+
+# Maximum number of log rows per page of the staff API
+MAX_LOGS_PAGE_SIZE = 200
+# Rows fetched at once by the server-side cursor of the export
+EXPORT_CHUNK_SIZE = 2000
 
 
 class TelegramBotWebhookView(View):
     @staticmethod
     def post(request, *args, **kwargs):
-        token = request.GET.get('token', None)
-        if not token:
+        # Webhooks set with `manage.py set_webhooks` authenticate with the secret token header;
+        # the token query parameter of the webhooks set the old way is only accepted if enabled
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", None)
+        if secret:
+            token = bots.get_token_by_secret(secret)
+        elif settings.TELEGRAM_WEBHOOK_QUERY_TOKEN:
+            token = request.GET.get('token', None)
+            if token:
+                LOG.warning("Webhook of bot %s authenticated by the token query parameter, "
+                            "run `manage.py set_webhooks`", token.split(":")[0])
+        else:
+            token = None
+        if not secret and not token:
             return JsonResponse({"ok": False, "error": "Bad request"}, status=400)
 
-        try:
-            TelegramBot.objects.get(token=token)
-        except TelegramBot.DoesNotExist:
+        if not token or not bots.is_authorized(token):
             return JsonResponse({"ok": False, "error": "Unauthorized bot token. Nice try, hacker! :)"}, status=403)
 
-        dispatch_telegram_update(json.loads(request.body), token)
+        if settings.TELEGRAM_WEBHOOK_QUEUE:
+            # The update is processed later by the `process_updates` workers
+            ingestion.enqueue(json.loads(request.body), bots.get_bot_id(token))
+        else:
+            dispatch_telegram_update(json.loads(request.body), token)
         return JsonResponse({"ok": True})
 
     @staticmethod
     def get(request, *args, **kwargs):
         return JsonResponse({"ok": False, "error": "Method not allowed"}, status=405)
+
+
+def _check_logs_permission(user) -> None:
+    if not user.is_authenticated or not user.is_staff or not user.has_perm("telegrambot.view_telegramlog"):
+        raise PermissionDenied
+
+
+@api_view(["GET"])
+def telegram_logs(request):
+    """Return a page of the moderation log, newest first, for the staff.
+    Filters: chat, target, issuer, event, q (see telegrambot.logsearch); `before` is the cursor of the page.
+    """
+    _check_logs_permission(request.user)
+    try:
+        size = min(int(request.query_params.get("limit", 50)), MAX_LOGS_PAGE_SIZE)
+        queryset = logsearch.filter_logs(TelegramLog.objects.all(), request.query_params)
+        logs, next_cursor = logsearch.page(queryset, request.query_params.get(logsearch.CURSOR_VAR), size)
+    except ValueError:
+        return Response({"ok": False, "error": "Bad filters or cursor"}, status=400)
+    return Response({"results": TelegramLogSerializer(logs, many=True).data, "next": next_cursor})
+
+
+class _Echo:
+    """A file-like object which returns what is written, for csv.writer"""
+    @staticmethod
+    def write(value: str) -> str:
+        return value
+
+
+# The first characters of a cell which a spreadsheet would evaluate as a formula
+_FORMULA_CHARS = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _csv_cell(value):
+    """Escape the text cells which a spreadsheet would evaluate as a formula, e.g. a message like =HYPERLINK(...)"""
+    if isinstance(value, str) and value.startswith(_FORMULA_CHARS):
+        return "'" + value
+    return value
+
+
+def _csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(partitions.FIELDS)
+    for row in rows:
+        row["event"] = TelegramLog.Events(row["event"]).name
+        yield writer.writerow([_csv_cell(row[field]) for field in partitions.FIELDS])
+
+
+def _ndjson_lines(rows):
+    for row in rows:
+        yield partitions.serialize(row) + "\n"
+
+
+def export_telegram_logs(request):
+    """Stream the moderation log rows as CSV (format=csv, the default) or NDJSON (format=ndjson), oldest first.
+    The filters are the ones of telegram_logs (see logsearch.filter_logs). NDJSON exports can be loaded
+    with `manage.py import_logs` once gzipped.
+    """
+    _check_logs_permission(request.user)
+    export_format = request.GET.get("format", "csv")
+    if export_format not in ("csv", "ndjson"):
+        return JsonResponse({"ok": False, "error": "Unknown format"}, status=400)
+    try:
+        queryset = logsearch.filter_logs(TelegramLog.objects.all(), request.GET)
+    except ValueError:
+        return JsonResponse({"ok": False, "error": "Bad filters"}, status=400)
+
+    # A server-side cursor: only EXPORT_CHUNK_SIZE rows are in memory at a time
+    rows = queryset.order_by("timestamp", "id").values(*partitions.FIELDS).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    if export_format == "csv":
+        response = StreamingHttpResponse(_csv_lines(rows), content_type="text/csv")
+    else:
+        response = StreamingHttpResponse(_ndjson_lines(rows), content_type="application/x-ndjson")
+    response["Content-Disposition"] = f'attachment; filename="telegram-logs.{export_format}"'
+    return response
@@ -5,3 +5,6 @@ class UniversityConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'university'
     verbose_name = 'University data'
+
+    def ready(self):
+        from university import signals  # noqa: F401 (connect the signal receivers)
@@ -0,0 +1,49 @@
+# Generated by Django 3.2.9 on 2026-10-18 07:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_group_degrees(apps, schema_editor):
+    """Create the GroupDegree rows from Degree.group and Course.group, like university.models.rebuild_group_degrees"""
+    GroupDegree = apps.get_model("university", "GroupDegree")
+    Degree = apps.get_model("university", "Degree")
+    CourseDegree = apps.get_model("university", "CourseDegree")
+
+    rows = {}
+    course_degrees = CourseDegree.objects.filter(course__group__isnull=False)
+    for degree_id, group_id in course_degrees.values_list("degree_id", "course__group_id"):
+        rows[(group_id, degree_id)] = False
+    for degree_id, group_id in Degree.objects.filter(group__isnull=False).values_list("id", "group_id"):
+        rows[(group_id, degree_id)] = True
+
+    GroupDegree.objects.bulk_create([
+        GroupDegree(group_id=group_id, degree_id=degree_id, main=main)
+        for (group_id, degree_id), main in rows.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegrambot', '0001_initial'),
+        ('university', '0014_auto_20231022_1330'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupDegree',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('main', models.BooleanField(default=False, verbose_name='main group of the degree')),
+                ('degree', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='group_degrees', to='university.degree')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='group_degrees', to='telegrambot.group')),
+            ],
+            options={
+                'verbose_name': 'Group degree',
+                'verbose_name_plural': 'Group degrees',
+                'unique_together': {('group', 'degree')},
+            },
+        ),
+        migrations.RunPython(fill_group_degrees, migrations.RunPython.noop),
+    ]
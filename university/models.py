@@ -1,5 +1,5 @@
 from django.contrib import admin
-from django.db import models
+from django.db import models, transaction
 
 from telegrambot.models import (
     User as TgUser,
@@ -132,6 +132,62 @@ class CourseDegree(models.Model):
         return f"{self.course.name} ∈ {self.degree.name}"
 
 
+class GroupDegree(models.Model):
+    """The degrees a Telegram group belongs to, either as the main group of the degree
+    or as the group of one of its courses.
+
+    This is a denormalized copy of Degree.group and Course.group, kept up to date
+    by the signals in university.signals, so that finding the degrees of a chat
+    is a single indexed lookup.
+    """
+    class Meta:
+        verbose_name = "Group degree"
+        verbose_name_plural = "Group degrees"
+        unique_together = ("group", "degree")
+
+    group = models.ForeignKey(TgGroup, on_delete=models.CASCADE, related_name="group_degrees")
+    degree = models.ForeignKey(Degree, on_delete=models.CASCADE, related_name="group_degrees")
+    main = models.BooleanField("main group of the degree", default=False)
+
+    def __str__(self):
+        return f"{self.group_id} ∈ {self.degree_id}"
+
+    @classmethod
+    def refresh(cls, degree_ids=None) -> None:
+        """Rebuild the rows of some degrees, or of all of them.
+
+        :param degree_ids: the IDs of the degrees to rebuild (default: all the degrees)
+        """
+        rebuild_group_degrees(cls, Degree, CourseDegree, degree_ids)
+
+
+def rebuild_group_degrees(group_degree_model, degree_model, course_degree_model, degree_ids=None) -> None:
+    """Rebuild the GroupDegree rows of some degrees from Degree.group and Course.group.
+    The models are parameters so that the migrations can use their historical versions.
+    """
+    degrees = degree_model.objects.filter(group__isnull=False)
+    course_degrees = course_degree_model.objects.filter(course__group__isnull=False)
+    stale = group_degree_model.objects.all()
+    if degree_ids is not None:
+        degree_ids = list(degree_ids)
+        degrees = degrees.filter(id__in=degree_ids)
+        course_degrees = course_degrees.filter(degree_id__in=degree_ids)
+        stale = stale.filter(degree_id__in=degree_ids)
+
+    rows: dict[tuple[int, int], bool] = {}
+    for degree_id, group_id in course_degrees.values_list("degree_id", "course__group_id"):
+        rows[(group_id, degree_id)] = False
+    for degree_id, group_id in degrees.values_list("id", "group_id"):
+        rows[(group_id, degree_id)] = True
+
+    with transaction.atomic():
+        stale.delete()
+        group_degree_model.objects.bulk_create([
+            group_degree_model(group_id=group_id, degree_id=degree_id, main=main)
+            for (group_id, degree_id), main in rows.items()
+        ])
+
+
 class CourseLink(models.Model):
     """Additional links to show on the website for a specific course."""
     course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name="links")
@@ -0,0 +1,68 @@
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete, m2m_changed
+from django.dispatch import receiver
+
+from telegrambot import cache
+from university.models import Degree, Course, CourseDegree, GroupDegree
+
+
+def _refresh(degree_ids) -> None:
+    GroupDegree.refresh(degree_ids)
+    # The permissions of the staff members depend on the degrees of the groups
+    cache.permissions.invalidate()
+
+
+# The degrees being deleted: their CourseDegree rows are deleted first, and refreshing
+# the degree at that point would insert GroupDegree rows pointing to the deleted degree.
+_deleting_degrees: set[int] = set()
+
+
+@receiver(pre_delete, sender=Degree)
+def start_degree_deletion(instance: Degree, **_) -> None:
+    _deleting_degrees.add(instance.id)
+
+
+@receiver(post_delete, sender=Degree)
+def end_degree_deletion(instance: Degree, **_) -> None:
+    _deleting_degrees.discard(instance.id)
+
+
+@receiver(post_save, sender=Degree)
+def refresh_degree_groups(instance: Degree, **_) -> None:
+    _refresh([instance.id])
+
+
+@receiver(post_save, sender=Course)
+def refresh_course_groups(instance: Course, **_) -> None:
+    _refresh(instance.degrees.values_list("id", flat=True))
+
+
+@receiver(pre_save, sender=CourseDegree)
+def remember_previous_degree(instance: CourseDegree, **_) -> None:
+    instance._previous_degree_id = None
+    if instance.pk is not None:
+        instance._previous_degree_id = CourseDegree.objects.filter(pk=instance.pk)\
+            .values_list("degree_id", flat=True).first()
+
+
+@receiver([post_save, post_delete], sender=CourseDegree)
+def refresh_course_degree_groups(instance: CourseDegree, **_) -> None:
+    degree_ids = {instance.degree_id, getattr(instance, "_previous_degree_id", None)} - {None} - _deleting_degrees
+    if not degree_ids:
+        return
+    _refresh(degree_ids)
+
+
+@receiver(m2m_changed, sender=CourseDegree)
+def refresh_changed_degrees(instance: Course | Degree, action: str, reverse: bool, pk_set: set | None, **_) -> None:
+    """Course.degrees.add/remove/clear() write the CourseDegree rows without saving them one by one"""
+    if reverse:  # instance is a Degree
+        if action in ("post_add", "post_remove", "post_clear"):
+            _refresh([instance.id])
+        return
+
+    if action == "pre_clear":
+        instance._cleared_degree_ids = list(instance.degrees.values_list("id", flat=True))
+    elif action == "post_clear":
+        _refresh(getattr(instance, "_cleared_degree_ids", []))
+    elif action in ("post_add", "post_remove"):
+        _refresh(pk_set)
@@ -15,6 +15,7 @@ from university.models import (
     CourseLink,
     Degree,
     Department,
+    GroupDegree,
     Representative,
     Professor,
 )
@@ -323,6 +324,50 @@ class DegreeTestCase(TestCase):
         })
 
 
+class GroupDegreeTestCase(TestCase):
+    def setUp(self):
+        dep1 = Department.objects.create(pk=1, name="Computer Science Department", slug="computer_science")
+        self.group1 = TgGroup.objects.create(id=1001, title="Computer Science general group")
+        self.group2 = TgGroup.objects.create(id=1002, title="Programming I fan club")
+        self.deg1 = Degree.objects.create(pk=1, name="Computer Science", type='B', department=dep1, group=self.group1)
+        self.deg2 = Degree.objects.create(pk=2, name="Computer Science", type='M', department=dep1)
+        self.course1 = Course.objects.create(pk=1, name="Programming I", cfu=12, group=self.group2)
+        CourseDegree.objects.create(degree=self.deg1, course=self.course1, year=1, semester=1)
+
+    def mapping(self) -> set:
+        return set(GroupDegree.objects.values_list("group_id", "degree_id", "main"))
+
+    def test_refresh_on_changes(self):
+        self.assertEqual(self.mapping(), {(1001, 1, True), (1002, 1, False)})
+
+        CourseDegree.objects.create(degree=self.deg2, course=self.course1)
+        self.assertEqual(self.mapping(), {(1001, 1, True), (1002, 1, False), (1002, 2, False)})
+
+        self.course1.group = None
+        self.course1.save()
+        self.assertEqual(self.mapping(), {(1001, 1, True)})
+
+        self.course1.group = self.group2
+        self.course1.save()
+        self.deg1.group = self.group2
+        self.deg1.save()
+        self.assertEqual(self.mapping(), {(1002, 1, True), (1002, 2, False)})
+
+        self.course1.degrees.remove(self.deg2)
+        self.assertEqual(self.mapping(), {(1002, 1, True)})
+
+        self.deg1.delete()
+        self.assertEqual(self.mapping(), set())
+
+    def test_refresh_all(self):
+        GroupDegree.objects.all().delete()
+        GroupDegree.refresh()
+        self.assertEqual(self.mapping(), {(1001, 1, True), (1002, 1, False)})
+
+        self.group2.delete()
+        self.assertEqual(self.mapping(), {(1001, 1, True)})
+
+
 class DepartmentTestCase(TestCase):
     def setUp(self):
         self.dep1 = Department.objects.create(
@@ -1,22 +1,16 @@
 import json
 import random
 from django.core.exceptions import PermissionDenied
-from django.db.models import Count, Q
+from django.db.models import Count
 from django.db.models.functions import Length
 from django.db.utils import IntegrityError
 from django.http import HttpResponse, HttpRequest
 from django.shortcuts import get_object_or_404, render
-from polymorphic.query import PolymorphicQuerySet
 from rest_framework import viewsets
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
-from roles.models import (
-    BaseRole,
-    Moderator,
-    Administrator,
-    SuperAdministrator,
-)
+from roles.models import get_staff_users
 from university.models import (
     DEGREE_TYPES,
     Degree,
@@ -207,11 +201,7 @@ def admin_by_degree(request):
     except (Degree.DoesNotExist, TypeError):
         return Response({"ok": False, "error": "Not found"}, status=404)
 
-    roles: PolymorphicQuerySet[BaseRole] = BaseRole.objects.filter(
-        (Q(degrees__in=[degree]) | Q(all_groups=True))
-    )
-    roles = roles.instance_of(Moderator) | roles.instance_of(Administrator) | roles.instance_of(SuperAdministrator)
-    serializer = UserSerializer([role.tg_user for role in roles], many=True)
+    serializer = UserSerializer(get_staff_users([degree.id]), many=True)
     return Response(serializer.data)
 
 